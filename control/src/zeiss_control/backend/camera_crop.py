@@ -0,0 +1,145 @@
+"""Crop the camera to a ROI, on the camera if possible, in software otherwise."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Literal
+
+from psygnal import Signal
+
+from zeiss_control.gui._util.roi import RectROI
+
+if TYPE_CHECKING:
+    import numpy as np
+    from pymmcore_plus import CMMCorePlus
+
+
+class CameraCrop:
+    """Reduce the frames to a ROI of the sensor before they are distributed.
+
+    `apply(roi)` takes a `RectROI` in the pixels of the frames as they are delivered
+    now (e.g. drawn in the Preview, possibly already cropped) and sets it as the
+    camera ROI with `setROI`, so the camera reads out and transfers less data.
+    Cameras round the ROI to their alignment; the remainder, or the whole ROI if
+    the camera doesn't support one (or `mode` is "software"), is cut out of every
+    frame by `crop`, which the `FrameHub` and the `LiveEngine` call before handing
+    the frames on.  `crop` leaves frames of any other shape alone, so it can be
+    applied twice.
+
+    `crop_changed(origin, shape)` is emitted with the (row, column) of the first
+    pixel on the sensor and the (rows, columns) of the frames after the crop.  The
+    crop can't be changed while an MDA is running.  `center_offset` is where the
+    cropped frames are relative to the center of the sensor, which the stage
+    positions refer to; the viewers offset the tiles by it.
+    """
+
+    crop_changed = Signal(tuple, tuple)
+
+    def __init__(
+        self, mmcore: CMMCorePlus,
+        mode: Literal["auto", "hardware", "software"] = "auto",
+    ) -> None:
+        self._mmc = mmcore
+        self.mode = mode
+        # (row, column) on the sensor of the first pixel of the camera frames
+        self.hardware_origin = (0, 0)
+        # (rows, columns) of the whole sensor, the camera is assumed to be at full
+        # frame at the start and it is read again with every change
+        self.sensor_shape = (mmcore.getImageHeight(), mmcore.getImageWidth())
+        # part of the camera frames that is kept, None for all of it
+        self.software: RectROI | None = None
+        # (rows, columns) of the camera frames the software crop applies to
+        self._source_shape: tuple[int, int] | None = None
+
+    @property
+    def origin(self) -> tuple[int, int]:
+        """(row, column) on the sensor of the first pixel of the cropped frames."""
+        row, column = self.hardware_origin
+        if self.software is not None:
+            row, column = row + self.software.top, column + self.software.left
+        return row, column
+
+    @property
+    def center_offset(self) -> tuple[float, float]:
+        """(rows, columns) from the center of the sensor to the center of the crop."""
+        shape = self.shape()
+        return tuple(  # type: ignore[return-value]
+            o - (s - c) / 2 for o, s, c in zip(self.origin, self.sensor_shape, shape)
+        )
+
+    def shape(self) -> tuple[int, int]:
+        """(rows, columns) of the frames after the crop."""
+        if self.software is not None:
+            return self.software.height, self.software.width
+        return self._mmc.getImageHeight(), self._mmc.getImageWidth()
+
+    def crop(self, frame: np.ndarray, copy: bool = False) -> np.ndarray:
+        """The part of `frame` in the ROI.
+
+        A view, unless `copy`: a view keeps the whole frame alive, copy frames that
+        are kept around.
+        """
+        if self.software is None or frame.shape[-2:] != self._source_shape:
+            return frame
+        cropped = frame[..., self.software.slices[0], self.software.slices[1]]
+        return cropped.copy() if copy else cropped
+
+    def apply(self, roi: RectROI) -> None:
+        if not roi:
+            return
+        top, left = self.origin
+        sensor = RectROI(top + roi.top, left + roi.left,
+                         top + roi.bottom, left + roi.right)
+        self._reconfigure(sensor)
+
+    def clear(self) -> None:
+        """Back to the full sensor."""
+        self._reconfigure(None)
+
+    def _reconfigure(self, sensor: RectROI | None) -> None:
+        if self._mmc.mda.is_running():
+            raise RuntimeError("The camera ROI can't be changed during an MDA.")
+        live = self._mmc.isSequenceRunning()
+        if live:
+            self._mmc.stopSequenceAcquisition()
+        try:
+            self.software = None
+            hardware = self._set_hardware(sensor)
+            if sensor is not None and hardware != sensor:
+                # what the camera couldn't do, relative to the camera frames
+                row, column = self.hardware_origin
+                self.software = RectROI(
+                    sensor.top - row, sensor.left - column,
+                    sensor.bottom - row, sensor.right - column,
+                )
+                self._source_shape = (hardware.height, hardware.width)
+        finally:
+            if live:
+                self._mmc.startContinuousSequenceAcquisition()
+        self.crop_changed.emit(self.origin, self.shape())
+
+    def _set_hardware(self, sensor: RectROI | None) -> RectROI:
+        """Set the camera ROI as close to `sensor` as possible, return what was set."""
+        # full frame first, to know the size of the sensor
+        self._mmc.clearROI()
+        _, _, width, height = self._mmc.getROI()
+        self.sensor_shape = (height, width)
+        if sensor is not None and self.mode != "software":
+            try:
+                self._mmc.setROI(sensor.left, sensor.top, sensor.width, sensor.height)
+            except RuntimeError as e:
+                if self.mode == "hardware":
+                    raise
+                print("Camera ROI not supported, cropping in software:", e)
+                self._mmc.clearROI()
+        x, y, width, height = self._mmc.getROI()
+        hardware = RectROI(y, x, y + height, x + width)
+        if sensor is not None and not (
+            hardware.top <= sensor.top and hardware.left <= sensor.left
+            and hardware.bottom >= sensor.bottom and hardware.right >= sensor.right
+        ):
+            # e.g. a camera that ignored part of the ROI
+            self._mmc.clearROI()
+            x, y, width, height = self._mmc.getROI()
+            hardware = RectROI(y, x, y + height, x + width)
+        self.hardware_origin = (hardware.top, hardware.left)
+        return hardware
@@ -0,0 +1,222 @@
+"""Single fan-out point for the frames of an MDA, backed by a ring of frame slots."""
+
+from __future__ import annotations
+
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+from psygnal import Signal
+
+if TYPE_CHECKING:
+    from pymmcore_plus import CMMCorePlus
+    from useq import MDAEvent, MDASequence
+
+    from zeiss_control.backend.camera_crop import CameraCrop
+
+
+@dataclass
+class HubStats:
+    """Counters of a `FrameHub`, reset at every sequence start."""
+
+    frames: int = 0
+    # frames that had to go to a temporary buffer because all slots were leased
+    overflows: int = 0
+    # {consumer name -> number of times it still held a slot that was due for reuse}
+    lagging: dict[str, int] = field(default_factory=dict)
+    # {consumer name -> longest time spent in its callback in ms}
+    max_callback_ms: dict[str, float] = field(default_factory=dict)
+
+
+class _Consumer:
+    def __init__(self, callback: Callable, name: str, retain: bool) -> None:
+        self.name = name
+        self.retain = retain
+        if hasattr(callback, "__self__"):
+            self._ref: Callable = weakref.WeakMethod(callback)
+        else:
+            self._ref = lambda: callback
+        self.key = _callback_key(callback)
+
+    @property
+    def callback(self) -> Callable | None:
+        return self._ref()
+
+
+class FrameHub:
+    """Deliver each frame of the MDA once to all consumers, without copying it.
+
+    The hub is the only listener of `mmcore.mda.events.frameReady`.  Every frame is
+    copied once into the next slot of a preallocated ring buffer and all consumers
+    get a read-only view of that slot.  A slot is reused when the ring comes back to
+    it, unless a consumer still holds a lease on it.
+
+    Consumers connected with `retain=False` must not keep the frame after their
+    callback returned.  Consumers connected with `retain=True` hold a lease from the
+    moment their callback is called and must give the frame back with `release`
+    when they are done, e.g. after a queued write.  If a slot is still leased when
+    it is due for reuse, the hub takes the next free slot (or a temporary buffer if
+    there is none) instead of waiting, and reports the consumer in
+    `consumer_lagging`.  Callbacks that take longer than `slow_callback_ms` are
+    reported in `consumer_slow`.
+
+    With a `crop`, only the part of the frames in its ROI is copied and delivered,
+    so the slots and all consumers get the smaller frames.
+
+    Consumers are held by weak reference, like psygnal does for bound methods.
+
+    Parameters
+    ----------
+    mmcore : CMMCorePlus
+        The core whose MDA frames are distributed.
+    n_slots : int
+        Number of frame slots in the ring.
+    slow_callback_ms : float
+        Callbacks taking longer than this are reported.
+    crop : CameraCrop | None
+        Software crop applied to the frames before they are distributed.
+    """
+
+    consumer_lagging = Signal(str, int)
+    consumer_slow = Signal(str, float)
+
+    def __init__(
+        self, mmcore: CMMCorePlus, n_slots: int = 16, slow_callback_ms: float = 50,
+        crop: CameraCrop | None = None,
+    ) -> None:
+        self._mmc = mmcore
+        self.crop = crop
+        self.n_slots = n_slots
+        self.slow_callback_ms = slow_callback_ms
+        self.stats = HubStats()
+
+        self._consumers: list[_Consumer] = []
+        self._slots: list[np.ndarray] = []
+        # {slot -> {consumer name -> number of leases}}
+        self._leases: list[dict[str, int]] = []
+        # {address of the slot data -> slot}, to find the slot of a released frame
+        self._addresses: dict[int, int] = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+        self._mmc.mda.events.sequenceStarted.connect(self.sequenceStarted)
+        self._mmc.mda.events.frameReady.connect(self.frameReady)
+
+    # ------------------------ consumers ------------------------
+
+    def connect(
+        self, callback: Callable, name: str | None = None, retain: bool = False
+    ) -> Callable:
+        """Call `callback(frame, event)` for every frame."""
+        name = name or getattr(callback, "__qualname__", repr(callback))
+        self._consumers.append(_Consumer(callback, name, retain))
+        return callback
+
+    def disconnect(self, callback: Callable) -> None:
+        key = _callback_key(callback)
+        self._consumers = [c for c in self._consumers if c.key != key]
+
+    def release(self, frame: np.ndarray, name: str | None = None) -> None:
+        """Give back a frame delivered to a consumer connected with `retain=True`.
+
+        `name` is the name the consumer was connected with. It is only needed if
+        several retaining consumers are connected, to report the right one as lagging.
+        """
+        slot = self._addresses.get(frame.__array_interface__["data"][0])
+        if slot is None:
+            return  # not one of our slots, e.g. an overflow buffer or network image
+        with self._lock:
+            leases = self._leases[slot]
+            if name not in leases:
+                name = next(iter(leases), None)
+                if name is None:
+                    return
+            leases[name] -= 1
+            if not leases[name]:
+                del leases[name]
+
+    # ------------------------ mmcore ------------------------
+
+    def sequenceStarted(self, seq: MDASequence) -> None:
+        self.stats = HubStats()
+
+    def frameReady(self, frame: np.ndarray, event: MDAEvent) -> None:
+        """Copy the frame into a free slot and hand it to all consumers."""
+        self.stats.frames += 1
+        if self.crop is not None:
+            frame = self.crop.crop(frame)
+        slot = self._acquire_slot(frame)
+        if slot is None:
+            self.stats.overflows += 1
+            view = frame.copy()
+        else:
+            np.copyto(self._slots[slot], frame)
+            view = self._slots[slot].view()
+        view.flags.writeable = False
+
+        for consumer in list(self._consumers):
+            if (callback := consumer.callback) is None:
+                self._remove(consumer)
+                continue
+            if consumer.retain and slot is not None:
+                with self._lock:
+                    leases = self._leases[slot]
+                    leases[consumer.name] = leases.get(consumer.name, 0) + 1
+            t0 = time.perf_counter()
+            try:
+                callback(view, event)
+            except Exception as e:
+                print(f"\033[1mERROR in frame consumer {consumer.name}\033[0m", repr(e))
+            elapsed = (time.perf_counter() - t0) * 1000
+            if elapsed > self.stats.max_callback_ms.get(consumer.name, 0):
+                self.stats.max_callback_ms[consumer.name] = elapsed
+            if elapsed > self.slow_callback_ms:
+                self.consumer_slow.emit(consumer.name, elapsed)
+
+    # ------------------------ private ------------------------
+
+    def _remove(self, consumer: _Consumer) -> None:
+        """Forget a consumer that was garbage collected, and its leases."""
+        self._consumers.remove(consumer)
+        with self._lock:
+            for leases in self._leases:
+                leases.pop(consumer.name, None)
+
+    def _acquire_slot(self, frame: np.ndarray) -> int | None:
+        if not self._slots or (
+            self._slots[0].shape != frame.shape or self._slots[0].dtype != frame.dtype
+        ):
+            self._allocate(frame.shape, frame.dtype)
+        free = None
+        lagging: dict[str, int] = {}
+        with self._lock:
+            for _ in range(self.n_slots):
+                slot = self._next
+                self._next = (self._next + 1) % self.n_slots
+                if not self._leases[slot]:
+                    free = slot
+                    break
+                lagging.update(self._leases[slot])
+        for name, count in lagging.items():
+            self.stats.lagging[name] = self.stats.lagging.get(name, 0) + 1
+            self.consumer_lagging.emit(name, count)
+        return free
+
+    def _allocate(self, shape: tuple[int, ...], dtype: np.dtype) -> None:
+        """(Re)allocate the ring for frames of `shape` and `dtype`."""
+        with self._lock:
+            self._slots = [np.empty(shape, dtype) for _ in range(self.n_slots)]
+            self._leases = [{} for _ in range(self.n_slots)]
+            self._addresses = {
+                s.__array_interface__["data"][0]: i for i, s in enumerate(self._slots)
+            }
+            self._next = 0
+
+
+def _callback_key(callback: Callable) -> tuple[int, str]:
+    return id(getattr(callback, "__self__", callback)), getattr(
+        callback, "__name__", ""
+    )
@@ -0,0 +1,159 @@
+"""Live mode: drain the camera buffer in a worker thread, display the newest frame."""
+
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Any
+
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+if TYPE_CHECKING:
+    import numpy as np
+    from pymmcore_plus import CMMCorePlus
+
+    from zeiss_control.backend.camera_crop import CameraCrop
+    from zeiss_control.backend.pretrigger import PreTriggerBuffer
+
+
+@dataclass
+class LiveStats:
+    """Rates over the last `stats_interval` and counts since live mode started."""
+
+    # frames delivered by the camera per second
+    camera_fps: float = 0.0
+    # frames taken for display per second
+    display_fps: float = 0.0
+    # frames received since the start of live mode
+    frames: int = 0
+    # frames replaced by a newer one before they were displayed
+    skipped: int = 0
+    # frames lost by the camera buffer (gaps in ImageNumber or buffer overflows)
+    dropped: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"camera {self.camera_fps:.1f} fps, display {self.display_fps:.1f} fps, "
+            f"{self.dropped} dropped"
+        )
+
+
+class LiveEngine(QtCore.QThread):
+    """Drain the circular buffer of the core while a live acquisition is running.
+
+    The thread pops every image with `popNextImageAndMD`, so the buffer never fills
+    up and every camera frame is counted, but only the newest one is kept.
+    `frame_ready` is emitted when a new frame is waiting and the previous one was
+    `take`n, so the GUI thread never has more than one queued display and skips
+    whatever it can't keep up with.  `stats_changed(LiveStats)` is emitted every
+    `stats_interval` seconds.  If a `pretrigger` buffer is set, every frame is
+    appended to it, including the skipped ones.  Frames are reduced by the software
+    `crop` first, if one is set.
+
+    ```python
+    engine.frame_ready.connect(lambda: show(engine.take()))
+    engine.start()  # after startContinuousSequenceAcquisition
+    engine.stop()
+    ```
+    """
+
+    frame_ready = Signal()
+    stats_changed = Signal(object)
+
+    def __init__(
+        self,
+        mmcore: CMMCorePlus,
+        poll_interval: float = 0.001,
+        stats_interval: float = 1.0,
+        pretrigger: PreTriggerBuffer | None = None,
+        crop: CameraCrop | None = None,
+        parent: QtCore.QObject | None = None,
+    ) -> None:
+        super().__init__(parent)
+        self._mmc = mmcore
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+        self.pretrigger = pretrigger
+        self.crop = crop
+        self.stats = LiveStats()
+        self._lock = threading.Lock()
+        self._latest: np.ndarray | None = None
+        self._waiting = False
+        self._displayed = 0
+        self._stop = threading.Event()
+
+    def take(self) -> np.ndarray | None:
+        """The newest frame, None if it was taken already. Call from the GUI."""
+        with self._lock:
+            frame, self._latest = self._latest, None
+            self._waiting = False
+        if frame is not None:
+            self._displayed += 1
+        return frame
+
+    def start(self, *args: Any) -> None:
+        # cleared here and not in `run`, which could clear a `stop` that came first
+        self._stop.clear()
+        super().start(*args)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self.wait()
+
+    def run(self) -> None:
+        self.stats = LiveStats()
+        self._latest = None
+        self._waiting = False
+        self._displayed = 0
+        last_number: int | None = None
+        window_start, window_frames, window_displayed = time.perf_counter(), 0, 0
+
+        while not self._stop.is_set():
+            if self._mmc.isBufferOverflowed():
+                # the frames in the buffer are lost, the gap shows in ImageNumber
+                self._mmc.clearCircularBuffer()
+            remaining = self._mmc.getRemainingImageCount()
+            if not remaining:
+                time.sleep(self.poll_interval)
+            # only what is there now, so the stats are updated under full load too
+            for _ in range(remaining):
+                frame, meta = self._mmc.popNextImageAndMD()
+                if self.crop is not None:
+                    # the frame is kept by the pre-trigger buffer, don't hold the
+                    # full sensor frame with a view
+                    frame = self.crop.crop(frame, copy=True)
+                self.stats.frames += 1
+                window_frames += 1
+                number = _image_number(meta)
+                if number is not None and last_number is not None:
+                    self.stats.dropped += max(0, number - last_number - 1)
+                last_number = number
+                if self.pretrigger is not None:
+                    self.pretrigger.append(frame)
+                with self._lock:
+                    if self._latest is not None:
+                        self.stats.skipped += 1
+                    self._latest = frame
+                    notify = not self._waiting
+                    self._waiting = True
+                if notify:
+                    self.frame_ready.emit()
+
+            now = time.perf_counter()
+            if now - window_start >= self.stats_interval:
+                seconds = now - window_start
+                self.stats.camera_fps = window_frames / seconds
+                self.stats.display_fps = (self._displayed - window_displayed) / seconds
+                window_start, window_frames = now, 0
+                window_displayed = self._displayed
+                self.stats_changed.emit(replace(self.stats))
+
+
+def _image_number(meta: object) -> int | None:
+    """The camera frame counter that MMCore adds to the metadata of every image."""
+    try:
+        return int(meta["ImageNumber"])  # type: ignore[index]
+    except (KeyError, TypeError, ValueError, RuntimeError):
+        return None
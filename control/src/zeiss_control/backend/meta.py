@@ -2,34 +2,152 @@ from pymmcore_plus import CMMCorePlus
 from pymmcore_widgets import MDAWidget
 from useq import MDASequence, MDAEvent
 import numpy as np 
-from collections import defaultdict
-import json
 from pathlib import Path
 from time import perf_counter
+from zeiss_control.output._util._metadata_sink import FrameMetadataSink
+from zeiss_control.backend.frame_hub import FrameHub
+
+INDEX_DIMS = ("p", "t", "z", "c", "g")
+FRAME_DTYPE = np.dtype([
+    ("timestamp", "f8"), ("min_start_time", "f8"),
+    *((dim, "i4") for dim in INDEX_DIMS),
+    ("channel", "i2"), ("group", "i2"), ("exposure", "f4"),
+    ("x_pos", "f8"), ("y_pos", "f8"),
+])
+
+
+class FrameMetadataTable():
+    """Columnar in-memory table of the metadata of each frame.
+
+    Rows are stored in preallocated structured NumPy arrays of `block_size` frames
+    (about 60 bytes per frame), a new block is added when the last one is full.
+    Channel and group names are interned and stored as integer ids, missing indices
+    are -1 and missing positions/times NaN. The query methods work on whole columns.
+    """
+    def __init__(self, block_size: int = 4096) -> None:
+        self.block_size = block_size
+        self._blocks: list[np.ndarray] = []
+        self._n_last = block_size
+        self._data: np.ndarray | None = None
+        self.channel_names: list[str] = []
+        self.group_names: list[str] = []
+        self._ids: dict[tuple[str, str], int] = {}
+
+    def __len__(self) -> int:
+        return max(0, len(self._blocks) - 1) * self.block_size + (
+            self._n_last if self._blocks else 0)
+
+    def append(self, timestamp: float, event: MDAEvent) -> None:
+        if self._n_last == self.block_size:
+            self._blocks.append(np.empty(self.block_size, dtype=FRAME_DTYPE))
+            self._n_last = 0
+        row = self._blocks[-1][self._n_last]
+        row["timestamp"] = timestamp
+        row["min_start_time"] = _or_nan(event.min_start_time)
+        for dim in INDEX_DIMS:
+            row[dim] = event.index.get(dim, -1)
+        channel = event.channel
+        row["channel"] = self._intern("channel", channel.config if channel else "")
+        row["group"] = self._intern("group", channel.group if channel else "")
+        row["exposure"] = _or_nan(event.exposure)
+        row["x_pos"] = _or_nan(event.x_pos)
+        row["y_pos"] = _or_nan(event.y_pos)
+        self._n_last += 1
+        self._data = None
+
+    @property
+    def data(self) -> np.ndarray:
+        """All rows as one structured array (cached until the next append)."""
+        if self._data is None:
+            if not self._blocks:
+                self._data = np.empty(0, dtype=FRAME_DTYPE)
+            else:
+                self._data = np.concatenate(
+                    [*self._blocks[:-1], self._blocks[-1][:self._n_last]])
+        return self._data
+
+    def mask(self, channel: str | None = None, **index: int) -> np.ndarray:
+        """Boolean mask of the rows with channel `channel` and e.g. `p=0, z=2`."""
+        data = self.data
+        selected = np.ones(len(data), dtype=bool)
+        if channel is not None:
+            key = ("channel", channel)
+            selected &= data["channel"] == self._ids.get(key, -1)
+        for dim, value in index.items():
+            selected &= data[dim] == value
+        return selected
+
+    def column(self, name: str, channel: str | None = None, **index: int) -> np.ndarray:
+        """Values of column `name` for the selected rows."""
+        data = self.data
+        if channel is None and not index:
+            return data[name]
+        return data[name][self.mask(channel, **index)]
+
+    def timestamps(self, channel: str | None = None, **index: int) -> np.ndarray:
+        return self.column("timestamp", channel, **index)
+
+    def intervals(self, channel: str | None = None, **index: int) -> np.ndarray:
+        """Time between consecutive selected frames."""
+        return np.diff(self.timestamps(channel, **index))
+
+    def jitter(self, channel: str | None = None, **index: int) -> np.ndarray:
+        """Deviation of the intervals between selected frames from the planned ones."""
+        planned = np.diff(self.column("min_start_time", channel, **index))
+        return self.intervals(channel, **index) - planned
+
+    def save(self, path: str | Path) -> None:
+        """Save the table and the interned names to a `.npz` file."""
+        np.savez(path, frames=self.data, channel_names=np.array(self.channel_names),
+                 group_names=np.array(self.group_names))
+
+    def _intern(self, kind: str, name: str | None) -> int:
+        key = (kind, name or "")
+        if key not in self._ids:
+            names = self.channel_names if kind == "channel" else self.group_names
+            self._ids[key] = len(names)
+            names.append(name or "")
+        return self._ids[key]
+
+
+def _or_nan(value: float | None) -> float:
+    return np.nan if value is None else value
 
 
 class MetaDataWriter(): 
-    def __init__(self, mmc: CMMCorePlus, tiff_save_path: str | Path) -> None:
+    """Save the metadata of each frame next to the OME-TIFF files.
+
+    Records are streamed to `<name>_meta.jsonl` while the sequence runs and
+    consolidated into `<name>_meta.json` ({position: [records]}) when it finishes.
+    The same information is kept in `table` for fast timing analysis and saved to
+    `<name>_meta.npz`.
+    """
+    def __init__(self, mmc: CMMCorePlus, tiff_save_path: str | Path,
+                 frame_source: FrameHub | None = None) -> None:
         self.mmc = mmc
-        self.frame_metadata = defaultdict(list)
         self._timestamps: list[float] = [] 
         self.tiff_save_path = Path(tiff_save_path)
         
 
         save_name= str(self.tiff_save_path.parts[-1]).split(".")[0] + "_meta.json"
         self.save_path = self.tiff_save_path / save_name
+        self.sink = FrameMetadataSink(self.save_path.with_suffix(".jsonl"))
+        self.table = FrameMetadataTable()
 
-        self.mmc.mda.events.frameReady.connect(self.frameReady)
+        self.frame_source = frame_source or self.mmc.mda.events.frameReady
+        self.frame_source.connect(self.frameReady)
         self.mmc.mda.events.sequenceFinished.connect(self.sequenceFinished)
 
     def frameReady(
         self, frame: np.ndarray, event: MDAEvent
     ) -> None:
         """."""
+        timestamp = perf_counter()
+        self.table.append(timestamp, event)
         our_index = {}
         for dim in event.index.keys():
             our_index[dim] = event.index[dim]
-        our_event = {"timestamp": perf_counter(), "min_start_time": event.min_start_time,
+        our_event = {"timestamp": timestamp, "min_start_time": event.min_start_time,
                       "index": our_index, "channel": event.channel.config, 
                       "exposure": event.exposure, "group": event.channel.group,
                       "x_pos": event.x_pos, "y_pos": event.y_pos}
@@ -37,8 +155,7 @@ class MetaDataWriter():
         p_index = event.index.get("p", 0)
         key = f"p{p_index}"
 
-        t = event.index.get("t", 0)
-        self.frame_metadata[key].append(our_event or {})
+        self.sink.append(key, our_event)
 
 
     def sequenceFinished(self):
@@ -46,8 +163,9 @@ class MetaDataWriter():
         #     for i, frame in enumerate(self.frame_metadata[position]):
         #         self.frame_metadata[position][i]['mda_event'] = json.loads(self.frame_metadata[position][i]['mda_event'].model_dump_json())
 
-        with open(self.save_path, "w") as file:
-            json.dump(dict(self.frame_metadata), file, indent=2)
+        self.sink.close()
+        self.sink.consolidate(self.save_path)
+        self.table.save(self.save_path.with_suffix(".npz"))
 
-        self.mmc.mda.events.frameReady.disconnect(self.frameReady)
+        self.frame_source.disconnect(self.frameReady)
         self.mmc.mda.events.sequenceFinished.disconnect(self.sequenceFinished)
@@ -0,0 +1,191 @@
+"""Keep the last seconds of live mode in RAM and record them on demand."""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+
+class PreTriggerBuffer:
+    """Rolling buffer of the live frames of the last `seconds`, at most `max_bytes`.
+
+    The `LiveEngine` `append`s every frame it pops from the camera, whether it is
+    displayed or not.  Frames older than `seconds`, or the oldest frames when the
+    buffer is over `max_bytes`, are dropped.  Frames are kept by reference, the core
+    hands out a new array for every image.  Views of a larger array are copied, the
+    budget would not account for the rest of it.
+
+    `record` starts a `PreTriggerRecording` with the frames in the buffer and the
+    frames that arrive during the next `post_seconds`.
+    """
+
+    def __init__(self, seconds: float = 5.0, max_bytes: int = 1024**3) -> None:
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._frames: deque[tuple[float, np.ndarray]] = deque()
+        self._lock = threading.Lock()
+        self._recordings: list[PreTriggerRecording] = []
+
+    def append(self, frame: np.ndarray, timestamp: float | None = None) -> None:
+        timestamp = time.perf_counter() if timestamp is None else timestamp
+        if isinstance(frame.base, np.ndarray) and frame.base.nbytes > frame.nbytes:
+            frame = frame.copy()
+        with self._lock:
+            self._frames.append((timestamp, frame))
+            self.nbytes += frame.nbytes
+            while self._frames and (
+                self.nbytes > self.max_bytes
+                or self._frames[0][0] < timestamp - self.seconds
+            ):
+                self.nbytes -= self._frames.popleft()[1].nbytes
+            recordings = list(self._recordings)
+        for recording in recordings:
+            recording.add(timestamp, frame)
+
+    def snapshot(self) -> list[tuple[float, np.ndarray]]:
+        """(timestamp, frame) of the frames in the buffer, oldest first."""
+        with self._lock:
+            return list(self._frames)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._frames.clear()
+            self.nbytes = 0
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def duration(self) -> float:
+        """Seconds between the oldest and the newest frame in the buffer."""
+        with self._lock:
+            if not self._frames:
+                return 0.0
+            return self._frames[-1][0] - self._frames[0][0]
+
+    def record(
+        self, path: Path | str, post_seconds: float = 5.0,
+        parent: QtCore.QObject | None = None,
+    ) -> PreTriggerRecording:
+        """Start recording the buffer and the next `post_seconds` to `path`.
+
+        The format follows the suffix of `path`, OME-TIFF for `.tif`/`.tiff`,
+        OME-Zarr otherwise.
+        """
+        recording = PreTriggerRecording(self, path, post_seconds, parent=parent)
+        with self._lock:
+            recording.pre = list(self._frames)
+            self._recordings.append(recording)
+        recording.start()
+        return recording
+
+    def _remove(self, recording: PreTriggerRecording) -> None:
+        with self._lock:
+            if recording in self._recordings:
+                self._recordings.remove(recording)
+
+
+class PreTriggerRecording(QtCore.QThread):
+    """Write the frames of a `PreTriggerBuffer` from before and after a trigger.
+
+    Runs in its own thread: it collects the frames that arrive until `post_seconds`
+    after the trigger, at most `buffer.max_bytes` of them, and then writes all frames
+    to one OME-TIFF or OME-Zarr with a time axis.  The time of each frame relative
+    to the trigger (negative before) is stored in the metadata.  Frames that don't
+    have the shape of the first frame, e.g. after the ROI was changed, are skipped.
+    `saved(path)` is emitted when the file is complete, `failed(message)` if not.
+    """
+
+    saved = Signal(str)
+    failed = Signal(str)
+
+    def __init__(
+        self, buffer: PreTriggerBuffer, path: Path | str, post_seconds: float,
+        parent: QtCore.QObject | None = None,
+    ) -> None:
+        super().__init__(parent)
+        self.buffer = buffer
+        self.path = Path(path)
+        self.post_seconds = post_seconds
+        self.trigger = time.perf_counter()
+        self.pre: list[tuple[float, np.ndarray]] = []
+        self.post: list[tuple[float, np.ndarray]] = []
+        self.skipped = 0
+        self._queue: queue.Queue[tuple[float, np.ndarray]] = queue.Queue()
+
+    def add(self, timestamp: float, frame: np.ndarray) -> None:
+        """Called by the buffer for every new frame while recording."""
+        self._queue.put((timestamp, frame))
+
+    def run(self) -> None:
+        deadline = self.trigger + self.post_seconds
+        nbytes = 0
+        while (remaining := deadline - time.perf_counter()) > 0:
+            try:
+                timestamp, frame = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if timestamp > deadline:
+                break
+            if nbytes + frame.nbytes > self.buffer.max_bytes:
+                self.skipped += 1
+                continue
+            self.post.append((timestamp, frame))
+            nbytes += frame.nbytes
+        self.buffer._remove(self)
+
+        frames = self.pre + self.post
+        if not frames:
+            self.failed.emit("No live frames to record")
+            return
+        shape, dtype = frames[0][1].shape, frames[0][1].dtype
+        kept = [(t, f) for t, f in frames if f.shape == shape and f.dtype == dtype]
+        self.skipped += len(frames) - len(kept)
+        times = [round(t - self.trigger, 6) for t, _ in kept]
+        try:
+            if self.path.suffix.lower() in (".tif", ".tiff"):
+                self._write_tiff([f for _, f in kept], times)
+            else:
+                self._write_zarr([f for _, f in kept], times)
+        except Exception as e:
+            import traceback
+            print(traceback.format_exc())
+            self.failed.emit(f"Recording to {self.path} failed: {e}")
+            return
+        finally:
+            self.pre, self.post = [], []
+        print(f"Recorded {len(kept)} frames ({self.skipped} skipped) to {self.path}")
+        self.saved.emit(str(self.path))
+
+    def _write_tiff(self, frames: list[np.ndarray], times: list[float]) -> None:
+        from tifffile import imwrite
+
+        # the time of every plane relative to the trigger
+        metadata = {
+            "axes": "TYX",
+            "Plane": {"DeltaT": times, "DeltaTUnit": ["s"] * len(times)},
+        }
+        imwrite(
+            self.path, iter(frames), shape=(len(frames), *frames[0].shape),
+            dtype=frames[0].dtype, bigtiff=True, ome=True, metadata=metadata,
+        )
+
+    def _write_zarr(self, frames: list[np.ndarray], times: list[float]) -> None:
+        from zeiss_control.output._util.zarr_saver import OMEZarrWriter
+
+        writer = OMEZarrWriter(str(self.path), overwrite=True)
+        height, width = frames[0].shape[-2:]
+        ary = writer.new_array(
+            "p0", frames[0].dtype, {"t": len(frames), "y": height, "x": width}
+        )
+        for t, frame in enumerate(frames):
+            ary[t] = frame
+        ary.attrs["frame_times"] = times
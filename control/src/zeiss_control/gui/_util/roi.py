@@ -0,0 +1,112 @@
+"""Regions of interest in camera pixels, rasterised to masks only when needed."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Sequence
+
+import numpy as np
+
+
+@dataclass(frozen=True)
+class RectROI:
+    """Axis aligned rectangle of camera pixels, rows [top, bottom), columns [left, right).
+
+    Coordinates are indices into the frames as they come from the camera, so the
+    rotation and mirroring of the preview don't apply anymore.
+    """
+
+    top: int
+    left: int
+    bottom: int
+    right: int
+
+    @classmethod
+    def from_points(
+        cls, points: Sequence[Sequence[float]], shape: tuple[int, int] | None = None
+    ) -> RectROI:
+        """Bounding rectangle of (row, column) `points`, clipped to a frame `shape`."""
+        # to the nearest pixel edge, halves always up so the size doesn't depend on
+        # the position
+        rows, cols = np.floor(np.asarray(points, dtype=float)[:, :2] + 0.5).T.astype(int)
+        top, bottom = int(rows.min()), int(rows.max())
+        left, right = int(cols.min()), int(cols.max())
+        if shape is not None:
+            top, bottom = (min(max(0, v), shape[0]) for v in (top, bottom))
+            left, right = (min(max(0, v), shape[1]) for v in (left, right))
+        return cls(top, left, bottom, right)
+
+    @property
+    def height(self) -> int:
+        return max(0, self.bottom - self.top)
+
+    @property
+    def width(self) -> int:
+        return max(0, self.right - self.left)
+
+    @property
+    def slices(self) -> tuple[slice, slice]:
+        """Index a frame with `frame[roi.slices]` to get the pixels in the ROI."""
+        return slice(self.top, self.bottom), slice(self.left, self.right)
+
+    @property
+    def bounds(self) -> RectROI:
+        return self
+
+    def __bool__(self) -> bool:
+        return self.height > 0 and self.width > 0
+
+    def mask(self, shape: tuple[int, int], packed: bool = False) -> np.ndarray:
+        """Boolean mask of the ROI in a frame of `shape`, `np.packbits` along x if
+        `packed`."""
+        mask = np.zeros(shape, dtype=bool)
+        mask[self.slices] = True
+        return np.packbits(mask, axis=-1) if packed else mask
+
+
+@dataclass(frozen=True)
+class PolygonROI:
+    """Polygon with (row, column) `vertices` in camera pixels.
+
+    A pixel is inside if its center is, by the even-odd rule.
+    """
+
+    vertices: tuple[tuple[float, float], ...]
+
+    @classmethod
+    def from_points(cls, points: Sequence[Sequence[float]]) -> PolygonROI:
+        return cls(tuple((float(p[0]), float(p[1])) for p in points))
+
+    @property
+    def bounds(self) -> RectROI:
+        """The rectangle of pixels that can be inside of the polygon."""
+        rows, cols = np.asarray(self.vertices).T
+        return RectROI(
+            int(np.floor(rows.min())), int(np.floor(cols.min())),
+            int(np.ceil(rows.max())), int(np.ceil(cols.max())),
+        )
+
+    def __bool__(self) -> bool:
+        return len(self.vertices) >= 3 and bool(self.bounds)
+
+    def mask(self, shape: tuple[int, int], packed: bool = False) -> np.ndarray:
+        """Boolean mask of the ROI in a frame of `shape`, `np.packbits` along x if
+        `packed`.  Only the pixels in the bounding rectangle are tested."""
+        mask = np.zeros(shape, dtype=bool)
+        box = RectROI.from_points(
+            [(self.bounds.top, self.bounds.left), (self.bounds.bottom, self.bounds.right)],
+            shape,
+        )
+        if box and len(self.vertices) >= 3:
+            rows = np.arange(box.top, box.bottom)[:, None] + 0.5
+            cols = np.arange(box.left, box.right)[None, :] + 0.5
+            inside = np.zeros((box.height, box.width), dtype=bool)
+            vertices = np.asarray(self.vertices)
+            for (r0, c0), (r1, c1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+                if r0 == r1:
+                    continue
+                crosses = (r0 > rows) != (r1 > rows)
+                col_at = c0 + (rows - r0) * (c1 - c0) / (r1 - r0)
+                inside ^= crosses & (cols < col_at)
+            mask[box.slices] = inside
+        return np.packbits(mask, axis=-1) if packed else mask
@@ -103,7 +103,7 @@ if frame.eda_window:
 
 
 from zeiss_control.gui.output import OutputGUI
-output = OutputGUI(mmc, frame.mda_window, event_bus)
+output = OutputGUI(mmc, frame.mda_window, event_bus, camera_crop=preview.camera_crop)
 
 frame.mda_window.send_new_settings()
 if frame.eda_window:
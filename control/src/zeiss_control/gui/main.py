@@ -114,7 +114,7 @@ if __name__ == "__main__":
     frame.show()
 
     from zeiss_control.gui.output import OutputGUI
-    output = OutputGUI(mmc, frame.mda_window)
+    output = OutputGUI(mmc, frame.mda_window, camera_crop=preview.camera_crop)
     app.exec_()
 
     try:
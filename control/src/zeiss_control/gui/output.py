@@ -4,19 +4,33 @@ from zeiss_control.output.stack_viewer import StackViewer
 from zeiss_control.output._stack_viewer import QOMEZarrDatastore
 from zeiss_control.output._stack_viewer import StackViewer as ZarrStackViewer
 from zeiss_control.output.tiff_saver import CoreOMETiffWriter
+from zeiss_control.output._util._write_queue import FlushPolicy
+from zeiss_control.output._util._compression import CompressionPipeline
 from zeiss_control.backend.meta import MetaDataWriter
+from zeiss_control.backend.frame_hub import FrameHub
+from zeiss_control.backend.camera_crop import CameraCrop
+from zeiss_control.output._util._storage import MemmapArray
+from zeiss_control.output._util._process_writer import ProcessWriter
 import time
+from pathlib import Path
 from useq import MDASequence, Channel, MDAEvent
 # from zeiss_control.output.zarr_saver import CoreOMEZarrWriter
-from qtpy.QtCore import QObject, Signal
+from qtpy.QtCore import QCoreApplication, QObject, Signal
 import numpy as np
 from eda_plugin.utility.core_event_bus import CoreEventBus
 
 class OutputGUI(QObject):
     net_frameReady = Signal(np.ndarray, MDAEvent)
-    def __init__(self, mmcore: CMMCorePlus, mda_gui=None, eda_event_bus:CoreEventBus=None):
+    def __init__(self, mmcore: CMMCorePlus, mda_gui=None, eda_event_bus:CoreEventBus=None,
+                 camera_crop: CameraCrop | None = None):
         super().__init__()
         self.mmc = mmcore
+        # camera ROI set in the Preview, frames are cropped in the hub if needed
+        self.camera_crop = camera_crop
+        # single frameReady listener that hands the frames to writers and datastores
+        self.hub = FrameHub(self.mmc, crop=camera_crop)
+        self.hub.consumer_lagging.connect(self._consumer_lagging)
+        self.hub.consumer_slow.connect(self._consumer_slow)
         self.mmc.mda.events.sequenceStarted.connect(self.make_viewer)
         self.mmc.mda.events.sequenceFinished.connect(self.sequence_finished)
         self.mda_gui = mda_gui
@@ -27,6 +41,18 @@ class OutputGUI(QObject):
         self.eda_event_bus = eda_event_bus
         self.ready = False
         self.writer = None
+        # memory for the local datastore in EDA runs, which have no fixed end
+        self.max_local_bytes = 8 * 1024**3
+        # "memmap" keeps the local datastore in OME-TIFFs on disk, which become the
+        # saved files at the end of the sequence instead of writing a second copy
+        self.local_backend = "memory"
+        # "process" runs the OME-TIFF writer in a child process, so that compression
+        # and file IO don't compete for the GIL with the viewer
+        self.writer_backend = "thread"
+        # started for the first sequence that needs it, stopped by `close`
+        self.process_writer: ProcessWriter | None = None
+        if (app := QCoreApplication.instance()) is not None:
+            app.aboutToQuit.connect(self.close)
 
     def new_save_settings(self, save: bool, path: str):
         self.path = path
@@ -34,32 +60,72 @@ class OutputGUI(QObject):
         print("New settings", save, path)
 
     def make_viewer(self, sequence:MDASequence):
+        open_ended = sequence.metadata.get("EDA", False)
         shape, sequence = self.adjust_sequence(sequence)
         self.n_channels = sequence.sizes.get('c', 1)
         if self.path[-4:] == "zarr":
             if self.save:
                 path = self.path
+                compression = CompressionPipeline()
             else:
                 path = None
+                compression = None
 
-            self.datastore = QOMEZarrDatastore(path)
+            # low resolution levels to quickly browse large grids
+            pyramid_levels = 3 if self.save and sequence.sizes.get('g', 1) > 1 else 0
+            self.datastore = QOMEZarrDatastore(path, compression=compression,
+                                               pyramid_levels=pyramid_levels,
+                                               stream_frame_metadata=self.save)
             self.datastore._mm_config = self.mmc.getSystemState().dict()
-            self.mmc.mda.events.frameReady.connect(self.datastore.frameReady)
+            self.hub.connect(self.datastore.frameReady, "QOMEZarrDatastore")
             self.net_frameReady.connect(self.datastore.frameReady)
             self.mmc.mda.events.sequenceStarted.connect(self.datastore.sequenceStarted)
             self.eda_event_bus.new_network_image.connect(self.net_frame_ready)
             self.viewer = ZarrStackViewer(datastore=self.datastore, mmcore=self.mmc,
-                                    sequence=sequence, transform=(90, False, True))
+                                    sequence=sequence, transform=(90, False, True),
+                                    size=tuple(shape[-2:]),
+                                    crop_offset=self._crop_offset())
             self.datastore.sequenceStarted(sequence)
         else:
+            memmap = self.local_backend == "memmap" and not open_ended
+            scratch_dir = Path(self.path) / ".scratch" if memmap and self.save else None
             self.datastore = QLocalDataStore(shape, mmcore=self.mmc,
-                                              eda_event_bus=self.eda_event_bus)
-            if self.save:
-                self.writer = CoreOMETiffWriter(self.path, self.mmc, self.eda_event_bus)
-                self.metadatawriter = MetaDataWriter(self.mmc, self.path)
+                                              eda_event_bus=self.eda_event_bus,
+                                              frame_source=self.hub,
+                                              max_bytes=self.max_local_bytes if open_ended else None,
+                                              backend="memmap" if memmap else "memory",
+                                              scratch_dir=scratch_dir,
+                                              metadata={"Channel": {"Name": [c.config for c in sequence.channels]}})
+            if self.save and memmap:
+                self.metadatawriter = MetaDataWriter(self.mmc, self.path,
+                                                     frame_source=self.hub)
+            elif self.save and self.writer_backend == "process":
+                # the child process is the writer thread already, it writes directly
+                writer_kwargs = {"folder": self.path, "background": False}
+                if self.process_writer is None:
+                    self.process_writer = ProcessWriter(writer_cls=CoreOMETiffWriter,
+                                                        writer_kwargs=writer_kwargs)
+                else:
+                    self.process_writer.configure(**writer_kwargs)
+                self.writer = self.process_writer
+                self.hub.connect(self.writer.frameReady, "ProcessWriter")
+                self.net_frameReady.connect(self.writer.frameReady)
+                if self.eda_event_bus is not None:
+                    self.eda_event_bus.new_network_image.connect(self.net_frame_ready)
+                self.metadatawriter = MetaDataWriter(self.mmc, self.path,
+                                                     frame_source=self.hub)
+                self.writer.sequenceStarted(sequence)
+            elif self.save:
+                self.writer = CoreOMETiffWriter(self.path, self.mmc, self.eda_event_bus,
+                                                background=True,
+                                                flush_policy=FlushPolicy(every_seconds=5),
+                                                frame_source=self.hub)
+                self.metadatawriter = MetaDataWriter(self.mmc, self.path,
+                                                     frame_source=self.hub)
                 self.writer.sequenceStarted(sequence)
             self.viewer = StackViewer(datastore=self.datastore, mmcore=self.mmc,
-                                    sequence=sequence)
+                                    sequence=sequence, size=tuple(shape[-2:]),
+                                    crop_offset=self._crop_offset())
         self.ready = True
         self.viewer.show()
 
@@ -70,23 +136,59 @@ class OutputGUI(QObject):
             self.net_frameReady.emit(img, event)
 
     def sequence_finished(self, sequence: MDASequence):
-        if self.writer:
-            time.sleep(1)
+        if isinstance(self.datastore, QLocalDataStore) and self.save and \
+                isinstance(self.datastore.array, MemmapArray):
+            # frames may still be queued for the datastore, promote once it stored them
+            self.datastore.drained.connect(self._saved)
+            self.datastore.finish(promote_to=self.path)
+        if isinstance(self.writer, ProcessWriter):
+            # the writer has no MDA connections, finish and stop it here
+            self.hub.disconnect(self.writer.frameReady)
+            self.net_frameReady.disconnect(self.writer.frameReady)
+            if self.eda_event_bus is not None:
+                self.eda_event_bus.new_network_image.disconnect(self.net_frame_ready)
+            self.writer.sequenceFinished(sequence)
+            # the process is kept for the next sequence
             self.writer = None
-        elif self.datastore:
+        elif self.writer:
+            # write the queued frames now, this slot runs before the writer's own
+            self.writer.sequenceFinished(sequence)
+            self.writer = None
+        elif isinstance(self.datastore, QOMEZarrDatastore):
             time.sleep(1)
             self.datastore.sequenceFinished(sequence)
             self.disconnect_datastore()
             self.datastore = None
         self.ready = False
 
+    def close(self):
+        """Stop the writer process, if one was started."""
+        if self.process_writer is not None:
+            self.process_writer.close()
+            self.process_writer = None
+
     def disconnect_datastore(self):
         if isinstance(self.datastore, QOMEZarrDatastore):
-            self.mmc.mda.events.frameReady.disconnect(self.datastore.frameReady)
+            self.hub.disconnect(self.datastore.frameReady)
             self.net_frameReady.disconnect(self.datastore.frameReady)
             self.mmc.mda.events.sequenceStarted.disconnect(self.datastore.sequenceStarted)
             self.eda_event_bus.new_network_image.disconnect(self.net_frame_ready)
 
+    def _saved(self, paths: list):
+        print("Saved", paths)
+
+    def _consumer_lagging(self, name: str, leases: int):
+        print(f"\033[1mFrame consumer {name} is lagging, holding {leases} frame(s)\033[0m")
+
+    def _consumer_slow(self, name: str, ms: float):
+        print(f"\033[1mFrame consumer {name} took {ms:.0f} ms\033[0m")
+
+    def _crop_offset(self) -> tuple[float, float]:
+        # the stage positions are those of the sensor center, not of the crop
+        if self.camera_crop is None:
+            return (0, 0)
+        return self.camera_crop.center_offset
+
     def adjust_sequence(self, sequence: MDASequence):
         if sequence.metadata.get("EDA", False):
             channels = list(sequence.channels) + [Channel(config="Network")]
@@ -99,10 +201,14 @@ class OutputGUI(QObject):
                 autofocus_plan=sequence.autofocus_plan,
             )
         sizes = sequence.sizes
+        if self.camera_crop is not None:
+            height, width = self.camera_crop.shape()
+        else:
+            height, width = self.mmc.getImageHeight(), self.mmc.getImageWidth()
         shape = [sizes.get('t', 1),
                     sizes.get('z', 1),
                     sizes.get('c', 1),
                     sizes.get('g', 1),
-                    self.mmc.getImageHeight(),
-                    self.mmc.getImageWidth()]
+                    height,
+                    width]
         return shape, sequence
\ No newline at end of file
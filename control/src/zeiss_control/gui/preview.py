@@ -1,7 +1,8 @@
 from __future__ import annotations
 from pymmcore_plus import CMMCorePlus
 from qtpy.QtWidgets import (QWidget, QGridLayout, QPushButton, QFileDialog, QMainWindow,
-                            QVBoxLayout, QHBoxLayout, QCheckBox)
+                            QVBoxLayout, QHBoxLayout, QCheckBox, QLabel, QComboBox,
+                            QDoubleSpinBox)
 from qtpy import QtCore
 from superqt import fonticon, QRangeSlider
 from fonticon_mdi6 import MDI6
@@ -10,20 +11,42 @@ from pathlib import Path
 import numpy as np
 from vispy import scene, visuals, color
 import json
+import time
 
 # from pymmcore_widgets._mda._util._hist import HistPlot
+from zeiss_control.backend.camera_crop import CameraCrop
+from zeiss_control.backend.live_engine import LiveEngine, LiveStats
+from zeiss_control.backend.pretrigger import PreTriggerBuffer, PreTriggerRecording
 from zeiss_control.gui._util.qt_classes import QWidgetRestore
-
-_DEFAULT_WAIT = 20
+from zeiss_control.gui._util.roi import PolygonROI, RectROI
+from zeiss_control.output._util._autocontrast import AutoContrast
+from zeiss_control.output._util._downsample import DisplayDownsampler
+from zeiss_control.output._util._render_scheduler import RenderScheduler
 
 class Preview(QWidgetRestore):
+    """Live view with a rectangle ROI.
+
+    `new_roi(RectROI)` is emitted for every change of the ROI, in camera pixels.
+    `new_mask(np.ndarray)` is emitted with the ROI rasterised to a boolean mask of
+    the frame (bit-packed along x if `pack_masks`), at most `mask_fps` times per
+    second, and always for the last ROI.
+
+    "Crop to ROI" reduces the camera to the ROI with `camera_crop`, which the
+    `OutputGUI` also uses for the MDA frames, "Full frame" goes back to the sensor.
+    """
+
+    new_roi = QtCore.Signal(object)
     new_mask = QtCore.Signal(np.ndarray)
 
     def __init__(self, parent: QWidget | None = None, mmcore: CMMCorePlus | None = None,
-                 key_listener: QObject | None = None):
+                 key_listener: QObject | None = None, mask_fps: float = 10,
+                 pack_masks: bool = False):
         super().__init__(parent=parent)
         self._mmc = mmcore
         self.current_frame = None
+        self.roi: RectROI | PolygonROI | None = None
+        self.pack_masks = pack_masks
+        self.mask_scheduler = RenderScheduler(self._emit_mask, max_fps=mask_fps, parent=self)
         settings = self.load_settings()
         self.save_loc = settings.get("path", Path.home())
         # self.rot = settings.get("rot", 90)
@@ -38,27 +61,106 @@ class Preview(QWidgetRestore):
         self._mmc.events.imageSnapped.connect(self.preview._on_image_snapped)
         self._mmc.events.imageSnapped.connect(self.new_frame)
 
+        # Camera ROI from the rectangle, cropped in software if the camera can't
+        self.camera_crop = CameraCrop(self._mmc)
+        self.camera_crop.crop_changed.connect(self._on_crop_changed)
+        self.preview.crop = self.camera_crop
+        self.preview.live_engine.crop = self.camera_crop
+
+        # The last seconds of live mode, recorded together with the next seconds
+        self.pretrigger = PreTriggerBuffer(seconds=settings.get("pre_seconds", 5.0))
+        self.preview.live_engine.pretrigger = self.pretrigger
+        self.recordings: list[PreTriggerRecording] = []
+
         self.setWindowTitle("Preview")
         self.setLayout(QGridLayout())
 
-        self.layout().addWidget(self.preview, 0, 0, 1, 5)
+        self.layout().addWidget(self.preview, 0, 0, 1, 6)
 
         self.save_btn = QPushButton("Save")
         self.save_btn.clicked.connect(self.save_image)
 
+        self.record_btn = QPushButton("Record")
+        self.record_btn.setIcon(fonticon.icon(MDI6.record_rec))
+        self.record_btn.setToolTip("Save the last seconds of live mode and the next seconds")
+        self.record_btn.clicked.connect(self.record_live)
+
+        self.pre_spin = QDoubleSpinBox()
+        self.pre_spin.setRange(0, 600)
+        self.pre_spin.setSuffix(" s before")
+        self.pre_spin.setValue(self.pretrigger.seconds)
+        self.pre_spin.valueChanged.connect(self._on_pre_seconds_changed)
+
+        self.post_spin = QDoubleSpinBox()
+        self.post_spin.setRange(0, 600)
+        self.post_spin.setSuffix(" s after")
+        self.post_spin.setValue(settings.get("post_seconds", 5.0))
+
+        self.record_format = QComboBox()
+        self.record_format.addItems(["OME-Zarr", "OME-TIFF"])
+        self.record_format.setCurrentText(settings.get("record_format", "OME-Zarr"))
+
+        self.crop_btn = QPushButton("Crop to ROI")
+        self.crop_btn.setIcon(fonticon.icon(MDI6.crop))
+        self.crop_btn.setToolTip("Only read out the pixels in the rectangle")
+        self.crop_btn.clicked.connect(self.crop_to_roi)
+
+        self.full_frame_btn = QPushButton("Full frame")
+        self.full_frame_btn.setIcon(fonticon.icon(MDI6.crop_free))
+        self.full_frame_btn.clicked.connect(self.full_frame)
+
         self.collapse_btn = QPushButton()
         self.collapse_btn.setIcon(fonticon.icon(MDI6.arrow_collapse_all))
         self.collapse_btn.clicked.connect(self.collapse_view)
 
         self.layout().addWidget(self.save_btn, 1, 0)
-        self.layout().addWidget(self.collapse_btn, 1, 4)
+        self.layout().addWidget(self.record_btn, 1, 1)
+        self.layout().addWidget(self.pre_spin, 1, 2)
+        self.layout().addWidget(self.post_spin, 1, 3)
+        self.layout().addWidget(self.record_format, 1, 4)
+        self.layout().addWidget(self.collapse_btn, 1, 5)
+        self.layout().addWidget(self.crop_btn, 2, 0)
+        self.layout().addWidget(self.full_frame_btn, 2, 1)
 
         if key_listener:
             self.key_listener = key_listener
             self.installEventFilter(self.key_listener)
 
     def new_frame(self, image):
-        self.current_frame = image
+        self.current_frame = self.camera_crop.crop(image, copy=True)
+
+    def set_roi(self, roi: RectROI | PolygonROI) -> None:
+        if roi == self.roi:
+            return
+        self.roi = roi
+        self.new_roi.emit(roi)
+        self.mask_scheduler.submit("mask", roi)
+
+    def crop_to_roi(self) -> None:
+        if not isinstance(self.roi, RectROI):
+            print("Draw a rectangle to crop to")
+            return
+        try:
+            self.camera_crop.apply(self.roi)
+        except RuntimeError as e:
+            print("\033[1mERROR\033[0m", e)
+
+    def full_frame(self) -> None:
+        try:
+            self.camera_crop.clear()
+        except RuntimeError as e:
+            print("\033[1mERROR\033[0m", e)
+
+    def _on_crop_changed(self, origin: tuple[int, int], shape: tuple[int, int]) -> None:
+        """The rectangle was in the pixels of the previous frames, remove it."""
+        print("Camera cropped to", shape, "at", origin,
+              "in software" if self.camera_crop.software else "")
+        self.preview.clear_objects()
+        self.roi = None
+
+    def _emit_mask(self, roi: RectROI | PolygonROI) -> None:
+        if self.preview.frame_shape is not None:
+            self.new_mask.emit(roi.mask(self.preview.frame_shape, packed=self.pack_masks))
 
     def save_image(self):
         if self.current_frame is not None:
@@ -70,6 +172,33 @@ class Preview(QWidgetRestore):
                 import traceback
                 print(traceback.format_exc())
 
+    def record_live(self):
+        """Write the pre-trigger buffer and the next seconds next to the saved images."""
+        suffix = ".ome.zarr" if self.record_format.currentText() == "OME-Zarr" else ".ome.tif"
+        path = Path(self.save_loc).parent / f"live_{time.strftime('%Y%m%d_%H%M%S')}{suffix}"
+        recording = self.pretrigger.record(path, self.post_spin.value(), parent=self)
+        recording.saved.connect(self._on_recording_saved)
+        recording.failed.connect(self._on_recording_failed)
+        recording.finished.connect(lambda: self._on_recording_finished(recording))
+        self.recordings.append(recording)
+        self.record_btn.setText(f"Recording ({len(self.recordings)})")
+
+    def _on_pre_seconds_changed(self, value: float):
+        self.pretrigger.seconds = value
+
+    def _on_recording_saved(self, path: str):
+        self.record_btn.setToolTip(f"Saved {path}")
+
+    def _on_recording_failed(self, message: str):
+        print("\033[1mERROR\033[0m", message)
+        self.record_btn.setToolTip(message)
+
+    def _on_recording_finished(self, recording: PreTriggerRecording):
+        if recording in self.recordings:
+            self.recordings.remove(recording)
+        self.record_btn.setText(f"Recording ({len(self.recordings)})"
+                                if self.recordings else "Record")
+
     def collapse_view(self):
         self.preview.view.camera.set_range(margin=0)
 
@@ -77,8 +206,13 @@ class Preview(QWidgetRestore):
         settings = {"path": str(self.save_loc),
                     "rot": self.rot,
                     "mirror_x": self.mirror_x,
-                    "mirror_y": self.mirror_y}
+                    "mirror_y": self.mirror_y,
+                    "pre_seconds": self.pre_spin.value(),
+                    "post_seconds": self.post_spin.value(),
+                    "record_format": self.record_format.currentText()}
         self.save_settings(settings)
+        for recording in self.recordings:
+            recording.wait()
         super().closeEvent(event)
 
     def save_settings(self, my_settings):
@@ -122,6 +256,8 @@ class Canvas(QWidget):
         self._imcls = scene.visuals.Image
         self._clim_mode: dict = {}
         self._clims: dict = {}
+        # Running histogram per channel, follows the live image within a few frames
+        self.autocontrast = AutoContrast(decay=0.5)
         self._cmap: str = "grays"
         self.last_channel = None
         self.current_channel = self._mmc.getConfigGroupState("Channel")
@@ -132,8 +268,16 @@ class Canvas(QWidget):
         self.view = self._canvas.central_widget.add_view(camera="panzoom")
         self.view.camera.aspect = 1
         self.view.camera.flip = (mirror_x, mirror_y, False)
+        # Live frames are uploaded at screen resolution, full resolution when zoomed in
+        self.downsampler = DisplayDownsampler(self.view, self._canvas)
 
         self.image: scene.visuals.Image | None = None
+        # (width, height) of the full resolution frames, the image may show fewer
+        self.image_size: tuple[int, int] | None = None
+        # software crop of the camera, applied to snapped images
+        self.crop: CameraCrop | None = None
+        # scene to camera pixels (x = column, y = row), independent of the downsampling
+        self.frame_transform: visuals.transforms.linear.MatrixTransform | None = None
         self.setLayout(QVBoxLayout())
         self.layout().setContentsMargins(0, 0, 0, 0)
         self.layout().addWidget(self._canvas.native)
@@ -159,17 +303,18 @@ class Canvas(QWidget):
         self.clim_layout.addWidget(self.auto_clim)
         self.clim_layout.addWidget(self.clim_rectangle_btn)
 
+        self.live_label = QLabel()
+        self.clim_layout.addWidget(self.live_label)
+
         self.layout().addLayout(self.clim_layout)
 
-        #Streaming when live
-        self.streaming_timer = QtCore.QTimer(parent=self)
-        self.streaming_timer.setTimerType(QtCore.Qt.TimerType.PreciseTimer)
-        self.streaming_timer.setInterval(int(self._mmc.getExposure()) or _DEFAULT_WAIT)
-        self.streaming_timer.timeout.connect(self._on_image_snapped)
+        #Streaming when live, the camera buffer is drained in a worker thread
+        self.live_engine = LiveEngine(self._mmc, parent=self)
+        self.live_engine.frame_ready.connect(self._on_live_frame)
+        self.live_engine.stats_changed.connect(self._on_live_stats)
 
         self._mmc.events.continuousSequenceAcquisitionStarted.connect(self._on_streaming_start)
         self._mmc.events.sequenceAcquisitionStopped.connect(self._on_streaming_stop)
-        self._mmc.events.exposureChanged.connect(self._on_exposure_changed)
 
         #Rect interaction
         self.selected_object = None
@@ -183,16 +328,20 @@ class Canvas(QWidget):
         ev = self._mmc.events
         ev.continuousSequenceAcquisitionStarted.disconnect(self._on_streaming_start)
         ev.sequenceAcquisitionStopped.disconnect(self._on_streaming_stop)
-        ev.exposureChanged.disconnect(self._on_exposure_changed)
-
-    def _on_exposure_changed(self, device: str, value: str) -> None:
-        self.streaming_timer.setInterval(max(20, int(value)))
+        self.live_engine.stop()
 
     def _on_streaming_start(self) -> None:
-        self.streaming_timer.start()
+        self.live_engine.start()
 
     def _on_streaming_stop(self) -> None:
-        self.streaming_timer.stop()
+        self.live_engine.stop()
+
+    def _on_live_frame(self) -> None:
+        if (img := self.live_engine.take()) is not None:
+            self._on_image_snapped(img)
+
+    def _on_live_stats(self, stats: LiveStats) -> None:
+        self.live_label.setText(str(stats))
 
     def update_clims(self, value: tuple[int, int]) -> None:
         if not self._clims:
@@ -226,11 +375,18 @@ class Canvas(QWidget):
                 img = self._mmc.getLastImage()
             except (RuntimeError, IndexError):
                 return
-        img_max = img.max()
+        if self.crop is not None:
+            img = self.crop.crop(img)
+        if self.image is not None and img.shape[:2][::-1] != self.image_size:
+            # new camera ROI, the transform depends on the size of the frames
+            self.image.parent = None
+            self.image = None
+        self.autocontrast.update(channel, img)
+        _, img_max = self.autocontrast.range(channel)
         #TODO: We might want to do this per channel
         slider_max = max(img_max, self.clim_slider.maximum())
         if self._clim_mode.get(channel, "auto") == "auto":
-            clim = (img.min(), img_max)
+            clim = self.autocontrast.clim(channel)
             self._clims[channel] = clim
         else:
             clim = self._clims.get(channel, (0, 1))
@@ -248,9 +404,11 @@ class Canvas(QWidget):
                 trans.translate((0, img.shape[1], 0))
             print("image rotated by", self.rot)
             self.image.transform = trans
+            self.frame_transform = visuals.transforms.linear.MatrixTransform(trans.matrix.copy())
             self.view.camera.set_range(self.image.bounds(0), self.image.bounds(1), margin=0)
+            self.downsampler.set_data(self.image, img)
         else:
-            self.image.set_data(img)
+            self.downsampler.set_data(self.image, img)
             self.image.clim = clim
             if self.auto_clim.isChecked():
                 block = self.clim_slider.blockSignals(True)
@@ -263,10 +421,35 @@ class Canvas(QWidget):
 
         #     self.histogram.set_max(slider_max)
 
-        # self.histogram.update_data(img)
+        # self.histogram.update_data(*self.autocontrast.histogram(channel))
+        self.image_size = img.shape[:2][::-1]
         self.last_channel = channel
 
+    @property
+    def frame_shape(self) -> tuple[int, int] | None:
+        """(rows, columns) of the full resolution frames."""
+        return None if self.image_size is None else self.image_size[::-1]
+
+    def roi_from_rect(self, center, width: float, height: float) -> RectROI | None:
+        """The camera pixels covered by a rectangle in scene coordinates.
+
+        Rotation is resolved by the transform of the image.  Mirroring is only done
+        by the camera of the view, it doesn't change the scene coordinates.
+        """
+        if self.frame_transform is None:
+            return None
+        corners = np.array([[center[0] + dx * width / 2, center[1] + dy * height / 2]
+                            for dx in (-1, 1) for dy in (-1, 1)])
+        cols, rows = self.frame_transform.imap(corners)[:, :2].T
+        return RectROI.from_points(np.stack([rows, cols], axis=1), self.frame_shape)
+
     # Things for the rectangle
+    def clear_objects(self):
+        for my_object in self.objects:
+            my_object.parent = None
+        self.objects = []
+        self.selected_object = None
+
     def rect_callback(self, state):
         if state:
             self.view.camera._viewbox.events.mouse_move.disconnect(
@@ -331,7 +514,6 @@ class Canvas(QWidget):
 
                 self.selected_object.move(pos[0:2])
 
-                mask = np.zeros(self.image.size)
                 my_object = self.selected_object
                 if not hasattr(my_object, "_center"):
                     my_object = my_object.control_points
@@ -339,30 +521,10 @@ class Canvas(QWidget):
                         print("This object has a list of control points")
                         my_object = my_object[0]
 
-                pos = [int(x) for x in my_object._center]
-                height = abs(int(my_object._height))
-                width = abs(int(my_object._width))
-                
-                if self.parent().mirror_x:
-                    pos[0] = mask.shape[0] - pos[0]
-                if self.parent().mirror_y:
-                    pos[1] = mask.shape[1] - pos[1]
-                if self.parent().rot == 0:
-                    pos = [pos[0], mask.shape[1] - pos[1]]
-                    width, height = height, width
-                    pos[0], pos[1] = pos[1], pos[0]
-                elif self.parent().rot == 90:
-                    pos = [mask.shape[0] - pos[0], mask.shape[1] - pos[1]]
-                elif self.parent().rot == 180:
-                    pos = [mask.shape[0] - pos[0], pos[1]]
-                    width, height = height, width
-                    pos[0], pos[1] = pos[1], pos[0]
-                # elif self.parent().rot == 270:
-                #     pos = [mask.shape[0] - pos[0], mask.shape[1] - pos[1]]
-                mask[int(np.floor(pos[0]-width/2)): int(np.floor(pos[0]+width/2)),
-                     int(np.floor(pos[1]-height/2)): int(np.floor(pos[1]+height/2))] = np.ones([width, height])
-                self.parent().new_mask.emit(mask)
-                # self._on_image_snapped(np.random.random((512, 512)) + mask, "default")
+                roi = self.roi_from_rect(my_object._center, my_object._width,
+                                         my_object._height)
+                if roi is not None:
+                    self.parent().set_roi(roi)
             else:
                 self.view.camera._viewbox.events.mouse_move.connect(
                     self.view.camera.viewbox_mouse_event)
@@ -43,7 +43,7 @@ frame.show()
 
 
 from zeiss_control.gui.output import OutputGUI
-output = OutputGUI(mmc, frame.mda_window)
+output = OutputGUI(mmc, frame.mda_window, camera_crop=preview.camera_crop)
 
 frame.mda_window.send_new_settings()
 app.exec_()
@@ -4,6 +4,12 @@ from typing import TYPE_CHECKING
 
 from psygnal import Signal
 from zeiss_control.output._util.zarr_saver import POS_PREFIX, OMEZarrWriter
+from zeiss_control.output._util._chunking import ChunkPolicy
+from zeiss_control.output._util._compression import CompressionPipeline
+from zeiss_control.output._util._plane_cache import PlaneCache
+from zeiss_control.output._util._pyramid import block_mean
+from zeiss_control.output._util._projection import RunningProjections
+from zeiss_control.output._util._rwlock import ReadWriteLock
 from useq import MDAEvent
 import yaml
 from pathlib import Path
@@ -17,15 +23,36 @@ if TYPE_CHECKING:
 
 
 class QOMEZarrDatastore(OMEZarrWriter):
+    """OMEZarrWriter that the StackViewer can read from while it is writing.
+
+    `get_frame` can be called from any thread and returns read-only arrays. Frames
+    that are not written to the store yet are returned from the write buffers.
+    Full resolution planes are kept in an LRU `cache` of `cache_bytes`, filled when
+    they are written or read, so scrubbing over recent data doesn't decode chunks.
+    Max, mean and min `projections` along z and t are updated with every frame, in
+    a worker thread, for the axes the sequence has more than one frame along.
+    """
+
     frame_ready = Signal(MDAEvent)
 
-    def __init__(self, store = None) -> None:
+    def __init__(self, store = None, chunk_policy: ChunkPolicy | None = None,
+                 compression: CompressionPipeline | None = None,
+                 pyramid_levels: int = 0, stream_frame_metadata: bool = False,
+                 cache_bytes: int = 512 * 1024**2) -> None:
         self.store = store
-        super().__init__(store=store)
+        self.lock = ReadWriteLock()
+        # {(p, t, z, c, g) -> decoded plane}
+        self.cache = PlaneCache(cache_bytes)
+        self.projections = RunningProjections()
+        super().__init__(store=store, chunk_policy=chunk_policy, compression=compression,
+                         pyramid_levels=pyramid_levels,
+                         stream_frame_metadata=stream_frame_metadata)
 
     def sequenceStarted(self, sequence: useq.MDASequence) -> None:
         self._used_axes = tuple(x for x in sequence.used_axes if x not in ['p'])
         self.start_time = time.perf_counter()
+        self.cache.clear()
+        self.projections.start(sequence.sizes)
         super().sequenceStarted(sequence)
         if self.store:
             if self._mm_config:
@@ -40,13 +67,64 @@ class QOMEZarrDatastore(OMEZarrWriter):
     ) -> None:
         timestamp = time.perf_counter() - self.start_time
         meta = {"DeltaT": timestamp, **(meta or {})}
-        super().frameReady(frame, event, meta or {})
+        # borrowed frames (read-only) are reused by their owner.  One copy is shared by
+        # the cache, the projections and the writer, that only copies read-only frames
+        owned = frame if frame.flags.writeable else frame.copy()
+        with self.lock.write():
+            super().frameReady(owned, event, meta or {})
+            self.cache.put(_cache_key(event), owned)
+        self.projections.add(event.index, owned)
         self.frame_ready.emit(event)
 
-    def get_frame(self, event: MDAEvent) -> np.ndarray:
-        key = f'{POS_PREFIX}{event.index.get("p", 0)}'
-        ary = self.position_arrays[key]
+    def sequenceFinished(self, seq: useq.MDASequence) -> None:
+        super().sequenceFinished(seq)
+        self.projections.shutdown()
 
+    def level_for(self, step: int, position: int = 0) -> int:
+        """Coarsest pyramid level with at most `step` pixels per level pixel."""
+        n_levels = len(self.level_arrays.get(f"{POS_PREFIX}{position}", []))
+        level = 0
+        while level < n_levels and 2 ** (level + 1) <= step:
+            level += 1
+        return level
+
+    def get_frame(self, event: MDAEvent, level: int = 0) -> np.ndarray:
+        """Frame for the event, `level` > 0 reads the downsampled pyramid levels."""
+        if not level and (data := self.cache.get(_cache_key(event))) is not None:
+            return data
+        if level and (data := self.cache.peek(_cache_key(event))) is not None:
+            # recent planes may not be downsampled yet, do it like the pyramid does
+            for _ in range(level):
+                data = block_mean(data, 2)
+            data.flags.writeable = False
+            return data
+        key = f'{POS_PREFIX}{event.index.get("p", 0)}'
         index = tuple(event.index.get(k) for k in self._used_axes)
-        data: np.ndarray = ary[index]
+        with self.lock.read():
+            ary = self.position_arrays[key]
+            if level:
+                ary = self.level_arrays[key][level - 1]
+            data = self.buffered_frame(ary.basename, index)
+        if data is None:
+            data = ary[index]
+            if not level:
+                self.cache.put(_cache_key(event), data)
+        else:
+            data = data.view()
+        data.flags.writeable = False
         return data
+
+    def get_projection(
+        self, axis: str, mode: str, event: MDAEvent
+    ) -> np.ndarray | None:
+        """Projection `mode` along `axis` through the frame of the event."""
+        with self.lock.read():
+            return self.projections.get(axis, mode, event.index)
+
+    def cached_frame(self, index: dict[str, int]) -> np.ndarray | None:
+        """Full resolution frame at `index` if it is in the cache, never reads."""
+        return self.cache.peek(tuple(index.get(k, 0) for k in "ptzcg"))
+
+
+def _cache_key(event: MDAEvent) -> tuple[int, ...]:
+    return tuple(event.index.get(k, 0) for k in "ptzcg")
@@ -6,11 +6,15 @@ import superqt
 from fonticon_mdi6 import MDI6
 from qtpy import QtCore, QtWidgets
 from superqt.fonticon import icon
+from zeiss_control.output._util._projection import PROJECTIONS
 
 FIXED = QtWidgets.QSizePolicy.Policy.Fixed
 
 
 class QLabeledSlider(superqt.QLabeledSlider):
+    # "plane" or one of PROJECTIONS along this dimension
+    projectionChanged = QtCore.Signal(str)
+
     def __init__(
         self,
         name: str = "",
@@ -36,17 +40,28 @@ class QLabeledSlider(superqt.QLabeledSlider):
         self.lock_btn.setMaximumWidth(24)
         self.lock_btn.toggled.connect(self._on_lock_toggled)
 
+        self.projection_combo = QtWidgets.QComboBox(self)
+        self.projection_combo.addItems(["plane", *PROJECTIONS])
+        self.projection_combo.setToolTip(f"Show a projection along {name}")
+        self.projection_combo.currentTextChanged.connect(self.projectionChanged)
+        self.projection_combo.setVisible(name in ("t", "z"))
+
         layout = cast(QtWidgets.QBoxLayout, self.layout())
         layout.insertWidget(0, self.play_btn, 0, QtCore.Qt.AlignmentFlag.AlignRight)
         layout.insertWidget(0, name_label)
         # FIXME: the padding/vertical alignment is a bit off here
         layout.addWidget(self._length_label, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
         layout.addWidget(self.lock_btn, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
+        layout.addWidget(self.projection_combo, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
 
         self.installEventFilter(self)
         self.setPageStep(1)
         self.last_val = 0
 
+    @property
+    def projection(self) -> str:
+        return self.projection_combo.currentText()
+
     def _on_play_toggled(self, state: bool) -> None:
         if state:
             self.play_btn.setIcon(icon(MDI6.pause))
@@ -0,0 +1,225 @@
+from __future__ import annotations
+
+import math
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from vispy import scene
+from vispy.visuals.transforms import MatrixTransform
+
+if TYPE_CHECKING:
+    from vispy.scene import Node
+
+    from zeiss_control.output._util._downsample import DisplayDownsampler
+
+
+def mosaic_step(n_tiles: int, tile_pixels: int, max_texels: int) -> int:
+    """Smallest power of two stride that fits `n_tiles` in `max_texels`."""
+    step = 1
+    while n_tiles * tile_pixels / step**2 > max_texels:
+        step *= 2
+    return step
+
+
+def orient(img: np.ndarray, linear: np.ndarray) -> np.ndarray:
+    """Rotate/flip `img` like the 2x2 `linear` part of a tile transform.
+
+    The result is indexed [y, x] in scene coordinates.
+    """
+    if abs(linear[0, 0]) >= abs(linear[1, 0]):
+        # image columns map to scene x
+        flip_x, flip_y = linear[0, 0] < 0, linear[1, 1] < 0
+    else:
+        img = img.T
+        flip_x, flip_y = linear[1, 0] < 0, linear[0, 1] < 0
+    return img[:: -1 if flip_y else 1, :: -1 if flip_x else 1]
+
+
+class ChannelMosaic:
+    """All grid tiles of one channel, packed into a few large atlas textures.
+
+    The scene is divided into pages of `page_size` x `page_size` texels at `step`
+    scene pixels per texel, each page is one `Image`.  Tiles are written into the
+    pages at their stage position with their rotation applied, so a grid of a
+    hundred tiles is drawn with a handful of visuals and contrast, colormap and
+    visibility are set once per channel.  Pages are only created where tiles land.
+
+    `set_tile` only writes to memory, `flush` uploads the pages that changed, so
+    many tiles arriving together are uploaded once.
+
+    The pages also serve as spatial index: `tile_at` only checks the bounds of the
+    tiles overlapping the page under a point and maps the point to tile pixels with
+    the inverse of the tile transform, without picking on the GPU.
+
+    Parameters
+    ----------
+    parent : Node
+        The scene the pages are added to.
+    cmap, clim :
+        Passed on to the pages.
+    additive : bool
+        Blend additively with the channels below.
+    step : int
+        Scene pixels per texel, see `mosaic_step`.
+    page_size : int
+        Size of a page in texels.
+    downsampler : DisplayDownsampler | None
+        Upload the pages at screen resolution.
+    """
+
+    def __init__(
+        self,
+        parent: Node,
+        cmap: Any,
+        clim: tuple[float, float] = (0, 1),
+        additive: bool = False,
+        step: int = 1,
+        page_size: int = 2048,
+        downsampler: DisplayDownsampler | None = None,
+    ) -> None:
+        self.parent = parent
+        self.step = step
+        self.page_size = page_size
+        self.downsampler = downsampler
+        self.additive = additive
+        self._cmap = cmap
+        self._clim = clim
+        self._visible = True
+        # {g -> tile transform}
+        self.tiles: dict[int, MatrixTransform] = {}
+        # {g -> (x0, y0, x1, y1) in scene coordinates}
+        self.bounds: dict[int, tuple[float, float, float, float]] = {}
+        # {(i, j) -> tiles overlapping page (i, j)}
+        self._cells: dict[tuple[int, int], list[int]] = {}
+        # {(i, j) -> (texels, image)}
+        self.pages: dict[tuple[int, int], tuple[np.ndarray, scene.visuals.Image]] = {}
+        self._dirty: set[tuple[int, int]] = set()
+
+    def add_tile(self, g: int, transform: MatrixTransform) -> None:
+        """Place tile `g` with `transform`, like it would be for its own `Image`."""
+        self.tiles[g] = transform
+
+    def set_tile(self, g: int, img: np.ndarray, scale: int = 1) -> None:
+        """Write the frame of tile `g` into the pages. KeyError if not added.
+
+        `img` can be downsampled by `scale`, e.g. a pyramid level, if `scale` divides
+        `step`.
+        """
+        transform = self.tiles[g]
+        size = [img.shape[1] * scale, img.shape[0] * scale]
+        corners = transform.map([[0, 0], size])[:, :2]
+        new_tile = g not in self.bounds
+        self.bounds[g] = (*corners.min(axis=0), *corners.max(axis=0))
+        x0, y0 = (round(v / self.step) for v in corners.min(axis=0))
+        stride = max(1, self.step // scale)
+        texels = orient(img, transform.matrix[:2, :2])[::stride, ::stride]
+        size = self.page_size
+        height, width = texels.shape
+        for j in range(y0 // size, (y0 + height - 1) // size + 1):
+            for i in range(x0 // size, (x0 + width - 1) // size + 1):
+                page = self._page(i, j, img.dtype)
+                # overlap of the tile and page (i, j) in texels
+                left, right = max(x0, i * size), min(x0 + width, (i + 1) * size)
+                top, bottom = max(y0, j * size), min(y0 + height, (j + 1) * size)
+                page[
+                    top - j * size : bottom - j * size,
+                    left - i * size : right - i * size,
+                ] = texels[top - y0 : bottom - y0, left - x0 : right - x0]
+                self._dirty.add((i, j))
+                if new_tile:
+                    self._cells.setdefault((i, j), []).append(g)
+
+    def flush(self) -> None:
+        """Upload the pages changed since the last flush."""
+        for key in self._dirty:
+            page, image = self.pages[key]
+            if self.downsampler is not None:
+                self.downsampler.set_data(image, page)
+            else:
+                image.set_data(page)
+        self._dirty.clear()
+
+    def value_at(self, x: float, y: float) -> Any:
+        """Value at scene position (x, y), None outside of the pages."""
+        tx, ty = math.floor(x / self.step), math.floor(y / self.step)
+        entry = self.pages.get((tx // self.page_size, ty // self.page_size))
+        if entry is None:
+            return None
+        return entry[0][ty % self.page_size, tx % self.page_size]
+
+    def tile_at(self, x: float, y: float) -> tuple[int, int, int] | None:
+        """(g, column, row) of the tile pixel at scene position (x, y)."""
+        origin = self.page_size * self.step
+        cell = (math.floor(x / origin), math.floor(y / origin))
+        # the last tile placed is drawn on top
+        for g in reversed(self._cells.get(cell, ())):
+            x0, y0, x1, y1 = self.bounds[g]
+            if x0 <= x < x1 and y0 <= y < y1:
+                column, row = self.tiles[g].imap([x, y])[:2]
+                return g, math.floor(column), math.floor(row)
+        return None
+
+    @property
+    def images(self) -> list[scene.visuals.Image]:
+        return [image for _, image in self.pages.values()]
+
+    @property
+    def clim(self) -> tuple[float, float]:
+        return self._clim
+
+    @clim.setter
+    def clim(self, clim: tuple[float, float]) -> None:
+        self._clim = clim
+        for image in self.images:
+            image.clim = clim
+
+    @property
+    def cmap(self) -> Any:
+        return self._cmap
+
+    @cmap.setter
+    def cmap(self, cmap: Any) -> None:
+        self._cmap = cmap
+        for image in self.images:
+            image.cmap = cmap
+
+    @property
+    def visible(self) -> bool:
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible: bool) -> None:
+        self._visible = visible
+        for image in self.images:
+            image.visible = visible
+
+    def close(self) -> None:
+        """Remove the pages from the scene."""
+        for image in self.images:
+            image.parent = None
+        self.pages.clear()
+        self.tiles.clear()
+        self.bounds.clear()
+        self._cells.clear()
+        self._dirty.clear()
+
+    def _page(self, i: int, j: int, dtype: np.dtype) -> np.ndarray:
+        if (entry := self.pages.get((i, j))) is not None:
+            return entry[0]
+        page = np.zeros((self.page_size, self.page_size), dtype=dtype)
+        image = scene.visuals.Image(
+            page, parent=self.parent, cmap=self._cmap, clim=self._clim
+        )
+        transform = MatrixTransform()
+        transform.scale((self.step, self.step, 1))
+        origin = self.page_size * self.step
+        transform.translate((i * origin, j * origin, 0))
+        image.transform = transform
+        image.interactive = True
+        image.visible = self._visible
+        if self.additive:
+            image.set_gl_state("additive", depth_test=False)
+        else:
+            image.set_gl_state(depth_test=False)
+        self.pages[(i, j)] = (page, image)
+        return page
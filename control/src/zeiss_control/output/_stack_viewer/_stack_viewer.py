@@ -1,19 +1,26 @@
 from __future__ import annotations
 
 import copy
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING, Any, cast
 
 import numpy as np
 from fonticon_mdi6 import MDI6
 from qtpy import QtCore, QtWidgets
-from qtpy.QtCore import QTimer, Signal
+from qtpy.QtCore import Signal
 from superqt import fonticon
 from useq import MDAEvent, MDASequence, _channel
 
 from ._channel_row import ChannelRow, try_cast_colormap
 from ._datastore import QOMEZarrDatastore
 from ._labeled_slider import LabeledVisibilitySlider
+from ._mosaic import ChannelMosaic, mosaic_step
 from ._save_button import SaveButton
+from zeiss_control.output._util._autocontrast import AutoContrast
+from zeiss_control.output._util._deferred_display import DeferredDisplay
+from zeiss_control.output._util._downsample import DisplayDownsampler
+from zeiss_control.output._util._prefetch import SlicePrefetcher
+from zeiss_control.output._util._render_scheduler import RenderScheduler
+from zeiss_control.output._util._tile import crop_translation
 
 DIMENSIONS = ["t", "z", "c", "p", "g"]
 AUTOCLIM_RATE = 1  # Hz   0 = inf
@@ -40,11 +47,17 @@ class StackViewer(QtWidgets.QWidget):
     Parameters
     ----------
     transform: (int, bool, bool) rotation mirror_x mirror_y.
+    max_fps: new frames are displayed at most this many times per second, only the
+        newest frame of each image is shown (see `render_scheduler`).
+    clim_percentiles: (low, high) percentiles of the pixels of a channel used as
+        contrast limits in auto mode (see `autocontrast`).
+    mosaic_texels: texels per channel for all grid tiles together. Tiles are packed
+        into a `ChannelMosaic` per channel, strided so that the grid fits.
+    crop_offset: (rows, columns) from the center of the sensor to the center of the
+        frames, e.g. `CameraCrop.center_offset`. Tiles are shifted by it.
     """
 
-    _retry_display = Signal(MDAEvent)
-    _new_dim = Signal(str)
-    _new_img = Signal(MDAEvent)
+    _new_sequence = Signal()
 
     def __init__(
         self,
@@ -55,12 +68,17 @@ class StackViewer(QtWidgets.QWidget):
         size: tuple[int, int] | None = None,
         transform: tuple[int, bool, bool] = (0, True, False),
         save_button: bool = True,
+        max_fps: float = 30,
+        clim_percentiles: tuple[float, float] = (0.1, 99.9),
+        mosaic_texels: int = 32 * 1024**2,
+        crop_offset: tuple[float, float] = (0, 0),
     ):
         super().__init__(parent=parent)
         self._reload_position()
         self.sequence = sequence
         self.canvas_size = size
         self.transform = transform
+        self.crop_offset = crop_offset
         self._mmc = mmcore
         self._clim = "auto"
         self.cmaps = [
@@ -72,6 +90,8 @@ class StackViewer(QtWidgets.QWidget):
         self.setLayout(self.main_layout)
         self.construct_canvas()
         self.main_layout.addWidget(self._canvas.native)
+        # frames are uploaded at screen resolution, full resolution when zoomed in
+        self.downsampler = DisplayDownsampler(self.view, self._canvas)
 
         self.info_bar = QtWidgets.QLabel()
         self.info_bar.setSizePolicy(
@@ -100,16 +120,32 @@ class StackViewer(QtWidgets.QWidget):
             self._mmc.mda.events.sequenceStarted.connect(self.sequenceStarted)
 
         # self._new_channel.connect(self.channel_row.box_visibility)
-        self._new_dim.connect(self.add_slider)
-        self._retry_display.connect(self._redisplay)
-        self._new_img.connect(self.add_image)
-
-        self.images: dict[tuple, scene.visuals.Image] = {}
+        self._new_sequence.connect(self._clear_mosaics)
+
+        # {c -> all grid tiles of the channel}
+        self.mosaics: dict[int, ChannelMosaic] = {}
+        self.mosaic_texels = mosaic_texels
+        self.mosaic_step = 1
+        # {(c, g) -> (t, z) of the frame shown}
+        self.shown: dict[tuple[int, int], tuple[int, int]] = {}
         self.frame = 0
         self.ready = False
         self.current_channel = 0
         self.pixel_size = 1.0
-        self.missed_events: list[MDAEvent] = []
+        # frames that arrive before their slider, channel or image exist
+        self.deferred = DeferredDisplay(
+            self._show_frame,
+            self._prepare_display,
+            self._update_canvas,
+            parent=self,
+        )
+        # planes are cached by the datastore, the prefetcher only requests them
+        self.prefetcher = SlicePrefetcher(self._load_plane)
+        self.render_scheduler = RenderScheduler(
+            self._show_frame, self._update_canvas, max_fps, parent=self
+        )
+        # running histogram of the displayed frames per channel
+        self.autocontrast = AutoContrast(clim_percentiles)
 
         # self.clim_timer = QtCore.QTimer()
         # self.clim_timer.setInterval(int(1000 // AUTOCLIM_RATE))
@@ -123,6 +159,10 @@ class StackViewer(QtWidgets.QWidget):
 
         self.bottom_buttons = QtWidgets.QHBoxLayout()
         self.bottom_buttons.addWidget(self.collapse_btn)
+        self.deferred_label = QtWidgets.QLabel()
+        self.deferred_label.setVisible(False)
+        self.deferred.depth_changed.connect(self._on_deferred_depth)
+        self.bottom_buttons.addWidget(self.deferred_label)
         if save_button:
             self.save_btn = SaveButton(self.datastore)
             self.bottom_buttons.addWidget(self.save_btn)
@@ -169,30 +209,34 @@ class StackViewer(QtWidgets.QWidget):
     def add_slider(self, dim: str) -> None:
         slider = LabeledVisibilitySlider(dim, orientation=QtCore.Qt.Horizontal)
         slider.sliderMoved.connect(self.on_display_timer)
+        slider.projectionChanged.connect(self._on_projection_changed)
         slider.setRange(0, 1)
         self.slider_layout.addWidget(slider)
         self.sliders[dim] = slider
 
     def add_image(self, event: MDAEvent) -> None:
-        image = scene.visuals.Image(
-            np.zeros(self._canvas.size).astype(np.uint16),
-            parent=self.view.scene,
-            cmap=self.cmaps[event.index.get("c", 0)].to_vispy(),
-            clim=(0, 1),
-        )
+        channel, grid = event.index.get("c", 0), event.index.get("g", 0)
+        if (mosaic := self.mosaics.get(channel)) is None:
+            mosaic = ChannelMosaic(
+                self.view.scene,
+                cmap=self.cmaps[channel].to_vispy(),
+                additive=channel > 0,
+                step=self.mosaic_step,
+                downsampler=self.downsampler,
+            )
+            self.mosaics[channel] = mosaic
         trans = visuals.transforms.linear.MatrixTransform()
         trans.rotate(self.transform[0], (0, 0, 1))
-        image.transform = self._get_image_position(trans, event)
-        image.interactive = True
-        if event.index.get("c", 0) > 0:
-            image.set_gl_state("additive", depth_test=False)
-        else:
-            image.set_gl_state(depth_test=False)
-        self.images[
-            tuple({"c": event.index.get("c", 0), "g": event.index.get("g", 0)}.items())
-        ] = image
+        mosaic.add_tile(grid, self._get_image_position(trans, event))
         print("IMAGE ADDED", event.index)
 
+    def _clear_mosaics(self) -> None:
+        for mosaic in self.mosaics.values():
+            mosaic.close()
+        self.mosaics.clear()
+        self.shown.clear()
+        self.deferred.clear()
+
     def sequenceStarted(self, sequence: MDASequence) -> None:
         """Sequence started by the mmcore. Adjust our settings, make layers etc."""
         self.ready = False
@@ -200,52 +244,57 @@ class StackViewer(QtWidgets.QWidget):
         self.pixel_size = self._mmc.getPixelSizeUm() if self._mmc else self.pixel_size
         self.ng = 1
         self.current_channel = 0
+        # stride the tiles so that the whole grid of a channel fits in the budget
+        self.mosaic_step = mosaic_step(
+            max(sequence.sizes.get("g", 1), 1),
+            self.img_size[0] * self.img_size[1],
+            self.mosaic_texels,
+        )
+        # the scene is changed in the GUI thread, before the first frame is shown
+        self._new_sequence.emit()
+        self.prefetcher.cancel()
+        self.render_scheduler.reset()
+        self.autocontrast.reset()
 
         self._collapse_view()
         self.ready = True
 
     def frameReady(self, event: MDAEvent) -> None:
-        """Frame received from acquisition, display the image, update sliders etc."""
-        if not self.ready:
-            self._retry_display.emit(event)
+        """Frame received from acquisition, schedule it to be displayed."""
+        key = (event.index.get("c", 0), event.index.get("g", 0))
+        self.render_scheduler.submit(key, event)
+
+    def _show_frame(self, event: MDAEvent) -> None:
+        """Display the image, update sliders etc."""
+        if not self.ready or len(self.deferred) or self._missing(event):
+            # shown in order once the sliders, channels and images exist
+            self.deferred.defer(event)
             return
         indices = dict(event.index)
         self.ng = max(self.ng, indices.get("g", 0) + 1)
-        img = self.datastore.get_frame(event)
+        # a projection is updated with every frame, show it with the new frame
+        projected = self._projected(indices)
+        img = self.datastore.get_frame(event) if projected is None else projected
         # Update display
-        try:
-            display_indices = self._set_sliders(indices)
-        except KeyError as e:
-            self._new_dim.emit(e.args[0])
-            self._retry_display.emit(event)
-            return
+        display_indices = self._set_sliders(indices)
         if display_indices == indices:
-            # Get controls
-            try:
-                clim_slider = self.channel_row.boxes[indices.get("c", 0)].slider
-            except KeyError:
-                this_channel = cast(_channel.Channel, event.channel)
-                self.channel_row.add_channel(this_channel, indices.get("c", 0))
-                self._retry_display.emit(event)
-                return
-            try:
-                self.display_image(img, indices.get("c", 0), indices.get("g", 0))
-            except KeyError:
-                self._new_img.emit(event)
-                self._retry_display.emit(event)
-                return
+            clim_slider = self.channel_row.boxes[indices.get("c", 0)].slider
+            self.display_image(img, indices.get("c", 0), indices.get("g", 0))
+            if projected is None:
+                self.shown[(indices.get("c", 0), indices.get("g", 0))] = (
+                    indices.get("t", 0),
+                    indices.get("z", 0),
+                )
+            else:
+                self.shown.pop((indices.get("c", 0), indices.get("g", 0)), None)
             # Handle autoscaling
+            vmin, vmax = self.autocontrast.range(indices.get("c", 0))
             clim_slider.setRange(
-                min(clim_slider.minimum(), img.min()),
-                max(clim_slider.maximum(), img.max()),
+                min(clim_slider.minimum(), vmin),
+                max(clim_slider.maximum(), vmax),
             )
             if self.channel_row.boxes[indices.get("c", 0)].autoscale_chbx.isChecked():
-                clim_slider.setValue(
-                    [
-                        min(clim_slider.minimum(), img.min()),
-                        max(clim_slider.maximum(), img.max()),
-                    ]
-                )
+                clim_slider.setValue(self.autocontrast.clim(indices.get("c", 0)))
             try:
                 self.on_clim_timer(indices.get("c", 0))
             except KeyError:
@@ -253,11 +302,44 @@ class StackViewer(QtWidgets.QWidget):
         if sum([event.index.get("t", 0), event.index.get("z", 0)]) == 0:
             self._collapse_view()
 
+    def _missing(self, event: MDAEvent) -> list[str]:
+        """What has to be created before `event` can be shown."""
+        missing = [
+            dim
+            for dim in ("t", "z")
+            if event.index.get(dim, 0) and dim not in self.sliders
+        ]
+        channel, grid = event.index.get("c", 0), event.index.get("g", 0)
+        if channel not in self.channel_row.boxes:
+            missing.append("channel")
+        if channel not in self.mosaics or grid not in self.mosaics[channel].tiles:
+            missing.append("image")
+        return missing
+
+    def _prepare_display(self, events: list[MDAEvent]) -> None:
+        """Create the sliders, channels and images for all deferred events."""
+        if not self.ready:
+            return
+        for event in events:
+            for missing in self._missing(event):
+                if missing == "channel":
+                    this_channel = cast(_channel.Channel, event.channel)
+                    self.channel_row.add_channel(this_channel, event.index.get("c", 0))
+                elif missing == "image":
+                    self.add_image(event)
+                else:
+                    self.add_slider(missing)
+
+    def _on_deferred_depth(self, depth: int) -> None:
+        self.deferred_label.setText(f"{depth} frames waiting")
+        self.deferred_label.setToolTip(str(self.deferred))
+        self.deferred_label.setVisible(depth > 0)
+
     def _handle_channel_clim(
         self, values: tuple[int, int], channel: int, set_autoscale: bool = True
     ) -> None:
-        for g in range(self.ng):
-            self.images[tuple({"c": channel, "g": g}.items())].clim = values
+        if (mosaic := self.mosaics.get(channel)) is not None:
+            mosaic.clim = values
         if self.channel_row.boxes[channel].autoscale_chbx.isChecked() and set_autoscale:
             self.channel_row.boxes[channel].autoscale_chbx.setCheckState(
                 QtCore.Qt.Unchecked
@@ -265,24 +347,17 @@ class StackViewer(QtWidgets.QWidget):
         self._canvas.update()
 
     def _handle_channel_cmap(self, colormap: cmap.Colormap, channel: int) -> None:
-        for g in range(self.ng):
-            try:
-                self.images[tuple({"c": channel, "g": g}.items())].cmap = (
-                    colormap.to_vispy()
-                )
-            except KeyError:
-                return
+        if (mosaic := self.mosaics.get(channel)) is None:
+            return
+        mosaic.cmap = colormap.to_vispy()
         if colormap.name not in self.cmap_names:
             self.cmap_names.append(self.cmap_names[channel])
         self.cmap_names[channel] = colormap.name
         self._canvas.update()
 
     def _handle_channel_visibility(self, state: bool, channel: int) -> None:
-        for g in range(self.ng):
-            self.images[tuple({"c": channel, "g": g}.items())].visible = (
-                self.channel_row.boxes[channel].show_channel.isChecked()
-            )
-
+        if (mosaic := self.mosaics.get(channel)) is not None:
+            mosaic.visible = self.channel_row.boxes[channel].show_channel.isChecked()
         self._canvas.update()
 
     def _handle_channel_autoscale(self, state: bool, channel: int) -> None:
@@ -301,44 +376,38 @@ class StackViewer(QtWidgets.QWidget):
         self.current_channel = channel
 
     def on_mouse_move(self, event: SceneMouseEvent) -> None:
-        """Mouse moved on the canvas, display the pixel value and position."""
-        # https://groups.google.com/g/vispy/c/sUNKoDL1Gc0/m/E5AG7lgPFQAJ
-        self.view.interactive = False
-        images = []
-        all_images = []
-        # Get the images the mouse is over
-        while image := self._canvas.visual_at(event.pos):
-            if image in self.images.values():
-                images.append(image)
-            image.interactive = False
-            all_images.append(image)
-        for image in all_images:
-            image.interactive = True
-
-
-        self.view.interactive = True
-        if images == []:
-            transform = self.view.get_transform("canvas", "visual")
-            p = [int(x) for x in transform.map(event.pos)]
-            info = f"[{p[0]}, {p[1]}]"
-            self.info_bar.setText(info)
-            return
-        # Adjust channel index is channel(s) are not visible
-        real_channel = self.current_channel
-        for i in range(self.current_channel):
-            i_visible = self.channel_row.boxes[i].show_channel.isChecked()
-            real_channel = real_channel - 1 if not i_visible else real_channel
-        images.reverse()
-        transform = images[real_channel].get_transform("canvas", "visual")
-        p = [int(x) for x in transform.map(event.pos)]
-        try:
-            pos = f"[{p[0]}, {p[1]}]"
-            value = f"{images[real_channel]._data[p[1], p[0]]}"
-            info = f"{pos}: {value}"
-            self.info_bar.setText(info)
-        except IndexError:
-            info = f"[{p[0]}, {p[1]}]"
-            self.info_bar.setText(info)
+        """Mouse moved on the canvas, display the pixel value and position.
+
+        The tile under the cursor is found in the mosaic of the current channel and
+        the value is read from the frame in the datastore cache, no picking render.
+        """
+        transform = self._canvas.scene.node_transform(self.view.scene)
+        x, y = transform.map(event.pos)[:2]
+        info = f"[{int(x)}, {int(y)}]"
+        channel = self.current_channel
+        mosaic = self.mosaics.get(channel)
+        if mosaic is not None and mosaic.visible and (tile := mosaic.tile_at(x, y)):
+            grid, column, row = tile
+            if (value := self._value_at(channel, grid, column, row)) is None:
+                # not cached (anymore), the mosaic has every step-th pixel
+                value = mosaic.value_at(x, y)
+            info = f"[{column}, {row}]: {value}"
+            if self.ng > 1:
+                info = f"g{grid} {info}"
+        self.info_bar.setText(info)
+
+    def _value_at(self, channel: int, grid: int, column: int, row: int) -> Any:
+        """Pixel value of the frame shown in tile (channel, grid), if cached."""
+        if (shown := self.shown.get((channel, grid))) is None:
+            # projections are not cached, the mosaic has their value
+            return None
+        t, z = shown
+        frame = self.datastore.cached_frame({"t": t, "z": z, "c": channel, "g": grid})
+        if frame is None:
+            return None
+        if not (0 <= row < frame.shape[0] and 0 <= column < frame.shape[1]):
+            return None
+        return frame[row, column]
 
     def on_display_timer(self) -> None:
         """Update display, usually triggered by QTimer started by slider click."""
@@ -347,23 +416,51 @@ class StackViewer(QtWidgets.QWidget):
             self.display_index[slider.name] = slider.value()
         if old_index == self.display_index:
             return
-        if (sequence := self.sequence) is None:
+        if self.sequence is None:
             return
-        for img_index in self.images.keys():
-            img_index = dict(img_index)
-            frame = self.datastore.get_frame(
-                MDAEvent(
-                    index={
-                        "t": self.display_index["t"],
-                        "z": self.display_index["z"],
-                        "c": img_index.get("c", 0),
-                        "g": img_index.get("g", 0),
-                        "p": 0,
-                    }
-                )
-            )
-            self.display_image(frame, img_index.get("c", 0), img_index.get("g", 0))
-        self._canvas.update()
+        images = self._display_current()
+        moves = {
+            dim: (slider.value(), slider.maximum())
+            for dim, slider in self.sliders.items()
+            if dim in ("t", "z") and old_index[dim] != self.display_index[dim]
+        }
+        if moves:
+            self.prefetcher.follow(moves, self.display_index, images)
+
+    def _display_current(self) -> list[tuple[int, int]]:
+        """Show the frames at the display index, returns the (c, g) shown."""
+        t, z = self.display_index["t"], self.display_index["z"]
+        images = [(c, g) for c, mosaic in self.mosaics.items() for g in mosaic.tiles]
+        for c, g in images:
+            index = {"t": t, "z": z, "c": c, "g": g}
+            if (frame := self._projected(index)) is None:
+                frame = self.prefetcher.fetch((t, z, c, g))
+                self.shown[(c, g)] = (t, z)
+            else:
+                self.shown.pop((c, g), None)
+            self.display_image(frame, c, g)
+        self._update_canvas()
+        return images
+
+    def _projected(self, index: dict[str, int]) -> np.ndarray | None:
+        """Projection through the frame at `index`, if a slider is set to one."""
+        for dim, slider in self.sliders.items():
+            if dim in ("t", "z") and slider.projection != "plane":
+                event = MDAEvent(index=index)
+                return self.datastore.get_projection(dim, slider.projection, event)
+        return None
+
+    def _on_projection_changed(self, mode: str) -> None:
+        if self.sequence is not None:
+            self._display_current()
+
+    def _load_plane(self, key: tuple[int, int, int, int]) -> np.ndarray:
+        t, z, c, g = key
+        # the mosaic only shows every step-th pixel, read the matching pyramid level
+        return self.datastore.get_frame(
+            MDAEvent(index={"t": t, "z": z, "c": c, "g": g, "p": 0}),
+            level=self.datastore.level_for(self.mosaic_step),
+        )
 
     def _set_sliders(self, indices: dict) -> dict:
         """New indices from outside the sliders, update."""
@@ -384,26 +481,32 @@ class StackViewer(QtWidgets.QWidget):
         return display_indices
 
     def display_image(self, img: np.ndarray, channel: int = 0, grid: int = 0) -> None:
-        self.images[tuple({"c": channel, "g": grid}.items())].set_data(img)
-        # Should we do this? Might it slow down acquisition while in the same thread?
+        # pyramid levels are smaller by a power of two
+        scale = 1
+        while img.shape[0] * scale * 2 <= self.img_size[0]:
+            scale *= 2
+        # the pages are uploaded once for all images by the callers
+        self.mosaics[channel].set_tile(grid, img, scale)
+        self.autocontrast.update(channel, img)
+
+    def _update_canvas(self) -> None:
+        """Upload the changed mosaic pages and redraw."""
+        for mosaic in self.mosaics.values():
+            mosaic.flush()
         self._canvas.update()
 
     def on_clim_timer(self, channel: int | None = None) -> None:
         channel_list = (
             list(range(len(self.channel_row.boxes))) if channel is None else [channel]
         )
-        for grid in range(self.ng):
-            for channel in channel_list:
-                if (
-                    self.channel_row.boxes[channel].autoscale_chbx.isChecked()
-                    and self.images[tuple({"c": channel, "g": grid}.items())].visible
-                ):
-                    # TODO: percentile here, could be in gui
-                    clim = np.percentile(
-                        self.images[tuple({"c": channel, "g": grid}.items())]._data,
-                        [0, 100],
-                    )
-                    self.images[tuple({"c": channel, "g": grid}.items())].clim = clim
+        for channel in channel_list:
+            if not self.channel_row.boxes[channel].autoscale_chbx.isChecked():
+                continue
+            # same limits for all tiles of a channel, from its running histogram
+            if (clim := self.autocontrast.clim(channel)) is None:
+                continue
+            if (mosaic := self.mosaics[channel]).visible:
+                mosaic.clim = clim
         self._canvas.update()
 
     def _get_image_position(
@@ -442,6 +545,7 @@ class StackViewer(QtWidgets.QWidget):
                     0,
                 )
             )
+            trans.translate(crop_translation(trans, self.crop_offset))
             self._expand_canvas_view(event)
         return trans
 
@@ -479,6 +583,7 @@ class StackViewer(QtWidgets.QWidget):
         if self._mmc:
             self._mmc.mda.events.sequenceStarted.disconnect(self.sequenceStarted)
         self.datastore.frame_ready.disconnect(self.frameReady)
+        self.prefetcher.close()
 
     def _reload_position(self) -> None:
         self.qt_settings = QtCore.QSettings("pymmcore_plus", self.__class__.__name__)
@@ -496,20 +601,6 @@ class StackViewer(QtWidgets.QWidget):
         )
         self.view.camera.rect = view_rect
 
-    def replot_timer_callback(self) -> None:
-        while self.missed_events:
-            event = self.missed_events.pop(0)
-            # self.missed_events.remove(event)
-            self.frameReady(event)
-
-    def _redisplay(self, event: MDAEvent) -> None:
-        self.missed_events.append(event)
-        self.replot_timer = QTimer()
-        self.replot_timer.setSingleShot(True)
-        self.replot_timer.timeout.connect(self.replot_timer_callback)
-        self.replot_timer.start(100)
-        return
-
     def closeEvent(self, e: QCloseEvent) -> None:
         """Write window size and position to config file."""
         self.qt_settings.setValue("size", self.size())
@@ -10,6 +10,8 @@ if TYPE_CHECKING:
     import numpy as np
     import useq
 
+    from ._metadata_sink import FrameMetadataSink
+
     class SupportsSetItem(Protocol):
         def __setitem__(self, key: tuple[int, ...], value: np.ndarray) -> None: ...
 
@@ -48,6 +50,9 @@ class _5DWriterBase(Generic[T]):
         Will accumulate frame metadata for each frame as the experiment progresses.
         It is up to subclasses to do something with it in `finalize_metadata()`, and it
         will be cleared at the end of each sequence.
+    metadata_sink : FrameMetadataSink | None
+        If set (by subclasses), frame metadata is streamed to this sink instead of
+        being accumulated in `frame_metadatas`.
     current_sequence : useq.MDASequence | None
         The current sequence being written.  This will be set during `sequenceStarted`
         and cleared during `sequenceFinished`.
@@ -66,6 +71,7 @@ class _5DWriterBase(Generic[T]):
         # storage of individual frame metadata
         # maps position key to list of frame metadata
         self.frame_metadatas: defaultdict[str, list[dict]] = defaultdict(list)
+        self.metadata_sink: FrameMetadataSink | None = None
 
         # set during sequenceStarted and cleared during sequenceFinished
         self.current_sequence: useq.MDASequence | None = None
@@ -180,6 +186,11 @@ class _5DWriterBase(Generic[T]):
         # needn't be re-implemented in subclasses
         # default implementation is to store the metadata in self._frame_metas
         # use finalize_metadata to write to disk at the end of the sequence.
+        if self.metadata_sink is not None:
+            # the event is serialized on the sink's thread
+            record = {**meta, "Event": event} if meta else {}
+            self.metadata_sink.append(key, record)
+            return
         if meta:
             # fix serialization MDAEvent
             # XXX: There is already an Event object in meta, this overwrites it.
@@ -0,0 +1,122 @@
+"""Contrast limits from running histograms of the displayed frames."""
+
+from __future__ import annotations
+
+import math
+from typing import Hashable
+
+import numpy as np
+
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+class ChannelHistogram:
+    """Running histogram of the pixel values of one channel.
+
+    Every `update` counts the values of a strided subsample of about `samples`
+    pixels with `np.bincount`, one bin per value.  The previous counts are weighted
+    by `decay`, so the histogram follows changes in brightness: 0 only keeps the last
+    frame, values close to 1 average over many frames (e.g. all tiles of a grid).
+    Values are clipped to the uint16 range.
+    """
+
+    def __init__(self, samples: int = 2**16, decay: float = 0.9) -> None:
+        self.samples = samples
+        self.decay = decay
+        self.counts = np.zeros(0, dtype=np.float64)
+        # smallest and largest value seen in any subsample
+        self.min = UINT16_MAX
+        self.max = 0
+
+    def subsample(self, img: np.ndarray) -> np.ndarray:
+        step = max(1, math.isqrt(img.size // self.samples))
+        return img[..., ::step, ::step]
+
+    def update(self, img: np.ndarray) -> None:
+        sample = self.subsample(img)
+        if sample.dtype.kind != "u" or sample.dtype.itemsize > 2:
+            sample = np.clip(sample, 0, UINT16_MAX).astype(np.uint16)
+        new = np.bincount(sample.ravel(), minlength=len(self.counts))
+        if len(new) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(new) - len(self.counts)))
+        self.counts *= self.decay
+        self.counts[: len(new)] += new
+        if len(nonzero := np.flatnonzero(new)):
+            self.min = min(self.min, int(nonzero[0]))
+            self.max = max(self.max, int(nonzero[-1]))
+
+    def percentiles(self, low: float, high: float) -> tuple[int, int] | None:
+        """Values below which `low` and `high` percent of the pixels fall."""
+        cumulative = np.cumsum(self.counts)
+        if not len(cumulative) or cumulative[-1] == 0:
+            return None
+        total = cumulative[-1]
+        vmin = int(np.searchsorted(cumulative, total * low / 100, side="right"))
+        vmax = int(np.searchsorted(cumulative, total * high / 100, side="left"))
+        vmax = min(vmax, len(cumulative) - 1)
+        return vmin, max(vmax, vmin + 1)
+
+    def histogram(self) -> tuple[np.ndarray, np.ndarray]:
+        """Counts and bin edges up to the largest value in the histogram."""
+        nonzero = np.flatnonzero(self.counts)
+        counts = self.counts[: nonzero[-1] + 1] if len(nonzero) else self.counts[:0]
+        return counts, np.arange(len(counts) + 1)
+
+
+class AutoContrast:
+    """Percentile contrast limits per channel, from `ChannelHistogram`s.
+
+    ```python
+    autocontrast.update(channel, img)
+    image.clim = autocontrast.clim(channel)
+    counts, edges = autocontrast.histogram(channel)
+    ```
+
+    Parameters
+    ----------
+    percentiles : tuple[float, float]
+        Lower and upper percentile of the pixels used as contrast limits, (0, 100)
+        is the minimum and maximum.
+    samples : int
+        Approximate number of pixels counted per frame.
+    decay : float
+        Weight of the previous counts at every update, see `ChannelHistogram`.
+    """
+
+    def __init__(
+        self,
+        percentiles: tuple[float, float] = (0.1, 99.9),
+        samples: int = 2**16,
+        decay: float = 0.9,
+    ) -> None:
+        self.percentiles = percentiles
+        self.samples = samples
+        self.decay = decay
+        self.histograms: dict[Hashable, ChannelHistogram] = {}
+
+    def update(self, key: Hashable, img: np.ndarray) -> None:
+        if (histogram := self.histograms.get(key)) is None:
+            histogram = ChannelHistogram(self.samples, self.decay)
+            self.histograms[key] = histogram
+        histogram.update(img)
+
+    def clim(self, key: Hashable) -> tuple[int, int] | None:
+        """Contrast limits for `key`, None before the first frame."""
+        if (histogram := self.histograms.get(key)) is None:
+            return None
+        return histogram.percentiles(*self.percentiles)
+
+    def range(self, key: Hashable) -> tuple[int, int] | None:
+        """Smallest and largest value seen for `key`, e.g. for a slider range."""
+        if (histogram := self.histograms.get(key)) is None:
+            return None
+        return histogram.min, histogram.max
+
+    def histogram(self, key: Hashable) -> tuple[np.ndarray, np.ndarray]:
+        """Counts and bin edges of the histogram of `key`, to draw it."""
+        if (histogram := self.histograms.get(key)) is None:
+            return np.zeros(0), np.arange(1)
+        return histogram.histogram()
+
+    def reset(self) -> None:
+        self.histograms.clear()
@@ -0,0 +1,148 @@
+"""Micro-benchmark for reading frames from a datastore while it is written to.
+
+Run with `python -m zeiss_control.output._util._benchmark`.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import numpy as np
+
+
+@dataclass
+class ReadBenchmark:
+    """Result of `read_during_write`."""
+
+    name: str
+    writes: int
+    reads: int
+    seconds: float
+    max_read_ms: float
+
+    @property
+    def reads_per_s(self) -> float:
+        return self.reads / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.name}: {self.reads_per_s:.0f} frames/s read during "
+            f"{self.writes} writes, slowest read {self.max_read_ms:.2f} ms"
+        )
+
+
+def read_during_write(
+    write: Callable[[int], None],
+    read: Callable[[int], Any],
+    n_frames: int = 200,
+    write_hz: float = 100,
+    name: str = "",
+) -> ReadBenchmark:
+    """Read the latest frame in a loop in one thread while another writes frames.
+
+    `write(i)` is called `n_frames` times at `write_hz` and `read(i)` is called as
+    often as possible with the index of the last frame written, like a viewer
+    following the acquisition.
+    """
+    last = -1
+    done = threading.Event()
+
+    def _write() -> None:
+        nonlocal last
+        for i in range(n_frames):
+            t0 = time.perf_counter()
+            write(i)
+            last = i
+            time.sleep(max(0, 1 / write_hz - (time.perf_counter() - t0)))
+        done.set()
+
+    reads = 0
+    max_read = 0.0
+    writer = threading.Thread(target=_write)
+    start = time.perf_counter()
+    writer.start()
+    while not done.is_set():
+        if last < 0:
+            # nothing to read yet, don't hold the GIL from the writer
+            done.wait(0.001)
+            continue
+        t0 = time.perf_counter()
+        read(last)
+        max_read = max(max_read, time.perf_counter() - t0)
+        reads += 1
+    writer.join()
+    seconds = time.perf_counter() - start
+    return ReadBenchmark(name, n_frames, reads, seconds, max_read * 1000)
+
+
+def _local_datastore(backend: str, shape: tuple[int, int]) -> ReadBenchmark:
+    """QLocalDataStore as the StackViewer reads it, frames borrowed like from a hub."""
+    import tempfile
+
+    from qtpy import QtCore
+    from useq import MDAEvent
+
+    from zeiss_control.output.datastore import QLocalDataStore
+
+    # the datastore's listener thread runs an event loop
+    _app = QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+    scratch = tempfile.TemporaryDirectory()
+    datastore = QLocalDataStore(
+        (200, 1, 2, 1, *shape), backend=backend, scratch_dir=scratch.name
+    )
+    frame = np.random.randint(0, 4096, shape, dtype=np.uint16)
+    frame.flags.writeable = False
+    events = [MDAEvent(index={"t": i, "z": 0, "c": i % 2}) for i in range(200)]
+
+    def write(i: int) -> None:
+        datastore.new_frame(frame, events[i])
+
+    def read(i: int) -> np.ndarray:
+        return datastore.get_frame((i, 0, i % 2, 0))
+
+    try:
+        return read_during_write(write, read, name=f"QLocalDataStore {backend}")
+    finally:
+        del datastore
+        scratch.cleanup()
+
+
+def _zarr_datastore(compressed: bool, shape: tuple[int, int]) -> ReadBenchmark:
+    """QOMEZarrDatastore as the StackViewer reads it, through its PlaneCache."""
+    import useq
+
+    from zeiss_control.output._stack_viewer._datastore import QOMEZarrDatastore
+
+    from ._compression import CompressionPipeline
+
+    seq = useq.MDASequence(time_plan={"interval": 0, "loops": 200}, channels=["a"])
+    compression = CompressionPipeline() if compressed else None
+    datastore = QOMEZarrDatastore(compression=compression)
+    datastore.sequenceStarted(seq)
+    events = list(seq)
+    frame = np.random.randint(0, 4096, shape, dtype=np.uint16)
+    frame.flags.writeable = False
+
+    def write(i: int) -> None:
+        datastore.frameReady(frame, events[i], {})
+
+    def read(i: int) -> np.ndarray:
+        return datastore.get_frame(events[i])
+
+    name = f"QOMEZarrDatastore {'compressed' if compressed else 'raw'}"
+    try:
+        return read_during_write(write, read, name=name)
+    finally:
+        datastore.sequenceFinished(seq)
+        print(f"  cache: {datastore.cache}")
+
+
+if __name__ == "__main__":
+    shape = (2048, 2048)
+    for backend in ("memory", "memmap"):
+        print(_local_datastore(backend, shape))
+    for compressed in (False, True):
+        print(_zarr_datastore(compressed, shape))
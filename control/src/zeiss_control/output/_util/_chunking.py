@@ -0,0 +1,181 @@
+"""Chunk layout for the OME-Zarr writers and an assembler for multi-plane chunks."""
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from typing import Callable, Iterator, Sequence
+
+    import zarr
+
+
+@dataclass
+class ChunkPolicy:
+    """How an OME-Zarr position array is split into chunks (and shards).
+
+    The default is one chunk per XY plane.
+
+    Parameters
+    ----------
+    planes_per_chunk : dict[str, int]
+        Number of planes along a non-spatial dimension that go into one chunk,
+        e.g. `{"t": 16, "z": 8}`.  Dimensions that are not given get 1.
+    xy_tile : tuple[int, int] | None
+        (y, x) size of the chunks in the image plane. None for the full frame.
+    chunks_per_shard : dict[str, int] | None
+        Zarr v3 only. Number of chunks along a dimension ("t", "z", "c", "y", "x")
+        that are stored together in one shard file.  Dimensions that are not given
+        get 1.  None disables sharding.  This uses the experimental v3 support of
+        zarr-python 2.x, see `check`.
+    """
+
+    planes_per_chunk: dict[str, int] = field(default_factory=dict)
+    xy_tile: tuple[int, int] | None = None
+    chunks_per_shard: dict[str, int] | None = None
+
+    def chunks(self, sizes: dict[str, int]) -> tuple[int, ...]:
+        """Chunk shape for the ordered `sizes` ({dim: size}, ending with y, x)."""
+        dims = list(sizes)
+        chunks = [
+            max(1, min(self.planes_per_chunk.get(dim, 1), sizes[dim]))
+            for dim in dims[:-2]
+        ]
+        if self.xy_tile is None:
+            chunks.extend((sizes[dims[-2]], sizes[dims[-1]]))
+        else:
+            chunks.extend(
+                min(tile, sizes[dim]) for tile, dim in zip(self.xy_tile, dims[-2:])
+            )
+        return tuple(chunks)
+
+    def check(self, zarr_version: int | None) -> None:
+        """Raise if the policy can't be used with `zarr_version`."""
+        if self.chunks_per_shard is None:
+            return
+        if zarr_version != 3:
+            raise ValueError("Sharding is only available with zarr_version=3.")
+        _sharding_transformer()
+
+    def array_kwargs(self, sizes: dict[str, int], zarr_version: int | None) -> dict:
+        """Keyword arguments for `zarr.Group.create` implementing this policy."""
+        kwargs: dict[str, Any] = {"chunks": self.chunks(sizes)}
+        if self.chunks_per_shard is None:
+            return kwargs
+        self.check(zarr_version)
+        per_shard = tuple(self.chunks_per_shard.get(dim, 1) for dim in sizes)
+        kwargs["storage_transformers"] = [
+            _sharding_transformer()("indexed", chunks_per_shard=per_shard)
+        ]
+        return kwargs
+
+    def shard_index(
+        self, dims: Sequence[str], chunks: Sequence[int], selection: tuple
+    ) -> tuple[int, ...] | None:
+        """Index of the shard that a write to `selection` goes to, None without
+        sharding.  The selection must not span several shards."""
+        if self.chunks_per_shard is None:
+            return None
+        index = []
+        for dim, chunk, sel in zip(dims, chunks, selection):
+            start = (sel.start or 0) if isinstance(sel, slice) else sel
+            index.append(start // (chunk * self.chunks_per_shard.get(dim, 1)))
+        return tuple(index)
+
+    @property
+    def single_plane(self) -> bool:
+        """True if each chunk holds a single plane, so no assembly is needed."""
+        return all(n <= 1 for n in self.planes_per_chunk.values())
+
+
+class ChunkAssembler:
+    """Collect planes in memory until a chunk along the non-spatial axes is complete.
+
+    Each complete chunk is written to the array with a single `__setitem__`, so every
+    chunk file is written exactly once. Chunks that are still incomplete at the end of
+    the sequence are written by `flush`.
+
+    Note that one buffer is held for every chunk that is currently being filled, e.g.
+    with 16 timepoints per chunk, one buffer of 16 planes per channel and z-plane.
+
+    `write(selection, data)` can be given to customize how a chunk is written, the
+    default is `ary[selection] = data`.
+    """
+
+    def __init__(
+        self,
+        ary: zarr.Array,
+        write: Callable[[tuple, np.ndarray], None] | None = None,
+    ) -> None:
+        self._ary = ary
+        self._store = write or ary.__setitem__
+        self._plane_chunks = ary.chunks[:-2]
+        self._plane_shape = ary.shape[:-2]
+        # {chunk index -> (buffer, filled planes)}
+        self._buffers: dict[tuple[int, ...], tuple[np.ndarray, np.ndarray]] = {}
+
+    def add(self, index: tuple[int, ...], frame: np.ndarray) -> None:
+        """Add a plane at `index`, writes the chunk if this completed it."""
+        chunk, local = self._locate(index)
+        if chunk not in self._buffers:
+            extent = self._extent(chunk)
+            fill = self._ary.fill_value or 0
+            buffer = np.full((*extent, *frame.shape), fill, dtype=self._ary.dtype)
+            self._buffers[chunk] = (buffer, np.zeros(extent, dtype=bool))
+        buffer, filled = self._buffers[chunk]
+        buffer[local] = frame
+        filled[local] = True
+        if filled.all():
+            self._write(chunk)
+
+    def get(self, index: tuple[int, ...]) -> np.ndarray | None:
+        """Return the plane at `index` if it is still held in memory."""
+        chunk, local = self._locate(index)
+        if chunk in self._buffers:
+            buffer, filled = self._buffers[chunk]
+            if filled[local]:
+                return buffer[local]
+        return None
+
+    def flush(self) -> None:
+        """Write all incomplete chunks."""
+        for chunk in list(self._buffers):
+            self._write(chunk)
+
+    def _locate(
+        self, index: tuple[int, ...]
+    ) -> tuple[tuple[int, ...], tuple[int, ...]]:
+        chunk = tuple(i // c for i, c in zip(index, self._plane_chunks))
+        local = tuple(i % c for i, c in zip(index, self._plane_chunks))
+        return chunk, local
+
+    def _extent(self, chunk: tuple[int, ...]) -> tuple[int, ...]:
+        return tuple(
+            min(c, size - i * c)
+            for i, c, size in zip(chunk, self._plane_chunks, self._plane_shape)
+        )
+
+    def _slices(self, chunk: tuple[int, ...]) -> Iterator[slice]:
+        for i, c, n in zip(chunk, self._plane_chunks, self._extent(chunk)):
+            yield slice(i * c, i * c + n)
+
+    def _write(self, chunk: tuple[int, ...]) -> None:
+        buffer, _ = self._buffers.pop(chunk)
+        self._store(tuple(self._slices(chunk)), buffer)
+
+
+def _sharding_transformer() -> type:
+    """The sharding storage transformer of zarr-python 2.x."""
+    # private module of the experimental v3 support, there is no public import
+    try:
+        from zarr._storage.v3_storage_transformers import ShardingStorageTransformer
+    except ImportError as e:
+        raise ImportError(
+            "Sharding needs the experimental zarr v3 support of zarr-python 2.x "
+            "(`pip install 'zarr>=2.13,<3'` and ZARR_V3_EXPERIMENTAL_API=1). "
+            "Use a ChunkPolicy without chunks_per_shard otherwise."
+        ) from e
+    return ShardingStorageTransformer
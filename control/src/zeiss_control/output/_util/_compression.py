@@ -0,0 +1,221 @@
+"""Thread pool that compresses and writes zarr chunks off the acquisition thread."""
+
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Hashable, Literal
+
+if TYPE_CHECKING:
+    import numpy as np
+    import zarr
+    from numcodecs.abc import Codec
+
+SHUFFLES = {"noshuffle": 0, "shuffle": 1, "bitshuffle": 2}
+
+
+@dataclass
+class CompressionStats:
+    """Compression statistics for one position array."""
+
+    writes: int = 0
+    raw_bytes: int = 0
+    stored_bytes: int = 0
+    first_submit: float = 0.0
+    last_done: float = 0.0
+
+    @property
+    def ratio(self) -> float:
+        """Uncompressed / compressed size of the data written so far."""
+        return self.raw_bytes / self.stored_bytes if self.stored_bytes else 0.0
+
+    @property
+    def mb_per_s(self) -> float:
+        """Uncompressed MB/s from the first submitted write to the last finished one."""
+        elapsed = self.last_done - self.first_submit
+        return self.raw_bytes / 1e6 / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.writes} writes, {self.raw_bytes / 1e6:.1f} MB, "
+            f"ratio {self.ratio:.2f}, {self.mb_per_s:.1f} MB/s"
+        )
+
+
+class CompressionPipeline:
+    """Compress and write zarr data in a pool of worker threads.
+
+    The zarr arrays are created with a Blosc `compressor` and every write to them is
+    submitted to the pool, so that the encoding (which releases the GIL) runs in
+    parallel on several cores and not on the thread that delivers the frames.
+    Bitshuffle before zstd works well for the 12/16 bit data of the Prime.
+
+    Writes submitted with the same `lane`, e.g. the chunks of one shard, which are
+    read, modified and written back as a whole, run one after the other in the same
+    worker.  The threads are stopped by `shutdown` and started again by the next
+    `submit`, so the pipeline can be shut down at the end of every sequence.
+
+    Parameters
+    ----------
+    cname : str
+        Blosc compressor name, e.g. "zstd", "lz4".
+    clevel : int
+        Compression level.
+    shuffle : {"noshuffle", "shuffle", "bitshuffle"}
+        Blosc shuffle filter.
+    max_workers : int | None
+        Number of writer threads. Default is the number of cores minus one, so that
+        one is left for acquisition and display.
+    max_pending : int | None
+        Maximum number of writes in flight. `submit` blocks if this is reached.
+        Default is four per worker.
+    """
+
+    def __init__(
+        self,
+        cname: str = "zstd",
+        clevel: int = 5,
+        shuffle: Literal["noshuffle", "shuffle", "bitshuffle"] = "bitshuffle",
+        max_workers: int | None = None,
+        max_pending: int | None = None,
+    ) -> None:
+        try:
+            from numcodecs import Blosc
+        except ImportError as e:  # pragma: no cover
+            raise ImportError(
+                "numcodecs is required for compression. "
+                "Install with `pip install numcodecs`"
+            ) from e
+
+        # to recreate the pipeline in another process, see `__reduce__`
+        self._args = (cname, clevel, shuffle, max_workers, max_pending)
+        # Blosc only uses its own threads when called from the main thread, so each
+        # chunk is compressed single-threaded in one of the workers.
+        self.compressor: Codec = Blosc(
+            cname=cname, clevel=clevel, shuffle=SHUFFLES[shuffle]
+        )
+        self.max_workers = max_workers or max(1, (os.cpu_count() or 2) - 1)
+        self._slots = threading.Semaphore(max_pending or 4 * self.max_workers)
+        # started on the first submit
+        self._executor: ThreadPoolExecutor | None = None
+        # single worker executors for writes with a lane
+        self._lanes: list[ThreadPoolExecutor] = []
+        self._lock = threading.Lock()
+        # notified when a write is done
+        self._done = threading.Condition(self._lock)
+        # {future -> (position key, selection, data)} for reads of unwritten data
+        self._pending: dict[Future, tuple[str, tuple, np.ndarray]] = {}
+        self._errors: list[str] = []
+        self.stats: dict[str, CompressionStats] = {}
+
+    def submit(
+        self, key: str, ary: zarr.Array, selection: tuple, data: np.ndarray,
+        lane: Hashable | None = None,
+    ) -> None:
+        """Write `data` to `ary[selection]` in the pool.
+
+        Writes with the same `lane` (not None) are never run concurrently.
+        """
+        self._slots.acquire()
+        with self._lock:
+            stats = self.stats.setdefault(key, CompressionStats())
+            if not stats.writes:
+                stats.first_submit = time.perf_counter()
+            stats.writes += 1
+            stats.raw_bytes += data.nbytes
+            future = self._pool(key, lane).submit(ary.__setitem__, selection, data)
+            self._pending[future] = (key, selection, data)
+        future.add_done_callback(self._on_done)
+
+    def get(self, key: str, index: tuple[int, ...]) -> np.ndarray | None:
+        """Return the plane at `index` of position `key` if it is not written yet."""
+        with self._lock:
+            pending = list(self._pending.values())
+        for pending_key, selection, data in reversed(pending):
+            if pending_key != key:
+                continue
+            local = _local_index(selection, index)
+            if local is not None:
+                return data[local]
+        return None
+
+    def wait(
+        self, arrays: dict[str, zarr.Array] | None = None
+    ) -> dict[str, CompressionStats]:
+        """Wait for all writes, update the compressed sizes and return the stats."""
+        # the done callbacks update the stats, wait for them and not the futures
+        with self._done:
+            self._done.wait_for(lambda: not self._pending)
+        for key, ary in (arrays or {}).items():
+            if key in self.stats:
+                self.stats[key].stored_bytes = _stored_bytes(ary)
+        while self._errors:
+            print("\033[1mERROR while compressing\033[0m", self._errors.pop(0))
+        return self.stats
+
+    def reset(self) -> None:
+        """Clear the statistics, e.g. at the start of a new sequence."""
+        self.stats = {}
+
+    def shutdown(self) -> None:
+        """Wait for all writes and stop the threads."""
+        with self._lock:
+            executors = [*([self._executor] if self._executor else []), *self._lanes]
+            self._executor, self._lanes = None, []
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+    def __reduce__(self) -> tuple:
+        # pickled as its settings, e.g. to be used by a writer in a ProcessWriter
+        return (type(self), self._args)
+
+    def _pool(self, key: str, lane: Hashable | None) -> ThreadPoolExecutor:
+        """The executor for a write, called under the lock."""
+        if lane is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="zarr_compression"
+                )
+            return self._executor
+        if not self._lanes:
+            self._lanes = [
+                ThreadPoolExecutor(1, thread_name_prefix=f"zarr_compression_lane{i}")
+                for i in range(self.max_workers)
+            ]
+        return self._lanes[hash((key, lane)) % len(self._lanes)]
+
+    def _on_done(self, future: Future) -> None:
+        if (error := future.exception()) is not None:
+            self._errors.append(repr(error))
+        with self._done:
+            key, _, _ = self._pending.pop(future)
+            self.stats[key].last_done = time.perf_counter()
+            self._done.notify_all()
+        self._slots.release()
+
+
+def _stored_bytes(ary: zarr.Array) -> int:
+    """Size of the array on disk, including nested chunk directories."""
+    store_path = getattr(ary.store, "path", None)
+    if store_path is None:
+        return ary.nbytes_stored
+    total = 0
+    for root, _, files in os.walk(os.path.join(store_path, ary.path)):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def _local_index(selection: tuple, index: tuple[int, ...]) -> tuple[int, ...] | None:
+    """Index of `index` inside the block written to `selection`, None if outside."""
+    local: list[int] = []
+    for sel, i in zip(selection, index):
+        if isinstance(sel, slice):
+            if not sel.start <= i < sel.stop:
+                return None
+            local.append(i - sel.start)
+        elif sel != i:
+            return None
+    return tuple(local)
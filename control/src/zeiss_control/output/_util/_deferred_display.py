@@ -0,0 +1,87 @@
+"""Hold frames the viewers can't show yet and show them later, in order."""
+
+from __future__ import annotations
+
+from collections import deque
+from typing import TYPE_CHECKING, Any, Callable
+
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+if TYPE_CHECKING:
+    from qtpy.QtCore import QObject
+
+
+class DeferredDisplay(QtCore.QObject):
+    """Queue of frames waiting for the viewer, replayed by a single timer.
+
+    A frame that arrives before the viewer is ready, or before its slider, channel
+    or image exist, is `defer`red.  `interval` ms after the first deferred frame,
+    `prepare(items)` is called once with all waiting frames, so the viewer can
+    create what is missing for all of them at once, and then `display(item)` is
+    called for every frame in the order they arrived, then `after()` once, e.g. to
+    update the canvas.  Every frame is replayed once per tick, a frame that still
+    can't be shown is deferred again by `display`.
+
+    While frames are waiting, newer frames should be deferred as well (check
+    `len(deferred)`), so that they are not overwritten by the older ones.
+    `depth_changed` is emitted with the number of waiting frames.
+    """
+
+    depth_changed = Signal(int)
+
+    def __init__(
+        self,
+        display: Callable[[Any], None],
+        prepare: Callable[[list[Any]], None] | None = None,
+        after: Callable[[], None] | None = None,
+        interval: int = 100,
+        parent: QObject | None = None,
+    ) -> None:
+        super().__init__(parent)
+        self._display = display
+        self._prepare = prepare
+        self._after = after
+        self.deferred = 0
+        self.replayed = 0
+        self.max_depth = 0
+        self._queue: deque[Any] = deque()
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self._on_timer)
+
+    def defer(self, item: Any) -> None:
+        self._queue.append(item)
+        self.deferred += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        if not self._timer.isActive():
+            self._timer.start()
+        self.depth_changed.emit(len(self._queue))
+
+    def clear(self) -> None:
+        """Drop the waiting frames and reset the counters."""
+        self._queue.clear()
+        self._timer.stop()
+        self.deferred = self.replayed = self.max_depth = 0
+        self.depth_changed.emit(0)
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def _on_timer(self) -> None:
+        pending, self._queue = self._queue, deque()
+        if self._prepare is not None:
+            self._prepare(list(pending))
+        for item in pending:
+            self._display(item)
+        self.replayed += len(pending)
+        if self._after is not None:
+            self._after()
+        self.depth_changed.emit(len(self._queue))
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self)} frames waiting, {self.deferred} deferred, "
+            f"{self.replayed} replayed, at most {self.max_depth} waiting"
+        )
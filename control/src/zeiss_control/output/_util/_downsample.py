@@ -0,0 +1,125 @@
+"""Upload frames at the resolution they are displayed at."""
+
+from __future__ import annotations
+
+import math
+import weakref
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+from vispy.util.transforms import scale
+
+if TYPE_CHECKING:
+    from vispy.scene import SceneCanvas, ViewBox
+    from vispy.scene.visuals import Image
+
+
+class DisplayDownsampler:
+    """Stride frames down to the screen resolution before they go to the GPU.
+
+    When the view shows more image pixels than the canvas has screen pixels (small
+    widgets, zoomed out mosaics), only every `step`-th pixel in x and y is uploaded
+    and the transform of the image is scaled by `step`, so it still covers the same
+    area.  `step` is the largest power of two of image pixels per screen pixel, so
+    it only changes every factor of two of zoom, and is 1 when zoomed in.  Striding
+    keeps the value of the pixels shown, the hover readout stays exact.
+
+    Images whose pixels already cover several scene pixels, like the pages of a
+    `ChannelMosaic`, are strided less: the stride of an image is the largest power
+    of two of its own pixels per screen pixel.
+
+    The last full resolution frame of every image is kept (`frame`), when the zoom
+    changes `step` the images are uploaded again from it.  A transform that is
+    replaced or changed after the image was downsampled, e.g. for a new frame size,
+    is taken as the new transform at step 1 by the next `set_data`.
+
+    ```python
+    downsampler = DisplayDownsampler(view, canvas)
+    image.transform = position  # set the transform first
+    downsampler.set_data(image, frame)
+    ```
+    """
+
+    def __init__(self, view: ViewBox, canvas: SceneCanvas, max_step: int = 64) -> None:
+        self.view = view
+        self.canvas = canvas
+        self.max_step = max_step
+        self.step = 1
+        # scene pixels per screen pixel
+        self.ratio = 1.0
+        # {image -> [full resolution frame, transform matrix at step 1, step shown,
+        #            transform, matrix set on it]}
+        self._images: weakref.WeakKeyDictionary[Image, list[Any]] = (
+            weakref.WeakKeyDictionary()
+        )
+        self.view.scene.transform.changed.connect(self._on_view_changed)
+
+    def set_data(self, image: Image, img: np.ndarray) -> None:
+        """Show `img` in `image` at the current step."""
+        transform = image.transform
+        entry = self._images.get(image)
+        if (
+            entry is None
+            or entry[3] is not transform
+            or not np.array_equal(transform.matrix, entry[4])
+        ):
+            # new image, or the transform was set from outside since
+            matrix = transform.matrix.copy()
+            entry = [img, matrix, 1, transform, matrix]
+            self._images[image] = entry
+        entry[0] = img
+        step = self._step(entry[1])
+        if entry[2] != step:
+            transform.matrix = scale((step, step, 1)) @ entry[1]
+            entry[2], entry[4] = step, transform.matrix.copy()
+        image.set_data(img[..., ::step, ::step] if step > 1 else img)
+
+    def frame(self, image: Image) -> np.ndarray | None:
+        """Last full resolution frame shown in `image`."""
+        entry = self._images.get(image)
+        return None if entry is None else entry[0]
+
+    def stride(self, image: Image) -> int:
+        """Step `image` is currently shown at, 1 if it is not downsampled."""
+        entry = self._images.get(image)
+        return 1 if entry is None else entry[2]
+
+    def update_step(self) -> bool:
+        """Recompute the step for the current view, True if it changed."""
+        rect = self.view.camera.rect
+        width, height = (max(1, x * self.canvas.pixel_scale) for x in self.view.size)
+        ratio = min(abs(rect.width) / width, abs(rect.height) / height)
+        steps = [self._step(entry[1], ratio) for entry in self._images.values()]
+        self.ratio = ratio
+        step = _power_of_two(min(ratio, self.max_step))
+        if step == self.step and all(
+            s == entry[2] for s, entry in zip(steps, self._images.values())
+        ):
+            return False
+        self.step = step
+        return True
+
+    def _step(self, matrix: np.ndarray, ratio: float | None = None) -> int:
+        """Step for an image with the transform `matrix` at step 1."""
+        ratio = self.ratio if ratio is None else ratio
+        # scene pixels per image pixel
+        texel = math.hypot(matrix[0, 0], matrix[0, 1]) or 1.0
+        return _power_of_two(min(ratio / texel, self.max_step))
+
+    def refresh(self) -> None:
+        """Upload all images again at the current step."""
+        for image, entry in list(self._images.items()):
+            self.set_data(image, entry[0])
+
+    def _on_view_changed(self, event: Any = None) -> None:
+        if self.update_step():
+            self.refresh()
+            self.canvas.update()
+
+
+def _power_of_two(ratio: float) -> int:
+    """Largest power of two <= `ratio`, at least 1."""
+    step = 1
+    while step * 2 <= ratio:
+        step *= 2
+    return step
@@ -6,11 +6,15 @@ import superqt
 from fonticon_mdi6 import MDI6
 from qtpy import QtCore, QtWidgets
 from superqt.fonticon import icon
+from zeiss_control.output._util._projection import PROJECTIONS
 
 FIXED = QtWidgets.QSizePolicy.Policy.Fixed
 
 
 class QLabeledSlider(superqt.QLabeledSlider):
+    # "plane" or one of PROJECTIONS along this dimension
+    projectionChanged = QtCore.Signal(str)
+
     def __init__(
         self,
         name: str = "",
@@ -37,12 +41,23 @@ class QLabeledSlider(superqt.QLabeledSlider):
         self.lock_btn.setMaximumWidth(24)
         self.lock_btn.toggled.connect(self._on_lock_toggled)
 
+        self.projection_combo = QtWidgets.QComboBox(self)
+        self.projection_combo.addItems(["plane", *PROJECTIONS])
+        self.projection_combo.setToolTip(f"Show a projection along {name}")
+        self.projection_combo.currentTextChanged.connect(self.projectionChanged)
+        self.projection_combo.setVisible(name in ("t", "z"))
+
         layout = cast(QtWidgets.QBoxLayout, self.layout())
         layout.insertWidget(0, self.play_btn, 0, QtCore.Qt.AlignmentFlag.AlignRight)
         layout.insertWidget(0, name_label)
         # FIXME: the padding/vertical alignment is a bit off here
         layout.addWidget(self._length_label, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
         layout.addWidget(self.lock_btn, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
+        layout.addWidget(self.projection_combo, 0, QtCore.Qt.AlignmentFlag.AlignVCenter)
+
+    @property
+    def projection(self) -> str:
+        return self.projection_combo.currentText()
 
     def _on_play_toggled(self, state: bool) -> None:
         if state:
@@ -59,10 +74,14 @@ class QLabeledSlider(superqt.QLabeledSlider):
             self.lock_btn.setIcon(icon(MDI6.lock_open_outline, color="gray"))
 
     def timerEvent(self, e: QtCore.QTimerEvent) -> None:
-        self.setValue((self.value() + 1) % self.maximum())
+        # wrap around to the minimum, which is not 0 for a sliding window of timepoints
+        if self.value() < self.maximum():
+            self.setValue(self.value() + 1)
+        else:
+            self.setValue(self.minimum())
 
     def _on_range_changed(self, min_: int, max_: int) -> None:
-        self._length_label.setText(f"/ {max_}")
+        self._length_label.setText(f"/ {max_}" if not min_ else f"/ {min_}-{max_}")
 
 
 class LabeledVisibilitySlider(QLabeledSlider):
@@ -0,0 +1,120 @@
+"""Append-only JSON Lines sink for per-frame metadata."""
+
+from __future__ import annotations
+
+import json
+import queue
+import threading
+from array import array
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from typing import Iterator
+
+
+def _to_json(obj: Any) -> Any:
+    """Fallback for objects json can't serialize, e.g. the MDAEvent."""
+    if hasattr(obj, "json"):  # pydantic models
+        return json.loads(obj.json(exclude={"sequence"}, exclude_defaults=True))
+    if hasattr(obj, "tolist"):  # numpy scalars and arrays
+        return obj.tolist()
+    return str(obj)
+
+
+class FrameMetadataSink:
+    """Write frame metadata records to a JSON Lines file in a background thread.
+
+    Each call to `append` puts the record in a queue and returns immediately.  The
+    writer thread serializes the records, appends them as one line each
+    (`{"key": <position key>, "meta": <record>}`) and flushes the file whenever the
+    queue runs empty, so that a crash loses at most the records still in the queue.
+    The byte offset of every record is kept per key (8 bytes per frame) and written
+    to `<name>.index.json` by `close`, which allows `records` and `consolidate` to
+    read the records of one position without parsing the whole file.
+
+    Parameters
+    ----------
+    path : str | Path
+        The JSON Lines file to write, it is overwritten. Parent folders are created.
+    """
+
+    _STOP = object()
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self.index_path = self.path.with_suffix(".index.json")
+        self._queue: queue.Queue = queue.Queue()
+        self._offsets: dict[str, array] = {}
+        self._errors: list[str] = []
+        self._thread = threading.Thread(
+            target=self._run, name="FrameMetadataSink", daemon=True
+        )
+        self._thread.start()
+
+    def append(self, key: str, record: dict) -> None:
+        """Queue `record` for position `key` to be written."""
+        self._queue.put((key, record))
+
+    def close(self) -> Path:
+        """Write all queued records, the index, and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        index = {
+            key: {"count": len(offsets), "offsets": offsets.tolist()}
+            for key, offsets in self._offsets.items()
+        }
+        with open(self.index_path, "w") as file:
+            json.dump({"file": self.path.name, "positions": index}, file)
+        while self._errors:
+            print("\033[1mERROR while writing metadata\033[0m", self._errors.pop(0))
+        return self.index_path
+
+    @property
+    def keys(self) -> list[str]:
+        return list(self._offsets)
+
+    def count(self, key: str) -> int:
+        """Number of records written for `key`."""
+        return len(self._offsets.get(key, ()))
+
+    def records(self, key: str) -> Iterator[dict]:
+        """Read back the records written for `key`, in order."""
+        with open(self.path, "rb") as file:
+            for offset in self._offsets.get(key, ()):
+                file.seek(offset)
+                yield json.loads(file.readline())["meta"]
+
+    def consolidate(self, path: str | Path) -> Path:
+        """Write all records as one JSON `{key: [records]}`, one position at a time."""
+        path = Path(path)
+        with open(path, "w") as out:
+            out.write("{")
+            for i, key in enumerate(self._offsets):
+                out.write(",\n" if i else "\n")
+                out.write(f"{json.dumps(key)}: [")
+                for j, record in enumerate(self.records(key)):
+                    out.write(",\n  " if j else "\n  ")
+                    out.write(json.dumps(record))
+                out.write("\n]")
+            out.write("\n}\n")
+        return path
+
+    def _run(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "wb") as file:
+            while True:
+                item = self._queue.get()
+                if item is self._STOP:
+                    break
+                key, record = item
+                try:
+                    line = json.dumps({"key": key, "meta": record}, default=_to_json)
+                except (TypeError, ValueError) as e:
+                    self._errors.append(repr(e))
+                    continue
+                self._offsets.setdefault(key, array("q")).append(file.tell())
+                file.write(line.encode() + b"\n")
+                if self._queue.empty():
+                    file.flush()
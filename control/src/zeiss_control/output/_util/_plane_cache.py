@@ -0,0 +1,79 @@
+"""Byte-budgeted LRU cache of decoded planes."""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+import numpy as np
+
+
+class PlaneCache:
+    """Keep the most recently used planes in memory, up to `max_bytes`.
+
+    Planes are stored read-only.  `put` for a key that is already cached replaces
+    the plane, so a frame written again at the same index never returns stale data.
+    All methods are thread-safe.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024**2) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._planes: OrderedDict[Hashable, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> np.ndarray | None:
+        with self._lock:
+            plane = self._planes.get(key)
+            if plane is None:
+                self.misses += 1
+                return None
+            self._planes.move_to_end(key)
+            self.hits += 1
+            return plane
+
+    def peek(self, key: Hashable) -> np.ndarray | None:
+        """The plane for `key` if cached, without counting it or making it recent."""
+        return self._planes.get(key)
+
+    def put(self, key: Hashable, plane: np.ndarray) -> None:
+        """Cache `plane` for `key`. Keep a reference, so the plane must not change."""
+        if plane.nbytes > self.max_bytes:
+            self.invalidate(key)
+            return
+        plane = plane.view()
+        plane.flags.writeable = False
+        with self._lock:
+            if (old := self._planes.pop(key, None)) is not None:
+                self.nbytes -= old.nbytes
+            self._planes[key] = plane
+            self.nbytes += plane.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._planes.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if (old := self._planes.pop(key, None)) is not None:
+                self.nbytes -= old.nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._planes.clear()
+            self.nbytes = 0
+            self.hits = self.misses = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._planes
+
+    def __len__(self) -> int:
+        return len(self._planes)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self)} planes, {self.nbytes / 1e6:.0f}/{self.max_bytes / 1e6:.0f} MB,"
+            f" {self.hits} hits, {self.misses} misses"
+        )
@@ -0,0 +1,191 @@
+"""Background loading of the planes ahead of a slider."""
+
+from __future__ import annotations
+
+import math
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Callable
+
+from ._plane_cache import PlaneCache
+
+if TYPE_CHECKING:
+    import numpy as np
+
+    # (t, z, c, g)
+    PlaneKey = tuple[int, int, int, int]
+
+DIMS = ("t", "z", "c", "g")
+
+
+class SlicePrefetcher:
+    """Load the planes the user is about to scrub to in a worker thread.
+
+    `follow` is called with every move of the sliders.  For each slider that moved,
+    the speed and direction are estimated from its last moves and the next
+    `lookahead` seconds of planes in that direction (at least 1, at most `depth`)
+    plus `behind` planes in the opposite direction are requested for all (c, g)
+    images shown.  Every call to `follow` replaces the planes wanted and the worker
+    drops the requests that are not wanted anymore, so after a jump nothing is loaded
+    for the old position.  Planes that are still wanted stay queued.
+
+    `fetch` returns a prefetched plane or loads it synchronously.  Planes are kept in
+    `cache`, if None the `load` function is expected to cache itself (like
+    `QOMEZarrDatastore.get_frame`) and `fetch` just calls `load`.  When a plane is
+    written after it was loaded, e.g. during the acquisition, `invalidate` it.
+
+    Parameters
+    ----------
+    load : Callable[[PlaneKey], np.ndarray]
+        Load the plane at (t, z, c, g). Called from the worker thread.
+    depth : int
+        Maximum number of planes ahead.
+    behind : int
+        Planes loaded in the opposite direction, for moving back and forth.
+    lookahead : float
+        Seconds of slider movement at the current speed to load ahead.
+    cache : PlaneCache | None
+        Where to keep the prefetched planes.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[PlaneKey], np.ndarray],
+        depth: int = 8,
+        behind: int = 2,
+        lookahead: float = 0.5,
+        cache: PlaneCache | None = None,
+    ) -> None:
+        self.load = load
+        self.depth = depth
+        self.behind = behind
+        self.lookahead = lookahead
+        self.cache = cache
+        self.requested = 0
+        self.loaded = 0
+        self.dropped = 0
+
+        # {dim -> (time, value) of the last move}
+        self._last_move: dict[str, tuple[float, int]] = {}
+        # planes per second, signed
+        self._velocity: dict[str, float] = {}
+        # None stops the worker
+        self._queue: queue.Queue[PlaneKey | None] = queue.Queue()
+        self._lock = threading.Lock()
+        # planes requested by the last `follow`, queued or loaded already
+        self._wanted: set[PlaneKey] = set()
+        # plane the worker is loading, and whether it was invalidated meanwhile
+        self._loading: PlaneKey | None = None
+        self._stale = False
+        self._thread = threading.Thread(
+            target=self._run, name="SlicePrefetcher", daemon=True
+        )
+        self._thread.start()
+
+    def follow(
+        self,
+        moves: dict[str, tuple[int, int]],
+        index: dict[str, int],
+        images: list[tuple[int, int]],
+    ) -> None:
+        """The sliders moved, request the planes around the new position.
+
+        `moves` is {dim -> (value, maximum)} of the sliders that moved, with the last
+        valid value of the slider, `index` the current display index and `images`
+        the (c, g) of the images shown.
+        """
+        now = time.perf_counter()
+        keys: dict[PlaneKey, None] = {}
+        for dim, (value, maximum) in moves.items():
+            for target in self._targets(dim, value, now):
+                if not 0 <= target <= maximum:
+                    continue
+                for c, g in images:
+                    plane = {**index, dim: target, "c": c, "g": g}
+                    keys[tuple(plane.get(d, 0) for d in DIMS)] = None
+        with self._lock:
+            new = [key for key in keys if key not in self._wanted]
+            self._wanted = set(keys)
+        for key in new:
+            self._queue.put(key)
+        self.requested += len(new)
+
+    def _targets(self, dim: str, value: int, now: float) -> list[int]:
+        """Values of `dim` to load around `value`, in the order to load them."""
+        last_time, last_value = self._last_move.get(dim, (now, value))
+        self._last_move[dim] = (now, value)
+        step = value - last_value
+        if step and now > last_time:
+            # smooth the speed over a few moves, the slider events are irregular
+            speed = step / (now - last_time)
+            self._velocity[dim] = 0.5 * self._velocity.get(dim, speed) + 0.5 * speed
+        velocity = self._velocity.get(dim, 1.0)
+        direction = 1 if velocity >= 0 else -1
+        ahead = min(self.depth, max(1, math.ceil(abs(velocity) * self.lookahead)))
+        offsets = [direction * i for i in range(ahead + 1)]
+        offsets += [-direction * i for i in range(1, self.behind + 1)]
+        return [value + offset for offset in offsets]
+
+    def fetch(self, key: PlaneKey) -> np.ndarray:
+        """The plane at (t, z, c, g), from the cache if it was prefetched."""
+        if self.cache is not None:
+            if (plane := self.cache.get(key)) is not None:
+                return plane
+            plane = self.load(key)
+            self.cache.put(key, plane)
+            return plane
+        return self.load(key)
+
+    def invalidate(self, key: PlaneKey) -> None:
+        """Forget the plane at `key`, it changed.  Also if it is being loaded."""
+        with self._lock:
+            # requested again by the next `follow`
+            self._wanted.discard(key)
+            if key == self._loading:
+                self._stale = True
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    def cancel(self) -> None:
+        """Drop all pending requests, e.g. at the start of a new sequence."""
+        with self._lock:
+            self._wanted.clear()
+        self._last_move.clear()
+        self._velocity.clear()
+        if self.cache is not None:
+            self.cache.clear()
+
+    def close(self) -> None:
+        """Stop the worker thread."""
+        self.cancel()
+        self._queue.put(None)
+
+    def _run(self) -> None:
+        while True:
+            key = self._queue.get()
+            if key is None:
+                return
+            with self._lock:
+                if key not in self._wanted:
+                    self.dropped += 1
+                    continue
+                if self.cache is not None and key in self.cache:
+                    continue
+                self._loading, self._stale = key, False
+            try:
+                plane = self.load(key)
+            except (KeyError, IndexError):
+                # not acquired (yet)
+                continue
+            except Exception as e:
+                print("\033[1mERROR while prefetching\033[0m", key, repr(e))
+                continue
+            finally:
+                with self._lock:
+                    self._loading, stale = None, self._stale
+            if stale:
+                continue
+            if self.cache is not None:
+                self.cache.put(key, plane)
+            self.loaded += 1
@@ -0,0 +1,298 @@
+"""Run a frame writer in a separate process, fed through shared memory."""
+
+from __future__ import annotations
+
+import multiprocessing as mp
+import queue
+import threading
+import time
+from array import array
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import TYPE_CHECKING, Any
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from pymmcore_plus import CMMCorePlus
+    from useq import MDAEvent, MDASequence
+
+    from zeiss_control.backend.frame_hub import FrameHub
+
+
+@dataclass
+class WriteLatency:
+    """End-to-end latency from `frameReady` to the acknowledgement of the writer."""
+
+    frames: int = 0
+    mean_ms: float = 0.0
+    p99_ms: float = 0.0
+    max_ms: float = 0.0
+    # number of frames that had to wait for a free slot
+    waits: int = 0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.frames} frames, latency mean {self.mean_ms:.1f} ms, "
+            f"p99 {self.p99_ms:.1f} ms, max {self.max_ms:.1f} ms, "
+            f"{self.waits} waits for a free slot"
+        )
+
+
+class ProcessWriter:
+    """Writer that runs `writer_cls(**writer_kwargs)` in a child process.
+
+    Compression and file IO then no longer compete for the GIL with the GUI, the
+    viewers and the analysers.  Every frame is copied into one of `n_slots` shared
+    memory slots and only the slot number and the event are sent to the child, which
+    calls `frameReady(frame, event, meta)` of the writer on a read-only view of the
+    slot and acknowledges the slot when it is done.  If all slots are in use,
+    `frameReady` waits for the writer, at most `timeout` seconds, and raises if the
+    child process died.  The shared memory is released when the writer finished the
+    sequence and allocated again for the first frame of the next one.  The process
+    can be kept for many sequences, `configure` replaces the writer (e.g. for a new
+    folder) before the next one, and is stopped by `close`.
+
+    The writer gets `sequenceStarted(seq)`, `frameReady(frame, event, meta)` and
+    `sequenceFinished(seq)` like when connected to the MDA directly, so
+    `OMEZarrWriter` (the default) and `CoreOMETiffWriter` (without `mmcore`) can be
+    used.  The writer class and its arguments have to be picklable.  The latency from
+    `frameReady` to the acknowledgement is reported at the end of each sequence and
+    kept in `latency`.
+
+    Parameters
+    ----------
+    mmcore : CMMCorePlus | None
+        If given, the MDA signals of this core are connected.
+    writer_cls : type
+        The writer to create in the child process. Default is `OMEZarrWriter`.
+    writer_kwargs : dict | None
+        Keyword arguments for `writer_cls`.
+    n_slots : int
+        Number of frames that can be in flight.
+    frame_source : FrameHub | None
+        Receive the frames from this FrameHub instead of the MDA runner.
+    timeout : float
+        Seconds `frameReady` waits for a free slot before it raises.
+    """
+
+    def __init__(
+        self,
+        mmcore: CMMCorePlus | None = None,
+        writer_cls: type | None = None,
+        writer_kwargs: dict[str, Any] | None = None,
+        n_slots: int = 16,
+        frame_source: FrameHub | None = None,
+        timeout: float = 30,
+    ) -> None:
+        if writer_cls is None:
+            from .zarr_saver import OMEZarrWriter
+
+            writer_cls = OMEZarrWriter
+        self.n_slots = n_slots
+        self.timeout = timeout
+        self.latency = WriteLatency()
+        self.errors: list[str] = []
+
+        self._shm: list[shared_memory.SharedMemory] = []
+        self._slots: list[np.ndarray] = []
+        self._free: queue.Queue[int] = queue.Queue()
+        self._submitted: dict[int, float] = {}
+        self._latencies = array("d")
+        self._finished = threading.Event()
+
+        ctx = mp.get_context("spawn")
+        self._commands = ctx.Queue()
+        self._acks = ctx.Queue()
+        self._process = ctx.Process(
+            target=_serve,
+            args=(writer_cls, writer_kwargs or {}, self._commands, self._acks),
+            name="ProcessWriter",
+            daemon=True,
+        )
+        self._process.start()
+        self._ack_thread = threading.Thread(
+            target=self._receive_acks, name="ProcessWriter acks", daemon=True
+        )
+        self._ack_thread.start()
+
+        self._mmc = mmcore
+        self._frame_source = frame_source
+        if mmcore is not None:
+            mmcore.mda.events.sequenceStarted.connect(self.sequenceStarted)
+            mmcore.mda.events.sequenceFinished.connect(self.sequenceFinished)
+            if frame_source is None:
+                mmcore.mda.events.frameReady.connect(self.frameReady)
+        if frame_source is not None:
+            frame_source.connect(self.frameReady, "ProcessWriter")
+
+    def sequenceStarted(self, seq: MDASequence) -> None:
+        self.latency = WriteLatency()
+        self._latencies = array("d")
+        self._finished.clear()
+        self._commands.put(("start", seq))
+
+    def configure(self, **writer_kwargs: Any) -> None:
+        """Replace the writer by `writer_cls(**writer_kwargs)`, between sequences."""
+        self._commands.put(("writer", writer_kwargs))
+
+    def frameReady(
+        self, frame: np.ndarray, event: MDAEvent, meta: dict | None = None
+    ) -> None:
+        """Copy the frame to a free slot and send it to the writer."""
+        if not self._slots or (
+            self._slots[0].shape != frame.shape or self._slots[0].dtype != frame.dtype
+        ):
+            self._allocate(frame.shape, frame.dtype)
+        try:
+            slot = self._free.get_nowait()
+        except queue.Empty:
+            self.latency.waits += 1
+            slot = self._take_slot()
+        self._submitted[slot] = time.perf_counter()
+        np.copyto(self._slots[slot], frame)
+        # the sequence is known to the writer, no need to send it with every frame
+        self._commands.put(("frame", slot, event.replace(sequence=None), meta or {}))
+
+    def sequenceFinished(
+        self, seq: MDASequence | None = None, timeout: float = 60
+    ) -> None:
+        """Wait until the writer finished the sequence and report the latency."""
+        self._commands.put(("finish", seq))
+        if self._finished.wait(timeout):
+            # all frames are acknowledged, the slots are not used anymore
+            self._release_slots()
+        else:
+            print("\033[1mProcessWriter did not finish in time\033[0m")
+        print("ProcessWriter:", self.latency)
+        while self.errors:
+            print("\033[1mERROR in ProcessWriter\033[0m", self.errors.pop(0))
+
+    def close(self, timeout: float = 60) -> None:
+        """Stop the child process and free the shared memory."""
+        if self._process.is_alive():
+            self._commands.put(("stop",))
+            self._process.join(timeout)
+        self._acks.put(("stop", None, None))
+        self._ack_thread.join()
+        self._release_slots()
+
+    # -------------------- private --------------------
+
+    def _allocate(self, shape: tuple[int, ...], dtype: np.dtype) -> None:
+        """Wait for all frames in flight and (re)allocate the slots."""
+        for _ in range(len(self._slots)):
+            self._take_slot()
+        self._release_slots()
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self._shm = [
+            shared_memory.SharedMemory(create=True, size=nbytes)
+            for _ in range(self.n_slots)
+        ]
+        self._slots = [
+            np.ndarray(shape, dtype, buffer=shm.buf) for shm in self._shm
+        ]
+        self._commands.put(
+            ("slots", [shm.name for shm in self._shm], shape, np.dtype(dtype).str)
+        )
+        for slot in range(self.n_slots):
+            self._free.put(slot)
+
+    def _take_slot(self) -> int:
+        """Wait for a free slot, raise if the child process died or `timeout`."""
+        deadline = time.perf_counter() + self.timeout
+        while True:
+            try:
+                return self._free.get(timeout=min(1.0, self.timeout))
+            except queue.Empty:
+                if not self._process.is_alive():
+                    raise RuntimeError(
+                        f"ProcessWriter process died (exit code "
+                        f"{self._process.exitcode})"
+                    ) from None
+                if time.perf_counter() > deadline:
+                    raise TimeoutError(
+                        f"ProcessWriter had no free slot for {self.timeout} s"
+                    ) from None
+
+    def _release_slots(self) -> None:
+        """Free the shared memory, only when no frame is in flight."""
+        self._slots = []
+        while True:
+            try:
+                self._free.get_nowait()
+            except queue.Empty:
+                break
+        if self._shm and self._process.is_alive():
+            self._commands.put(("release",))
+        for shm in self._shm:
+            shm.close()
+            shm.unlink()
+        self._shm = []
+
+    def _receive_acks(self) -> None:
+        while True:
+            command, slot, error = self._acks.get()
+            if command == "stop":
+                return
+            if error is not None:
+                self.errors.append(error)
+            if command == "frame":
+                self._record(time.perf_counter() - self._submitted.pop(slot))
+                self._free.put(slot)
+            elif command == "finish":
+                if self._latencies:
+                    self.latency.p99_ms = float(np.percentile(self._latencies, 99))
+                self._finished.set()
+
+    def _record(self, seconds: float) -> None:
+        self._latencies.append(seconds * 1000)
+        latency = self.latency
+        latency.frames = len(self._latencies)
+        latency.mean_ms += (self._latencies[-1] - latency.mean_ms) / latency.frames
+        latency.max_ms = max(latency.max_ms, self._latencies[-1])
+
+
+def _serve(writer_cls: type, writer_kwargs: dict, commands: Any, acks: Any) -> None:
+    """Main loop of the child process."""
+    writer = writer_cls(**writer_kwargs)
+    shms: list[shared_memory.SharedMemory] = []
+    slots: list[np.ndarray] = []
+    while True:
+        command, *args = commands.get()
+        if command == "stop":
+            break
+        if command == "release":
+            slots = []
+            for shm in shms:
+                shm.close()
+            shms = []
+            continue
+        error = None
+        try:
+            if command == "slots":
+                names, shape, dtype = args
+                slots = []
+                for shm in shms:
+                    shm.close()
+                shms = [shared_memory.SharedMemory(name=name) for name in names]
+                slots = [np.ndarray(shape, dtype, buffer=shm.buf) for shm in shms]
+                for slot in slots:
+                    # writers that keep the frame have to copy it
+                    slot.flags.writeable = False
+                continue
+            if command == "writer":
+                writer = writer_cls(**args[0])
+            elif command == "start":
+                writer.sequenceStarted(args[0])
+            elif command == "frame":
+                slot, event, meta = args
+                writer.frameReady(slots[slot], event, meta)
+            elif command == "finish":
+                writer.sequenceFinished(args[0])
+        except Exception as e:
+            error = repr(e)
+        acks.put((command, args[0] if command == "frame" else None, error))
+    slots = []
+    for shm in shms:
+        shm.close()
@@ -0,0 +1,178 @@
+"""Max, mean and min projections, updated with every frame."""
+
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Mapping
+
+import numpy as np
+
+PROJECTIONS = ("max", "mean", "min")
+# the order of the keys of the projections
+DIMS = "ptzcg"
+
+
+class _Accumulator:
+    """Running max, min and sum of the frames of one projection."""
+
+    def __init__(self, frame: np.ndarray) -> None:
+        self.max = np.array(frame)
+        self.min = np.array(frame)
+        # exact for unsigned integer frames, up to 65536 frames of uint16
+        exact = frame.dtype.kind in "bu" and frame.itemsize <= 2
+        self.sum = frame.astype(np.uint32 if exact else np.float64)
+        self.count = 1
+
+    def add(self, frame: np.ndarray) -> None:
+        np.maximum(self.max, frame, out=self.max)
+        np.minimum(self.min, frame, out=self.min)
+        self.sum += frame
+        self.count += 1
+
+    @property
+    def nbytes(self) -> int:
+        return self.max.nbytes + self.min.nbytes + self.sum.nbytes
+
+
+class RunningProjections:
+    """Projections of the frames along `axes`, updated in place as frames arrive.
+
+    `start(sizes)` begins a sequence and keeps only the axes the sequence has more
+    than one frame along.  Every `add`ed frame then updates one accumulator per such
+    axis, the projection along that axis at the frame's other indices, with an
+    in-place `np.maximum`, `np.minimum` and sum, so a projection costs O(1) per
+    frame and never re-reads the stack.  The updates run in a worker thread, `add`
+    only queues the frame, which must not be changed afterwards.  A projection read
+    with `get` can lag behind the frames still queued.
+
+    The accumulators use at most `max_bytes`.  When they don't fit, the projection
+    updated longest ago (e.g. along z at an old timepoint) is dropped and stays
+    unavailable (`get` returns None) rather than becoming a projection of only the
+    later frames.  The same happens to the projections of a frame that finds
+    `max_pending` frames queued already.  The last `max_dropped` of these are
+    remembered.  Thread-safe, the worker is stopped by `shutdown` and started again
+    by the next `add`.
+    """
+
+    def __init__(
+        self,
+        axes: tuple[str, ...] = ("z", "t"),
+        max_bytes: int = 1024**3,
+        max_pending: int = 16,
+        max_dropped: int = 4096,
+    ) -> None:
+        self.axes = axes
+        # the axes of the current sequence, none until `start`
+        self.active: tuple[str, ...] = ()
+        self.max_bytes = max_bytes
+        self.max_dropped = max_dropped
+        self.nbytes = 0
+        self._accumulators: OrderedDict[tuple, _Accumulator] = OrderedDict()
+        # keys of the dropped projections, oldest first
+        self._dropped: OrderedDict[tuple, None] = OrderedDict()
+        # started on the first add
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots = threading.Semaphore(max_pending)
+        self._lock = threading.Lock()
+        # frames queued before a `clear` are not added after it
+        self._generation = 0
+
+    @staticmethod
+    def key(axis: str, index: Mapping[str, int]) -> tuple:
+        return (axis, *(index.get(d, 0) for d in DIMS if d != axis))
+
+    def start(self, sizes: Mapping[str, int]) -> None:
+        """Clear and project along the axes with more than one frame in `sizes`."""
+        self.clear()
+        self.active = tuple(axis for axis in self.axes if sizes.get(axis, 1) > 1)
+
+    def add(self, index: Mapping[str, int], frame: np.ndarray) -> None:
+        """Queue `frame` at `index` to be added to its projections."""
+        if not self.active:
+            return
+        if not self._slots.acquire(blocking=False):
+            # the worker is behind, don't make the acquisition wait for it
+            with self._lock:
+                for axis in self.active:
+                    self._drop(self.key(axis, index))
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix="projections")
+            future = self._executor.submit(
+                self._accumulate, self._generation, self.active, dict(index), frame
+            )
+        future.add_done_callback(self._on_done)
+
+    def get(self, axis: str, mode: str, index: Mapping[str, int]) -> np.ndarray | None:
+        """Projection `mode` along `axis` at `index` (`axis` itself is ignored)."""
+        with self._lock:
+            if (accumulator := self._accumulators.get(self.key(axis, index))) is None:
+                return None
+            if mode == "max":
+                return accumulator.max.copy()
+            if mode == "min":
+                return accumulator.min.copy()
+            if mode == "mean":
+                return (accumulator.sum / accumulator.count).astype(accumulator.max.dtype)
+        raise ValueError(f"Unknown projection {mode!r}, use one of {PROJECTIONS}")
+
+    def count(self, axis: str, index: Mapping[str, int]) -> int:
+        """Number of frames in the projection along `axis` at `index`."""
+        with self._lock:
+            accumulator = self._accumulators.get(self.key(axis, index))
+            return 0 if accumulator is None else accumulator.count
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._accumulators.clear()
+            self._dropped.clear()
+            self.nbytes = 0
+
+    def shutdown(self) -> None:
+        """Wait for the queued frames and stop the worker."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _accumulate(
+        self,
+        generation: int,
+        axes: tuple[str, ...],
+        index: Mapping[str, int],
+        frame: np.ndarray,
+    ) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            for axis in axes:
+                key = self.key(axis, index)
+                if (accumulator := self._accumulators.get(key)) is not None:
+                    accumulator.add(frame)
+                    self._accumulators.move_to_end(key)
+                elif key not in self._dropped:
+                    accumulator = _Accumulator(frame)
+                    self._accumulators[key] = accumulator
+                    self.nbytes += accumulator.nbytes
+            while self.nbytes > self.max_bytes and len(self._accumulators) > 1:
+                key, dropped = self._accumulators.popitem(last=False)
+                self.nbytes -= dropped.nbytes
+                self._drop(key)
+
+    def _drop(self, key: tuple) -> None:
+        if (accumulator := self._accumulators.pop(key, None)) is not None:
+            self.nbytes -= accumulator.nbytes
+        self._dropped[key] = None
+        self._dropped.move_to_end(key)
+        while len(self._dropped) > self.max_dropped:
+            # mostly those of old timepoints, that are not acquired again
+            self._dropped.popitem(last=False)
+
+    def _on_done(self, future: Future) -> None:
+        self._slots.release()
+        if (error := future.exception()) is not None:
+            print("\033[1mERROR while projecting\033[0m", repr(error))
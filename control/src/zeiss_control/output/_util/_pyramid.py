@@ -0,0 +1,115 @@
+"""Incremental multiscale (pyramid) levels for the OME-Zarr writers."""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import zarr
+
+
+def block_mean(plane: np.ndarray, factor: int = 2) -> np.ndarray:
+    """Downsample the last two axes of `plane` by the mean over `factor`² blocks.
+
+    Pixels at the lower/right border that don't fill a complete block are dropped,
+    so the result has shape `(..., y // factor, x // factor)` and the input dtype.
+    """
+    *lead, y, x = plane.shape
+    ny, nx = y // factor, x // factor
+    blocks = plane[..., : ny * factor, : nx * factor].reshape(
+        *lead, ny, factor, nx, factor
+    )
+    mean = blocks.mean(axis=(-3, -1), dtype=np.float32)
+    if np.issubdtype(plane.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(plane.dtype, copy=False)
+
+
+def level_shapes(
+    shape: tuple[int, ...], levels: int, factor: int = 2
+) -> list[tuple[int, int]]:
+    """(y, x) of the levels `block_mean` makes from planes of `shape`.
+
+    At most `levels`, fewer if a level would be empty.
+    """
+    shapes: list[tuple[int, int]] = []
+    # no pixels, only the shapes are computed
+    plane = np.empty((0, *shape[-2:]), np.uint8)
+    for _ in range(levels):
+        plane = block_mean(plane, factor)
+        if 0 in plane.shape[-2:]:
+            break
+        shapes.append(plane.shape[-2:])
+    return shapes
+
+
+class PyramidBuilder:
+    """Compute 2x, 4x, 8x, ... downsampled planes in a worker thread.
+
+    Every plane given to `submit` is downsampled by successive 2x2 block means and
+    each level is handed to `write(level_array, index, data)`.  A single worker keeps
+    the levels of each plane in order, `max_pending` limits the planes waiting.  The
+    worker is stopped by `shutdown` and started again by the next `submit`.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[zarr.Array, tuple, np.ndarray], None],
+        max_pending: int = 64,
+    ) -> None:
+        self._write = write
+        # started on the first submit
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots = threading.Semaphore(max_pending)
+        self._futures: set[Future] = set()
+        self._lock = threading.Lock()
+        # notified when a plane is done
+        self._done = threading.Condition(self._lock)
+        self._errors: list[str] = []
+
+    def submit(
+        self, levels: list[zarr.Array], index: tuple[int, ...], frame: np.ndarray
+    ) -> None:
+        """Downsample `frame` and write it at `index` into each of `levels`."""
+        self._slots.acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(1, thread_name_prefix="zarr_pyramid")
+            future = self._executor.submit(self._build, levels, index, frame)
+            self._futures.add(future)
+        future.add_done_callback(self._on_done)
+
+    def wait(self) -> None:
+        """Wait until all submitted planes are written to all levels."""
+        # the done callbacks collect the errors, wait for them and not the futures
+        with self._done:
+            self._done.wait_for(lambda: not self._futures)
+        while self._errors:
+            print("\033[1mERROR while downsampling\033[0m", self._errors.pop(0))
+
+    def shutdown(self) -> None:
+        """Wait for all planes and stop the worker."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _build(
+        self, levels: list[zarr.Array], index: tuple[int, ...], frame: np.ndarray
+    ) -> None:
+        plane = frame
+        for ary in levels:
+            plane = block_mean(plane, 2)
+            self._write(ary, index, plane)
+
+    def _on_done(self, future: Future) -> None:
+        if (error := future.exception()) is not None:
+            self._errors.append(repr(error))
+        with self._done:
+            self._futures.discard(future)
+            self._done.notify_all()
+        self._slots.release()
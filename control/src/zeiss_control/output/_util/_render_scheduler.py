@@ -0,0 +1,86 @@
+"""Limit how often the viewers render new frames."""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Hashable
+
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+if TYPE_CHECKING:
+    from qtpy.QtCore import QObject
+
+
+class RenderScheduler(QtCore.QObject):
+    """Render new frames at most `max_fps` times per second.
+
+    Frames are `submit`ted with the key of the image they are shown in, e.g. (c, g).
+    Until the next render, a newer frame for the same image replaces the pending one
+    (counted in `skipped`).  At each render, `render(item)` is called for the newest
+    frame of every image (counted in `displayed`) and then `after()` once, e.g. to
+    update the canvas.  `submit` can be called from any thread, rendering always
+    happens in the thread of the scheduler (the GUI thread).
+    """
+
+    _wake = Signal()
+
+    def __init__(
+        self,
+        render: Callable[[Any], None],
+        after: Callable[[], None] | None = None,
+        max_fps: float = 30,
+        parent: QObject | None = None,
+    ) -> None:
+        super().__init__(parent)
+        self._render = render
+        self._after = after
+        self.max_fps = max_fps
+        self.displayed = 0
+        self.skipped = 0
+        self._pending: dict[Hashable, Any] = {}
+        self._lock = threading.Lock()
+        self._last_render = 0.0
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._on_timer)
+        self._wake.connect(self._schedule)
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def submit(self, key: Hashable, item: Any) -> None:
+        with self._lock:
+            if key in self._pending:
+                self.skipped += 1
+            self._pending[key] = item
+        # direct call in the GUI thread, queued from other threads
+        self._wake.emit()
+
+    def _schedule(self) -> None:
+        if not self._timer.isActive():
+            wait = 1 / self.max_fps - (time.perf_counter() - self._last_render)
+            self._timer.start(max(0, int(wait * 1000)))
+
+    def reset(self) -> None:
+        """Drop pending frames and reset the counters."""
+        with self._lock:
+            self._pending.clear()
+        self.displayed = self.skipped = 0
+
+    def _on_timer(self) -> None:
+        self._last_render = time.perf_counter()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for item in pending.values():
+            self._render(item)
+        self.displayed += len(pending)
+        if self._after is not None:
+            self._after()
+        if self._pending and not self._timer.isActive():
+            self._timer.start(int(1000 / self.max_fps))
+
+    def __str__(self) -> str:
+        return f"{self.displayed} frames displayed, {self.skipped} skipped"
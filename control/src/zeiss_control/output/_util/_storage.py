@@ -0,0 +1,398 @@
+"""Frame storage for the local datastore, in memory or memory-mapped on disk."""
+
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, cast
+
+import numpy as np
+import numpy.typing as npt
+
+
+class SegmentedArray:
+    """(t, z, c, g, y, x) frame store made of fixed-size blocks of timepoints.
+
+    Instead of one array that has to be copied whenever the acquisition runs longer
+    than expected, the frames are kept in blocks of `block_size` timepoints.  A block
+    is only allocated when the first frame of its timepoints arrives, and adding
+    timepoints never touches existing blocks.  A (t, z, c, g) index is resolved to its
+    block by `t // block_size`, independent of the number of blocks.
+
+    The sizes of z, c and g are fixed by `shape`.  If a frame arrives outside of
+    them, all blocks are reallocated with the larger size, as this means the shape
+    given did not fit the sequence.  The frame size is set by the first frame.
+
+    With `max_timepoints` and/or `max_bytes`, only the most recent timepoints are
+    kept (ring buffer mode, for acquisitions without a fixed end).  Blocks that are
+    completely older than the window are freed, and their frames are passed to
+    `evict(frame, (t, z, c, g))` first if it is given.  Timepoints before
+    `first_timepoint` read as zeros, frames arriving for them go to `evict` directly.
+
+    Parameters
+    ----------
+    shape : tuple[int, ...]
+        Initial (t, z, c, g, y, x) shape. The t size is only used as the initial
+        number of timepoints.
+    dtype : npt.DTypeLike
+        Data type of the frames.
+    block_size : int | None
+        Timepoints per block. Default is the initial t size, at most 64 and at most
+        a quarter of the timepoints that fit into `max_bytes`.
+    max_timepoints : int | None
+        Number of most recent timepoints to keep. None for no limit.
+    max_bytes : int | None
+        Memory budget for the blocks. None for no limit.
+    evict : Callable[[np.ndarray, tuple[int, int, int, int]], None] | None
+        Called for every frame that is dropped from memory.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, ...],
+        dtype: npt.DTypeLike = np.uint16,
+        block_size: int | None = None,
+        max_timepoints: int | None = None,
+        max_bytes: int | None = None,
+        evict: Callable[[np.ndarray, tuple[int, int, int, int]], None] | None = None,
+    ) -> None:
+        self.dtype = np.dtype(dtype)
+        self.n_timepoints = max(shape[0], 1)
+        self.max_timepoints = max_timepoints
+        self.max_bytes = max_bytes
+        self.evict = evict
+        self.first_timepoint = 0
+        self.last_timepoint = -1
+        self.plane_shape: tuple[int, ...] = tuple(shape[1:4])
+        self.frame_shape: tuple[int, ...] = tuple(shape[4:])
+        self._fixed_block_size = block_size is not None
+        self.block_size = block_size or self._default_block_size()
+        # {block index -> (block_size, z, c, g, y, x) array}
+        self.blocks: dict[int, np.ndarray] = {}
+        # {block index -> (block_size, z, c, g) bool}, frames written to the block
+        self.filled: dict[int, np.ndarray] = {}
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return (self.n_timepoints, *self.plane_shape, *self.frame_shape)
+
+    @property
+    def ndim(self) -> int:
+        return 6
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held in allocated blocks."""
+        return sum(block.nbytes for block in self.blocks.values())
+
+    @property
+    def window(self) -> tuple[int, int]:
+        """First and last acquired timepoint held in memory."""
+        return self.first_timepoint, self.last_timepoint
+
+    @property
+    def capacity(self) -> int | None:
+        """Number of timepoints kept in ring buffer mode, None without a limit."""
+        limits = []
+        if self.max_timepoints is not None:
+            limits.append(self.max_timepoints)
+        if self.max_bytes is not None:
+            # the blocks of a window of n timepoints hold at most n - 1 + 2 blocks of
+            # timepoints (partial blocks at both ends), a new block is allocated
+            # before the oldest is freed
+            limits.append(self._budget_timepoints() - 2 * self.block_size + 1)
+        return max(min(limits), 1) if limits else None
+
+    def _budget_timepoints(self) -> int:
+        """Number of timepoints that fit into `max_bytes`."""
+        timepoint = int(np.prod(self.plane_shape + self.frame_shape))
+        timepoint *= self.dtype.itemsize
+        return self.max_bytes // max(timepoint, 1)
+
+    def _default_block_size(self) -> int:
+        block_size = min(self.n_timepoints, 64)
+        if self.max_timepoints is not None:
+            # blocks larger than the window would keep too much
+            block_size = min(block_size, self.max_timepoints)
+        if self.max_bytes is not None:
+            # at most a quarter of the budget, so that the window keeps at least
+            # half of it (see `capacity`)
+            block_size = min(block_size, self._budget_timepoints() // 4)
+        return max(block_size, 1)
+
+    def locate(self, t: int) -> tuple[int, int]:
+        """(block index, timepoint in the block) of timepoint `t`."""
+        return divmod(t, self.block_size)
+
+    def __setitem__(self, key: tuple[int, int, int, int], frame: np.ndarray) -> None:
+        t, *plane = key
+        if t < self.first_timepoint:
+            if self.evict is not None:
+                self.evict(frame, key)
+            return
+        if not self.blocks:
+            # the first frame decides the frame size, and with it the block size
+            self.frame_shape = tuple(frame.shape)
+            if not self._fixed_block_size:
+                self.block_size = self._default_block_size()
+        if any(i >= n for i, n in zip(plane, self.plane_shape)):
+            self._grow_planes(plane)
+        block, local = self.locate(t)
+        if block not in self.blocks:
+            self.blocks[block] = np.zeros(
+                (self.block_size, *self.plane_shape, *self.frame_shape), self.dtype
+            )
+            self.filled[block] = np.zeros((self.block_size, *self.plane_shape), bool)
+        self.blocks[block][(local, *plane)] = frame
+        self.filled[block][(local, *plane)] = True
+        self.n_timepoints = max(self.n_timepoints, t + 1)
+        if t > self.last_timepoint:
+            self.last_timepoint = t
+            if (capacity := self.capacity) is not None:
+                self._drop_before(t + 1 - capacity)
+
+    def __getitem__(self, key: tuple[int, int, int, int]) -> np.ndarray:
+        """The frame at (t, z, c, g). Frames not acquired yet are zeros."""
+        t, *plane = key
+        if t >= self.n_timepoints or any(
+            i >= n for i, n in zip(plane, self.plane_shape)
+        ):
+            raise IndexError(f"{key} is out of bounds for shape {self.shape}")
+        block, local = self.locate(t)
+        if block not in self.blocks or t < self.first_timepoint:
+            return np.zeros(self.frame_shape, self.dtype)
+        return self.blocks[block][(local, *plane)]
+
+    def _drop_before(self, t: int) -> None:
+        """Move the window to start at `t` and free the blocks before it."""
+        if t <= self.first_timepoint:
+            return
+        self.first_timepoint = t
+        for block in sorted(self.blocks):
+            if (block + 1) * self.block_size > t:
+                break
+            data = self.blocks.pop(block)
+            filled = self.filled.pop(block)
+            if self.evict is None:
+                continue
+            for local, *plane in zip(*np.nonzero(filled)):
+                t_evicted = block * self.block_size + int(local)
+                self.evict(data[(local, *plane)], (t_evicted, *map(int, plane)))
+
+    def _grow_planes(self, index: list[int]) -> None:
+        self.plane_shape = tuple(
+            max(n, i + 1) for n, i in zip(self.plane_shape, index)
+        )
+        self._reallocate()
+
+    def _reallocate(self) -> None:
+        for key, old in self.blocks.items():
+            new = np.zeros(
+                (self.block_size, *self.plane_shape, *self.frame_shape), self.dtype
+            )
+            new[tuple(slice(0, n) for n in old.shape)] = old
+            self.blocks[key] = new
+            filled = np.zeros((self.block_size, *self.plane_shape), bool)
+            filled[tuple(slice(0, n) for n in self.filled[key].shape)] = self.filled[key]
+            self.filled[key] = filled
+
+
+class MemmapArray:
+    """(t, z, c, g, y, x) frame store backed by memory-mapped OME-TIFF files.
+
+    One OME-TIFF (axes TZCYX) per grid position is created in `directory` when the
+    first frame arrives.  The files are sparse, so only the pages of frames that
+    were written take up disk space, and the OS can drop them from RAM at any time.
+    The files are valid OME-TIFFs at all times, `promote` moves them to their final
+    location (a rename on the same file system) instead of writing the data again.
+
+    The (t, z, c, g) sizes are preallocated from `shape`.  If a frame arrives outside
+    of them, the files are recreated with the larger size (doubling t) and the data
+    is copied, which should not happen if the shape was taken from the sequence.
+    `promote` trims the files to the last timepoint written the same way.
+
+    Frames are read as copies, so that no view outside of the array keeps the files
+    mapped: files that are mapped can't be renamed or removed on Windows.  `promote`
+    and `close` release all maps first.
+
+    Parameters
+    ----------
+    shape : tuple[int, ...]
+        (t, z, c, g, y, x) shape. y and x are taken from the first frame.
+    dtype : npt.DTypeLike
+        Data type of the frames.
+    directory : str | Path | None
+        Scratch folder for the files, should be on a local SSD and, to promote
+        without a copy, on the same file system as the final location. Default is a
+        new temporary folder.
+    metadata : dict | None
+        OME metadata passed to `tifffile.imwrite`, e.g. `{"Channel": {"Name": [...]}}`.
+    """
+
+    def __init__(
+        self,
+        shape: tuple[int, ...],
+        dtype: npt.DTypeLike = np.uint16,
+        directory: str | Path | None = None,
+        metadata: dict[str, Any] | None = None,
+    ) -> None:
+        try:
+            import tifffile  # noqa: F401
+        except ImportError as e:  # pragma: no cover
+            raise ImportError(
+                "tifffile is required for the memmap backend. "
+                "Please `pip install tifffile`."
+            ) from e
+        self.dtype = np.dtype(dtype)
+        self.n_timepoints = max(shape[0], 1)
+        self.plane_shape: tuple[int, ...] = tuple(max(n, 1) for n in shape[1:4])
+        self.frame_shape: tuple[int, ...] = tuple(shape[4:])
+        self.metadata = metadata or {}
+        self._own_directory = directory is None
+        if directory is None:
+            self.directory = Path(tempfile.mkdtemp(prefix="zeiss_control_"))
+        else:
+            self.directory = Path(directory)
+            self.directory.mkdir(parents=True, exist_ok=True)
+        self.promoted = False
+        self.first_timepoint = 0
+        self.last_timepoint = -1
+        self.capacity: int | None = None
+        self.paths: list[Path] = []
+        self.mmaps: list[np.memmap] = []
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return (self.n_timepoints, *self.plane_shape, *self.frame_shape)
+
+    @property
+    def ndim(self) -> int:
+        return 6
+
+    @property
+    def window(self) -> tuple[int, int]:
+        return self.first_timepoint, self.last_timepoint
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes allocated on disk for the frames written so far."""
+        return sum(os.stat(path).st_blocks * 512 for path in self.paths)
+
+    def __setitem__(self, key: tuple[int, int, int, int], frame: np.ndarray) -> None:
+        t, z, c, g = key
+        if not self.mmaps:
+            self.frame_shape = tuple(frame.shape)
+            self._create(self._names(), self.shape)
+        if t >= self.n_timepoints or any(
+            i >= n for i, n in zip((z, c, g), self.plane_shape)
+        ):
+            self._grow(key)
+        self.mmaps[g][t, z, c] = frame
+        self.last_timepoint = max(self.last_timepoint, t)
+
+    def __getitem__(self, key: tuple[int, int, int, int]) -> np.ndarray:
+        """Copy of the frame at (t, z, c, g). Frames not acquired yet are zeros."""
+        t, z, c, g = key
+        if t >= self.n_timepoints or any(
+            i >= n for i, n in zip((z, c, g), self.plane_shape)
+        ):
+            raise IndexError(f"{key} is out of bounds for shape {self.shape}")
+        if not self.mmaps:
+            return np.zeros(self.frame_shape, self.dtype)
+        return np.array(self.mmaps[g][t, z, c])
+
+    def flush(self) -> None:
+        for mmap in self.mmaps:
+            mmap.flush()
+
+    def promote(self, folder: str | Path, name: str | None = None) -> list[Path]:
+        """Move the files to `folder`, named like the files of `CoreOMETiffWriter`.
+
+        The data stays accessible, the memory maps are reopened at the new location.
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        if self.mmaps and 0 <= self.last_timepoint < self.n_timepoints - 1:
+            # timepoints preallocated or grown but never acquired, e.g. a stopped run
+            self._resize(self.last_timepoint + 1, self.plane_shape)
+        self.flush()
+        self.mmaps = []
+        targets = [folder / path for path in self._names(name or folder.parts[-1])]
+        for path, target in zip(self.paths, targets):
+            shutil.move(path, target)
+        self.paths = targets
+        self._open()
+        self.promoted = True
+        if not any(self.directory.iterdir()):
+            self.directory.rmdir()
+        return targets
+
+    def close(self) -> None:
+        """Close the files, and remove them if they were not promoted."""
+        self.flush()
+        self.mmaps = []
+        if not self.promoted:
+            for path in self.paths:
+                path.unlink(missing_ok=True)
+        if self._own_directory and self.directory.exists():
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _names(self, name: str = "datastore") -> list[str]:
+        n_grid = self.plane_shape[2]
+        if n_grid == 1:
+            return [f"{name}.ome.tiff"]
+        return [f"{name}_g{str(g).zfill(2)}.ome.tiff" for g in range(n_grid)]
+
+    def _create(self, names: list[str], shape: tuple[int, ...]) -> None:
+        from tifffile import imwrite
+
+        t, z, c, _, y, x = shape
+        metadata = {"axes": "TZCYX", **self.metadata}
+        self.paths = []
+        for g, name in enumerate(names):
+            metadata["GridPosition"] = g
+            path = self.directory / name
+            imwrite(path, shape=(t, z, c, y, x), dtype=self.dtype, metadata=metadata)
+            self.paths.append(path)
+        self._open()
+
+    def _open(self) -> None:
+        from tifffile import memmap
+
+        t, z, c, _, y, x = self.shape
+        self.mmaps = [
+            cast("np.memmap", memmap(path)).reshape((t, z, c, y, x))
+            for path in self.paths
+        ]
+
+    def _grow(self, key: tuple[int, int, int, int]) -> None:
+        t, *plane = key
+        n_timepoints = self.n_timepoints
+        if t >= n_timepoints:
+            n_timepoints = max(2 * n_timepoints, t + 1)
+        self._resize(
+            n_timepoints, tuple(max(n, i + 1) for n, i in zip(self.plane_shape, plane))
+        )
+
+    def _resize(self, n_timepoints: int, plane_shape: tuple[int, ...]) -> None:
+        """Recreate the files with the new sizes and copy the frames that fit."""
+        old_mmaps, old_paths = self.mmaps, self.paths
+        self.n_timepoints = n_timepoints
+        self.plane_shape = plane_shape
+        self._create([f"grow_{name}" for name in self._names()], self.shape)
+        for g, old in enumerate(old_mmaps):
+            common = tuple(
+                slice(0, min(a, b)) for a, b in zip(old.shape, self.mmaps[g].shape)
+            )
+            self.mmaps[g][common] = old[common]
+        # release all maps before removing and renaming their files
+        old = old_mmaps = None
+        self.flush()
+        self.mmaps = []
+        for old_path, path in zip(old_paths, self.paths):
+            old_path.unlink()
+        for i, path in enumerate(self.paths):
+            self.paths[i] = path.rename(path.with_name(path.name[len("grow_"):]))
+        self._open()
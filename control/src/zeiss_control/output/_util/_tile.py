@@ -0,0 +1,22 @@
+"""Placement of the camera frames in the scenes of the viewers."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from vispy.visuals.transforms import MatrixTransform
+
+
+def crop_translation(
+    transform: MatrixTransform, offset: tuple[float, float]
+) -> tuple[float, float, float]:
+    """Scene translation of a tile for a crop `offset` of (rows, columns).
+
+    `transform` is the transform of the tile, the offset is rotated with it.
+    """
+    row, column = offset
+    dx, dy = np.array([column, row], dtype=float) @ transform.matrix[:2, :2]
+    return float(dx), float(dy), 0.0
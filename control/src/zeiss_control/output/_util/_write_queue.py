@@ -0,0 +1,199 @@
+"""Bounded write queue that moves disk writes off the acquisition thread."""
+
+from __future__ import annotations
+
+import queue
+import threading
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Literal
+
+if TYPE_CHECKING:
+    import numpy as np
+
+
+@dataclass
+class FlushPolicy:
+    """When the background writer should flush written frames to disk.
+
+    Any combination of the two triggers may be set.  If neither is set, data is only
+    flushed at the end of the sequence.
+
+    Parameters
+    ----------
+    every_n_frames : int | None
+        Flush after this many frames have been written since the last flush.
+    every_seconds : float | None
+        Flush if this many seconds have passed since the last flush.
+    """
+
+    every_n_frames: int | None = None
+    every_seconds: float | None = None
+
+    def due(self, n_frames: int, seconds: float) -> bool:
+        """Return True if a flush is due after `n_frames` frames / `seconds` seconds."""
+        if self.every_n_frames and n_frames >= self.every_n_frames:
+            return True
+        if self.every_seconds is not None and seconds >= self.every_seconds:
+            return n_frames > 0
+        return False
+
+
+@dataclass
+class WriteQueueReport:
+    """Statistics of a `QueuedFrameWriter`, reset at every sequence start."""
+
+    frames_queued: int = 0
+    frames_written: int = 0
+    frames_dropped: int = 0
+    flushes: int = 0
+    max_depth: int = 0
+    # time the acquisition thread spent waiting on a full queue
+    blocked_seconds: float = 0.0
+    # time spent in the write and flush calls on the writer thread
+    write_seconds: float = 0.0
+    errors: list[str] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        return (
+            f"queued {self.frames_queued}, written {self.frames_written}, "
+            f"dropped {self.frames_dropped}, flushes {self.flushes}, "
+            f"max depth {self.max_depth}, blocked {self.blocked_seconds:.3f} s, "
+            f"writing {self.write_seconds:.3f} s"
+        )
+
+
+class QueuedFrameWriter:
+    """Hand frames to a dedicated writer thread through a bounded queue.
+
+    `put` is called from the acquisition thread and returns as soon as the frame is in
+    the queue.  The writer thread calls `write(target, index, frame)` for every frame
+    and `flush()` whenever `flush_policy` says so and once more when draining.  Bound
+    methods are held by weak reference, so that an idle queue doesn't keep its owner
+    alive; every queued frame holds a strong reference until it is written, so no
+    frame is lost if the owner is dropped with frames in the queue.
+
+    Parameters
+    ----------
+    write : Callable[[int, tuple, np.ndarray], None]
+        Writes one frame to `target` (e.g. the grid position) at `index`.
+    flush : Callable[[], None]
+        Flushes all written data to disk.
+    maxsize : int
+        Maximum number of frames waiting in the queue.
+    flush_policy : FlushPolicy | None
+        When to flush during the sequence. Default is only at the end of the sequence.
+    overflow : {"block", "drop"}
+        What to do if the queue is full.  "block" applies backpressure to the
+        acquisition thread, "drop" discards the frame.  Both are counted in `report`.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        write: Callable[[int, tuple, np.ndarray], None],
+        flush: Callable[[], None],
+        maxsize: int = 64,
+        flush_policy: FlushPolicy | None = None,
+        overflow: Literal["block", "drop"] = "block",
+    ) -> None:
+        self._write = _weak(write)
+        self._flush = _weak(flush)
+        self.flush_policy = flush_policy or FlushPolicy()
+        self.overflow = overflow
+        self.report = WriteQueueReport()
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        """Start a new writer thread, if not already running."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self.report = WriteQueueReport()
+        self._thread = threading.Thread(
+            target=self._run, name="QueuedFrameWriter", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, target: int, index: tuple, frame: np.ndarray) -> bool:
+        """Queue a frame for writing. Return False if it was dropped."""
+        item = (self._write(), target, index, frame)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == "drop":
+                self.report.frames_dropped += 1
+                return False
+            t0 = time.perf_counter()
+            self._queue.put(item)
+            self.report.blocked_seconds += time.perf_counter() - t0
+        self.report.frames_queued += 1
+        self.report.max_depth = max(self.report.max_depth, self._queue.qsize())
+        return True
+
+    def drain(self, timeout: float | None = None) -> WriteQueueReport:
+        """Write all queued frames, flush, and stop the writer thread.
+
+        Called on the writer thread itself, e.g. by the finalizer of the owner when
+        the last queued frame released it, the thread is only told to stop.
+        """
+        if self._thread is not None:
+            self._queue.put((self._STOP, self._flush()))
+            if self._thread is not threading.current_thread():
+                self._thread.join(timeout)
+            self._thread = None
+        return self.report
+
+    @property
+    def depth(self) -> int:
+        """Number of frames currently waiting to be written."""
+        return self._queue.qsize()
+
+    def _run(self) -> None:
+        since_flush = 0
+        last_flush = time.perf_counter()
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_policy.every_seconds)
+            except queue.Empty:
+                item = None
+            if item is not None and item[0] is self._STOP:
+                flush = item[1]
+                break
+            t0 = time.perf_counter()
+            if item is not None:
+                write, *args = item
+                try:
+                    write(*args)
+                    self.report.frames_written += 1
+                    since_flush += 1
+                except Exception as e:  # keep draining, report at the end
+                    self.report.errors.append(repr(e))
+                # the owner is only kept alive by frames that are still queued
+                item = write = args = None
+            if self.flush_policy.due(since_flush, t0 - last_flush):
+                self._do_flush()
+                since_flush = 0
+                last_flush = time.perf_counter()
+            self.report.write_seconds += time.perf_counter() - t0
+        t0 = time.perf_counter()
+        self._do_flush(flush)
+        self.report.write_seconds += time.perf_counter() - t0
+
+    def _do_flush(self, flush: Callable[[], None] | None = None) -> None:
+        if flush is None and (flush := self._flush()) is None:
+            return
+        try:
+            flush()
+            self.report.flushes += 1
+        except Exception as e:
+            self.report.errors.append(repr(e))
+
+
+def _weak(callback: Callable) -> Callable[[], Callable | None]:
+    """Weak reference to a bound method, plain functions are kept."""
+    if hasattr(callback, "__self__"):
+        return weakref.WeakMethod(callback)  # type: ignore[arg-type]
+    return lambda: callback
@@ -8,12 +8,17 @@ import tempfile
 from typing import TYPE_CHECKING, Any, Literal, MutableMapping, Protocol
 
 from ._5d_writer_base import _5DWriterBase
+from ._chunking import ChunkAssembler, ChunkPolicy
+from ._metadata_sink import FrameMetadataSink
+from ._compression import CompressionPipeline
+from ._pyramid import PyramidBuilder, level_shapes
 
 if TYPE_CHECKING:
     from os import PathLike
     from typing import ContextManager, Sequence, TypedDict
 
     import numpy as np
+    import useq
     import zarr
     from fsspec import FSMap
     from numcodecs.abc import Codec
@@ -36,6 +41,7 @@ if TYPE_CHECKING:
 
 
 POS_PREFIX = "p"
+FRAME_META_FILE = "frame_meta.jsonl"
 
 
 class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
@@ -47,9 +53,10 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     It also aims to be compatible with the xarray Zarr spec:
     https://docs.xarray.dev/en/latest/internals/zarr-encoding-spec.html
 
-    Note: this does *not* currently calculate any additional pyramid levels.
-    But it would be easy to do so after acquisition.
-    Chunk size is currently 1 XY plane.
+    Additional pyramid levels are only calculated if `pyramid_levels` is set.
+    They are then downsampled 2x, 4x, ... in XY while the frames arrive and stored
+    next to the full resolution array as `<position>_s<level>`.
+    Chunk size is 1 XY plane, unless a different `chunk_policy` is given.
 
     Zarr directory structure will be:
 
@@ -65,7 +72,9 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     │       └── c               # (only collected dimensions will be present)
     │           └── z
     │               └── y
-    │                   └── x   # chunks will be each XY plane
+    │                   └── x   # chunks will be each XY plane (by default)
+    ├── p0_s1                   # 2x downsampled p0, if pyramid_levels >= 1
+    ├── p0_s2                   # 4x downsampled p0, if pyramid_levels >= 2
     ├── ...
     ├── pn
     │   ├── .zarray
@@ -91,7 +100,29 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     array_kwargs : dict, optional
         Keyword arguments passed to `zarr.group.create` when creating the arrays.
         This may be used to set the zarr `compressor`, `fill_value`, `synchronizer`,
-        etc... Default is `{'dimension_separator': '/'}`.
+        etc... Default is `{'dimension_separator': '/'}`.  The chunks are set by the
+        `chunk_policy`, not here.
+    chunk_policy : ChunkPolicy, optional
+        Chunk layout of the position arrays: number of planes per chunk along t/z/c,
+        XY tiles and (for zarr v3) sharding.  If a chunk holds more than one plane,
+        planes are assembled in memory and each chunk is written once it is complete.
+        Default is one chunk per XY plane.
+    compression : CompressionPipeline, optional
+        If given, the arrays are compressed with its Blosc `compressor` (unless
+        `array_kwargs` sets another one) and all writes run in its thread pool.
+        Compression ratio and throughput per position are in `compression.stats` and
+        printed at the end of the sequence. Default is to write on the calling thread.
+    pyramid_levels : int, optional
+        Number of additional multiscale levels, each downsampled 2x in XY from the
+        previous one by a block mean.  They are computed in a worker thread as the
+        frames arrive and added to the `multiscales` metadata of the position.
+        Levels that would have no pixels are left out.  Default is 0, no pyramid.
+    stream_frame_metadata : bool, optional
+        If True and the store is a directory, frame metadata is appended to
+        `frame_meta.jsonl` in the store while the sequence runs, instead of being
+        kept in memory and written to the `frame_meta` attribute at the end. The
+        arrays then reference the file in their `frame_meta_file` attribute, together
+        with the number of frames. Default is False.
     minify_attrs_metadata : bool, optional
         If True, zattrs metadata will be read from disk, minified, and written
         back to disk at the end of a successful acquisition (to save space). Default is
@@ -106,6 +137,10 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         synchronizer: ZarrSynchronizer | None = None,
         zarr_version: Literal[2, 3, None] = None,
         array_kwargs: ArrayCreationKwargs | None = None,
+        chunk_policy: ChunkPolicy | None = None,
+        compression: CompressionPipeline | None = None,
+        pyramid_levels: int = 0,
+        stream_frame_metadata: bool = False,
         minify_attrs_metadata: bool = False,
     ) -> None:
         try:
@@ -135,9 +170,34 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
             )
 
         # passed to zarr.group.create
-        self._array_kwargs: ArrayCreationKwargs = array_kwargs or {}
+        self._array_kwargs: ArrayCreationKwargs = dict(array_kwargs or {})  # type: ignore[assignment]
         self._array_kwargs.setdefault("dimension_separator", "/")
         self._minify_metadata = minify_attrs_metadata
+        self._stream_frame_metadata = stream_frame_metadata
+
+        self._zarr_version = zarr_version
+        self._chunk_policy = chunk_policy or ChunkPolicy()
+        # fail now and not at the first frame
+        self._chunk_policy.check(zarr_version)
+        if layout := {"chunks", "storage_transformers"} & set(self._array_kwargs):
+            raise ValueError(
+                f"Set {sorted(layout)} with the chunk_policy, not the array_kwargs."
+            )
+        # {position key -> ChunkAssembler}, only used for multi-plane chunks
+        self._assemblers: dict[str, ChunkAssembler] = {}
+        # {position key -> dimension names}, to find the shard of a write
+        self._dims: dict[str, tuple[str, ...]] = {}
+
+        self._compression = compression
+        if compression is not None:
+            self._array_kwargs.setdefault("compressor", compression.compressor)
+
+        self._pyramid_levels = pyramid_levels
+        # {position key -> [2x array, 4x array, ...]}
+        self.level_arrays: dict[str, list[zarr.Array]] = {}
+        self._pyramid: PyramidBuilder | None = None
+        if pyramid_levels:
+            self._pyramid = PyramidBuilder(self._store_data)
 
     @classmethod
     def in_tmpdir(
@@ -183,9 +243,50 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
         """Read-only access to the zarr group."""
         return self._group
 
+    @property
+    def compression(self) -> CompressionPipeline | None:
+        """The compression pipeline writes run in, if any."""
+        return self._compression
+
+    def sequenceStarted(self, seq: useq.MDASequence) -> None:
+        if self._compression is not None:
+            self._compression.reset()
+        super().sequenceStarted(seq)
+        store_path = getattr(self._group.store, "path", None)
+        if self._stream_frame_metadata and store_path is not None:
+            self.metadata_sink = FrameMetadataSink(
+                os.path.join(store_path, self._group.path, FRAME_META_FILE)
+            )
+
     def finalize_metadata(self) -> None:
         """Called by superclass in sequenceFinished.  Flush metadata to disk."""
+        # write the chunks that are not complete yet
+        while self._assemblers:
+            _, assembler = self._assemblers.popitem()
+            assembler.flush()
+        if self._pyramid is not None:
+            self._pyramid.wait()
+            self._pyramid.shutdown()
+        if self._compression is not None:
+            arrays = dict(self.position_arrays)
+            for levels in self.level_arrays.values():
+                arrays.update({ary.basename: ary for ary in levels})
+            stats = self._compression.wait(arrays)
+            for key, pos_stats in stats.items():
+                print(f"Compression {key}: {pos_stats}")
+            # restarted by the next sequence, if the writer is used again
+            self._compression.shutdown()
+
         # flush frame metadata to disk
+        if self.metadata_sink is not None:
+            self.metadata_sink.close()
+            for key in self.metadata_sink.keys:
+                if key in self.position_arrays:
+                    self.position_arrays[key].attrs["frame_meta_file"] = {
+                        "path": FRAME_META_FILE,
+                        "count": self.metadata_sink.count(key),
+                    }
+            self.metadata_sink = None
         while self.frame_metadatas:
             key, metas = self.frame_metadatas.popitem()
             if key in self.position_arrays:
@@ -197,38 +298,106 @@ class OMEZarrWriter(_5DWriterBase["zarr.Array"]):
     def new_array(self, key: str, dtype: np.dtype, sizes: dict[str, int]) -> zarr.Array:
         """Create a new array in the group, under `key`."""
         dims, shape = zip(*sizes.items())
-        ary: zarr.Array = self._group.create(
-            key,
-            shape=shape,
-            chunks=(1,) * len(shape[:-2]) + shape[-2:],  # single XY plane chunks
-            dtype=dtype,
+        # the chunk layout comes from the policy only (see __init__), everything
+        # else from the array_kwargs
+        kwargs = {
             **self._array_kwargs,
-        )
+            **self._chunk_policy.array_kwargs(sizes, self._zarr_version),
+        }
+        ary: zarr.Array = self._group.create(key, shape=shape, dtype=dtype, **kwargs)
+        self._dims[key] = dims
+        if not self._chunk_policy.single_plane:
+            self._assemblers[key] = ChunkAssembler(
+                ary, lambda sel, data: self._store_data(ary, sel, data)
+            )
+
+        # downsampled levels, chunked by single planes
+        levels = []
+        for level, plane_shape in enumerate(
+            level_shapes(shape, self._pyramid_levels), start=1
+        ):
+            level_shape = (*shape[:-2], *plane_shape)
+            level_ary = self._group.create(
+                f"{key}_s{level}",
+                shape=level_shape,
+                chunks=(1,) * len(shape[:-2]) + level_shape[-2:],
+                dtype=dtype,
+                **self._array_kwargs,
+            )
+            level_ary.attrs["_ARRAY_DIMENSIONS"] = dims
+            levels.append(level_ary)
+        if levels:
+            self.level_arrays[key] = levels
 
         # add minimal OME-NGFF metadata
         scales = self._group.attrs.get("multiscales", [])
-        scales.append(self._multiscales_item(ary.path, ary.path, dims))
+        scales.append(
+            self._multiscales_item(
+                ary.path, ary.path, dims, [lvl.path for lvl in levels]
+            )
+        )
         self._group.attrs["multiscales"] = scales
         ary.attrs["_ARRAY_DIMENSIONS"] = dims
         if seq := self.current_sequence:
             ary.attrs["useq_MDASequence"] = json.loads(seq.json(exclude_unset=True))
         return ary
 
-    # # the superclass implementation is all we need
-    # def write_frame(
-    #     self, ary: zarr.Array, frame: np.ndarray, event: useq.MDAEvent
-    # ) -> None:
-    #     super().write_frame(ary, frame, event)
-
-    def _multiscales_item(self, path: str, name: str, axes: Sequence[str]) -> dict:
+    def write_frame(
+        self, ary: zarr.Array, index: tuple[int, ...], frame: np.ndarray
+    ) -> None:
+        """Write the frame directly, or to the assembler for multi-plane chunks."""
+        if not frame.flags.writeable and (self._compression or self._pyramid):
+            # read-only frames are borrowed (e.g. from a FrameHub), but the
+            # pipelines keep the frame until their worker gets to it
+            frame = frame.copy()
+        if (assembler := self._assemblers.get(ary.basename)) is not None:
+            assembler.add(index, frame)
+        else:
+            self._store_data(ary, index, frame)
+        if self._pyramid is not None and ary.basename in self.level_arrays:
+            self._pyramid.submit(self.level_arrays[ary.basename], index, frame)
+
+    def buffered_frame(self, key: str, index: tuple[int, ...]) -> np.ndarray | None:
+        """Return the frame at `index` if it has not been written to the store yet."""
+        if None in index:
+            return None
+        frame = None
+        if (assembler := self._assemblers.get(key)) is not None:
+            frame = assembler.get(index)
+        if frame is None and self._compression is not None:
+            frame = self._compression.get(key, index)
+        return frame
+
+    def _store_data(self, ary: zarr.Array, selection: tuple, data: np.ndarray) -> None:
+        if self._compression is not None:
+            # chunks of the same shard are written one after the other
+            lane = None
+            if (dims := self._dims.get(ary.basename)) is not None:
+                lane = self._chunk_policy.shard_index(dims, ary.chunks, selection)
+            self._compression.submit(ary.basename, ary, selection, data, lane=lane)
+        else:
+            ary[selection] = data
+
+    def _multiscales_item(
+        self,
+        path: str,
+        name: str,
+        axes: Sequence[str],
+        level_paths: Sequence[str] = (),
+    ) -> dict:
         """ome-zarr multiscales image metadata.
 
+        `level_paths` are the downsampled levels, each 2x smaller in XY.
         https://ngff.openmicroscopy.org/0.4/index.html#multiscale-md
         """
-        tforms = [{"scale": [1] * len(axes), "type": "scale"}]
+        datasets = []
+        for level, level_path in enumerate([path, *level_paths]):
+            scale = [1] * (len(axes) - 2) + [2**level] * 2
+            tforms = [{"scale": scale, "type": "scale"}]
+            datasets.append({"coordinateTransformations": tforms, "path": level_path})
         return {
             "axes": [{"name": ax, "type": AXTYPE.get(ax, "")} for ax in axes],
-            "datasets": [{"coordinateTransformations": tforms, "path": path}],
+            "datasets": datasets,
             "name": name,
             "version": "0.4",
         }
@@ -1,7 +1,9 @@
 from __future__ import annotations
 
 import copy
-from typing import TYPE_CHECKING
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Literal
 
 import numpy as np
 import numpy.typing as npt
@@ -10,17 +12,48 @@ from qtpy import QtCore, QtGui
 from qtpy.QtCore import Signal
 from useq import MDAEvent
 from eda_plugin.utility.core_event_bus import CoreEventBus
+from zeiss_control.output._util._projection import RunningProjections
+from zeiss_control.output._util._rwlock import ReadWriteLock
+from zeiss_control.output._util._storage import MemmapArray, SegmentedArray
 
 if TYPE_CHECKING:
     from qtpy.QtWidgets import QWidget
+    from zeiss_control.backend.frame_hub import FrameHub
 
 DIMENSIONS = ["t", "c", "z"]
 
 
 class QLocalDataStore(QtCore.QObject):
-    """Connects directly to mmcore frameReady and saves the data in a numpy array."""
+    """Connects directly to mmcore frameReady and saves the data in a numpy array.
+
+    If a `frame_source` is given, frames are received from that FrameHub instead.
+    The frames are kept in a `SegmentedArray`, so that acquisitions running longer
+    than `shape` grow in blocks of timepoints without copying the existing data.
+
+    For acquisitions without a fixed end, `max_timepoints` and/or `max_bytes` limit
+    the data kept to the most recent timepoints. `window_changed(first, last)` is
+    emitted when the range of timepoints in memory moves. Frames that are dropped
+    are passed to `spill_writer.frameReady(frame, event)` if it is given.
+
+    With `backend="memmap"`, the frames are kept in sparse memory-mapped OME-TIFFs in
+    `scratch_dir` instead (see `MemmapArray`), which can be moved to the final
+    location with `promote` at the end of the sequence.
+
+    `get_frame` returns read-only views (copies with the memmap backend) and can be
+    called from any thread, reads and writes are guarded by a `ReadWriteLock`.
+
+    `finish` is called at the end of the sequence, `drained(paths)` is emitted once
+    all frames received until then are stored, with the files they were promoted to
+    if a folder was given.
+
+    Max, mean and min `projections` along the axes of `shape` with more than one
+    frame (z and/or t) are updated with every frame in a worker thread and read with
+    `get_projection`.
+    """
 
     frame_ready = Signal(MDAEvent)
+    window_changed = Signal(int, int)
+    drained = Signal(list)
 
     def __init__(
         self,
@@ -29,15 +62,42 @@ class QLocalDataStore(QtCore.QObject):
         parent: QWidget | None = None,
         mmcore: CMMCorePlus | None = None,
         eda_event_bus: CoreEventBus | None = None,
+        frame_source: FrameHub | None = None,
+        max_timepoints: int | None = None,
+        max_bytes: int | None = None,
+        spill_writer: Any | None = None,
+        backend: Literal["memory", "memmap"] = "memory",
+        scratch_dir: str | Path | None = None,
+        metadata: dict | None = None,
     ):
         super().__init__(parent=parent)
         self.dtype = np.dtype(dtype)
-        self.array: np.ndarray = np.ndarray(shape, dtype=self.dtype)
+        self.spill_writer = spill_writer
+        # channel names seen so far, for the events of spilled frames
+        self._channels: dict[int, str] = {}
+        self.lock = ReadWriteLock()
+        self.projections = RunningProjections()
+        self.projections.start(dict(zip("tzcg", shape)))
+        self.array: SegmentedArray | MemmapArray
+        if backend == "memmap":
+            self.array = MemmapArray(shape, self.dtype, scratch_dir, metadata)
+        else:
+            self.array = SegmentedArray(
+                shape, dtype=self.dtype, max_timepoints=max_timepoints,
+                max_bytes=max_bytes, evict=self._spill if spill_writer else None,
+            )
 
         self._mmc: CMMCorePlus = mmcore or CMMCorePlus.instance()
         self.eda_event_bus: CoreEventBus = eda_event_bus
 
-        self.listener = self.EventListener(self._mmc, self.eda_event_bus, self.array.shape[2])
+        self._stored = 0
+        # set by `finish`: (folder to promote to or None) until the frames are stored
+        self._finishing: tuple[Path | None] | None = None
+        self._count_lock = threading.Lock()
+
+        self.frame_source = frame_source
+        self.listener = self.EventListener(self._mmc, self.eda_event_bus, self.array.shape[2],
+                                           frame_source)
         self.listener.start()
         self.listener.frame_ready.connect(self.new_frame)
 
@@ -47,46 +107,119 @@ class QLocalDataStore(QtCore.QObject):
         frame_ready = Signal(np.ndarray, MDAEvent)
 
         def __init__(self, mmcore: CMMCorePlus, eda_event_bus: CoreEventBus = None,
-                     channels: int = None):
+                     channels: int = None, frame_source: FrameHub | None = None):
             super().__init__()
             self._mmc = mmcore
-            self._mmc.mda.events.frameReady.connect(self.on_frame_ready)
+            # frames handed on to the datastore
+            self.received = 0
+            self._lock = threading.Lock()
+            if frame_source is None:
+                self._mmc.mda.events.frameReady.connect(self.on_frame_ready)
+            else:
+                # the frame is used later in the GUI thread, released in new_frame
+                frame_source.connect(self.on_frame_ready, "QLocalDataStore", retain=True)
+            self.frame_source = frame_source
             self.channels = channels
             if eda_event_bus:
                 self.eda_event_bus = eda_event_bus
                 self.eda_event_bus.new_network_image.connect(self.on_network_image)
 
         def on_frame_ready(self, img: np.ndarray, event: MDAEvent) -> None:
+            with self._lock:
+                self.received += 1
             self.frame_ready.emit(img, event)
 
         def on_network_image(self, img: np.ndarray, timepoint: tuple):
             # print("NETWORK IMAGE IN DATASTORE", img.min(), img.max())
             event = MDAEvent(channel={"config": "Network"}, index={'t': timepoint[0], 'c': self.channels-1})
+            with self._lock:
+                self.received += 1
             self.frame_ready.emit(img, event)
 
         def closeEvent(self, event: QtGui.QCloseEvent) -> None:
-            self._mmc.mda.events.frameReady.disconnect(self.on_frame_ready)
+            if self.frame_source is None:
+                self._mmc.mda.events.frameReady.disconnect(self.on_frame_ready)
+            else:
+                self.frame_source.disconnect(self.on_frame_ready)
             super().exit()
             event.accept()
 
     def new_frame(self, img: np.ndarray, event: MDAEvent) -> None:
+        try:
+            self._store(img, event)
+        finally:
+            with self._count_lock:
+                self._stored += 1
+            self._check_drained()
+
+    def _store(self, img: np.ndarray, event: MDAEvent) -> None:
         self.shape = img.shape
         indices = self.complement_indices(event)
+        if event.channel is not None:
+            self._channels[indices["c"]] = event.channel.config
         # print("ADDING IMAGE TO DATASTORE", img.max())
-        try:
-            self.array[
-                indices["t"], indices["z"], indices["c"], indices.get("g", 0), :, :
-            ] = img
-        except IndexError:
-            self.correct_shape(indices)
-            self.new_frame(img, event)
-            return
+        with self.lock.write():
+            window = self.array.window
+            key = (indices["t"], indices["z"], indices["c"], indices.get("g", 0))
+            self.array[key] = img
+            # the stored frame, img is released below
+            stored = self.array[key] if self.projections.active else None
+        if stored is not None:
+            self.projections.add(indices, stored)
+        if self.array.window != window and self.array.capacity is not None:
+            self.window_changed.emit(*self.array.window)
+        if self.frame_source is not None:
+            self.frame_source.release(img, "QLocalDataStore")
         # print("ADDED IMAGE TO DATASTORE", img.max(), indices)
         self.frame_ready.emit(event)
 
     def get_frame(self, key: tuple) -> np.ndarray:
-        print(key)
-        return np.array(self.array[key])
+        """Read-only view of the frame at (t, z, c, g).
+
+        This is not a copy, if a frame is acquired again at the same index, the view
+        shows the new data.  With the memmap backend it is a copy, see `MemmapArray`.
+        """
+        with self.lock.read():
+            frame = self.array[key].view()
+        frame.flags.writeable = False
+        return frame
+
+    def get_projection(self, axis: str, mode: str, key: tuple) -> np.ndarray | None:
+        """Projection `mode` along `axis` through the frame at (t, z, c, g)."""
+        index = dict(zip("tzcg", key))
+        with self.lock.read():
+            return self.projections.get(axis, mode, index)
+
+    def promote(self, folder: str | Path) -> list[Path]:
+        """Move the memory-mapped files to `folder` as the final OME-TIFFs."""
+        if not isinstance(self.array, MemmapArray):
+            raise TypeError("Only the memmap backend can be promoted.")
+        # no frame is read or written while the files are moved
+        with self.lock.write():
+            return self.array.promote(folder)
+
+    def finish(self, promote_to: str | Path | None = None) -> None:
+        """End of the sequence, emit `drained` when all frames received are stored.
+
+        The files are moved to `promote_to` then, if it is given.
+        """
+        with self._count_lock:
+            self._finishing = (None if promote_to is None else Path(promote_to),)
+        self._check_drained()
+
+    def _check_drained(self) -> None:
+        with self._count_lock, self.listener._lock:
+            if self._finishing is None or self._stored < self.listener.received:
+                return
+            (folder,), self._finishing = self._finishing, None
+        self.drained.emit([] if folder is None else self.promote(folder))
+
+    def _spill(self, frame: np.ndarray, key: tuple[int, int, int, int]) -> None:
+        """Hand a frame that is dropped from memory to the spill writer."""
+        t, z, c, g = key
+        channel = {"config": self._channels.get(c, str(c))}
+        event = MDAEvent(index={"t": t, "z": z, "c": c, "g": g}, channel=channel)
+        self.spill_writer.frameReady(frame, event)
 
     def complement_indices(self, event: MDAEvent | dict) -> dict:
         indices = dict(copy.deepcopy(dict(event.index)))
@@ -95,19 +228,9 @@ class QLocalDataStore(QtCore.QObject):
                 indices[i] = 0
         return indices
 
-    def correct_shape(self, indices: dict) -> None:
-        """The initialised shape does not fit the data, extend the array."""
-        min_shape = [indices["t"], indices["z"], indices["c"], indices.get("g", 0)]
-        diff = [x - y + 1 for x, y in zip(min_shape, self.array.shape[:-2])]
-        for i, app in enumerate(diff):
-            if app > 0:
-                if i == 0:  # handle time differently, double the size
-                    app = max(self.array.shape[0], 1)
-                append_shape = [*self.array.shape[:i], app, *self.array.shape[i + 1 :]]
-                self.array = np.append(
-                    self.array, np.zeros(append_shape, self.array.dtype), axis=i
-                )
-
     def __del__(self) -> None:
+        self.projections.shutdown()
         self.listener.exit()
         self.listener.wait()
+        if isinstance(self.array, MemmapArray):
+            self.array.close()
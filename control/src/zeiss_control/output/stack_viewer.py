@@ -7,13 +7,21 @@ import numpy as np
 from fonticon_mdi6 import MDI6
 from pymmcore_plus import CMMCorePlus
 from qtpy import QtCore, QtWidgets
-from qtpy.QtCore import QTimer, Signal
+from qtpy.QtCore import Signal
 from superqt import fonticon
 from superqt.cmap._cmap_utils import try_cast_colormap
 from useq import Channel, MDASequence
 from zeiss_control.output._util._channel_row import ChannelRow
 from zeiss_control.output._util._labeled_slider import LabeledVisibilitySlider
 from zeiss_control.gui._util.qt_classes import QWidgetRestore
+from zeiss_control.output._util._autocontrast import AutoContrast
+from zeiss_control.output._util._deferred_display import DeferredDisplay
+from zeiss_control.output._util._downsample import DisplayDownsampler
+from zeiss_control.output._util._plane_cache import PlaneCache
+from zeiss_control.output._util._prefetch import SlicePrefetcher
+from zeiss_control.output._util._render_scheduler import RenderScheduler
+from zeiss_control.output._util._storage import MemmapArray
+from zeiss_control.output._util._tile import crop_translation
 
 DIMENSIONS = ["t", "z", "c", "p", "g"]
 AUTOCLIM_RATE = 1  # Hz   0 = inf
@@ -47,9 +55,16 @@ class StackViewer(QWidgetRestore):
         parent: QWidget | None = None,
         size: tuple[int, int] | None = None,
         transform: tuple[int, bool, bool] = (90, False, True),
+        max_fps: float = 30,
+        clim_percentiles: tuple[float, float] = (0.1, 99.9),
+        crop_offset: tuple[float, float] = (0, 0),
     ):
         """Create a new StackViewer widget.
         transform: (int, bool, bool) rotation mirror_x mirror_y
+        max_fps: new frames are displayed at most this many times per second
+        clim_percentiles: (low, high) percentiles used as auto contrast limits
+        crop_offset: (rows, columns) from the sensor center to the center of the
+            frames, see `CameraCrop.center_offset`
         """
         super().__init__(parent=parent)
         self._reload_position()
@@ -57,6 +72,7 @@ class StackViewer(QWidgetRestore):
         self.sequence = sequence
         self.canvas_size = size
         self.transform = transform
+        self.crop_offset = crop_offset
         self._clim = "auto"
         self.cmaps = [try_cast_colormap(x) for x in self.cmap_names]
         self.display_index = {dim: 0 for dim in DIMENSIONS}
@@ -64,6 +80,8 @@ class StackViewer(QWidgetRestore):
         self.setLayout(QtWidgets.QVBoxLayout())
         self.construct_canvas()
         self.layout().addWidget(self._canvas.native)
+        # frames are uploaded at screen resolution, full resolution when zoomed in
+        self.downsampler = DisplayDownsampler(self.view, self._canvas)
 
         self.info_bar = QtWidgets.QLabel()
         self.info_bar.setSizePolicy(
@@ -76,6 +94,23 @@ class StackViewer(QWidgetRestore):
         self.datastore = datastore
         self._mmc.mda.events.sequenceStarted.connect(self.on_sequence_start)
         self.datastore.frame_ready.connect(self.on_frame_ready)
+        self.datastore.window_changed.connect(self._on_window_changed)
+        # only the newest frame of each image is displayed, at most max_fps times/s
+        self.render_scheduler = RenderScheduler(
+            self._show_frame, self._canvas.update, max_fps, parent=self
+        )
+        # frames that arrive before the viewer is ready, shown in order later
+        self.deferred = DeferredDisplay(
+            self._show_frame, after=self._canvas.update, parent=self
+        )
+        # planes in memory are returned as views, only files need prefetching
+        self.prefetcher: SlicePrefetcher | None = None
+        if isinstance(self.datastore.array, MemmapArray):
+            self.prefetcher = SlicePrefetcher(
+                self._load_plane, cache=PlaneCache(256 * 1024**2)
+            )
+        # running histogram of the displayed frames per channel
+        self.autocontrast = AutoContrast(clim_percentiles)
 
         self._new_channel.connect(self.channel_row.box_visibility)
 
@@ -130,6 +165,10 @@ class StackViewer(QWidgetRestore):
         self.ready = False
         self.sequence = sequence
         self.pixel_size = self._mmc.getPixelSizeUm()
+        if self.prefetcher:
+            self.prefetcher.cancel()
+        self.render_scheduler.reset()
+        self.autocontrast.reset()
         # Sliders
         for dim in DIMENSIONS[:3]:
             if sequence.sizes.get(dim, 1) > 1:
@@ -157,7 +196,6 @@ class StackViewer(QWidgetRestore):
                 trans = visuals.transforms.linear.MatrixTransform()
                 trans.rotate(self.transform[0], (0, 0, 1))
                 image.transform = self._get_image_position(trans, sequence, g)
-                image.interactive = True
                 if c > 0:
                     image.set_gl_state("additive", depth_test=False)
                 self.images[c].append(image)
@@ -231,6 +269,7 @@ class StackViewer(QWidgetRestore):
         for dim in dims:
             slider = LabeledVisibilitySlider(dim, orientation=QtCore.Qt.Horizontal)
             slider.valueChanged.connect(self.on_display_timer)
+            slider.projectionChanged.connect(self._on_projection_changed)
             self._slider_settings.connect(slider._visibility)
             self.layout().addWidget(slider)
             slider.hide()
@@ -238,39 +277,46 @@ class StackViewer(QWidgetRestore):
         # print("Number of sliders constructed: ", len(self.sliders))
 
     def on_mouse_move(self, event: SceneMouseEvent) -> None:
-        """Mouse moved on the canvas, display the pixel value and position."""
-        # https://groups.google.com/g/vispy/c/sUNKoDL1Gc0/m/E5AG7lgPFQAJ
-        self.view.interactive = False
-        images = []
-        # Get the images the mouse is over
-        while image := self._canvas.visual_at(event.pos):
-            images.append(image)
-            image.interactive = False
-        for image in images:
-            image.interactive = True
-        self.view.interactive = True
-        if images == []:
+        """Mouse moved on the canvas, display the pixel value and position.
+
+        The tile under the cursor is found by mapping the position through the
+        transforms of the tiles of the current channel, no picking render.
+        """
+        channel = self.current_channel
+        tile = None
+        if channel < len(self.images) and self.images[channel][0].visible:
+            tile = self._tile_at(channel, event.pos)
+        if tile is None:
             transform = self.view.get_transform("canvas", "visual")
-            p = [int(x) for x in transform.map(event.pos)]
-            info = f"[{p[0]}, {p[1]}]"
-            self.info_bar.setText(info)
+            p = [int(x) for x in transform.map(event.pos)[:2]]
+            self.info_bar.setText(f"[{p[0]}, {p[1]}]")
             return
-        # Adjust channel index is channel(s) are not visible
-        real_channel = self.current_channel
-        for i in range(self.current_channel):
-            i_visible = self.channel_row.boxes[i].show_channel.isChecked()
-            real_channel = real_channel - 1 if not i_visible else real_channel
-        images.reverse()
-        transform = images[real_channel].get_transform("canvas", "visual")
-        p = [int(x) for x in transform.map(event.pos)]
-        try:
-            pos = f"[{p[0]}, {p[1]}]"
-            value = f"{images[real_channel]._data[p[1], p[0]]}"
-            info = f"{pos}: {value}"
-            self.info_bar.setText(info)
-        except IndexError:
-            info = f"[{p[0]}, {p[1]}]"
-            self.info_bar.setText(info)
+        grid, column, row = tile
+        # the frame shown, which can be a projection, else the one at the sliders
+        frame = self.downsampler.frame(self.images[channel][grid])
+        if frame is None:
+            key = (self.display_index["t"], self.display_index["z"], channel, grid)
+            frame = self.datastore.get_frame(key)
+        info = f"[{column}, {row}]: {frame[row, column]}"
+        if len(self.images[channel]) > 1:
+            info = f"g{grid} {info}"
+        self.info_bar.setText(info)
+
+    def _tile_at(
+        self, channel: int, pos: tuple[float, float]
+    ) -> tuple[int, int, int] | None:
+        """(grid, column, row) of the frame pixel of `channel` at canvas `pos`."""
+        for grid in reversed(range(len(self.images[channel]))):
+            image = self.images[channel][grid]
+            frame = self.downsampler.frame(image)
+            height, width = self.img_size if frame is None else frame.shape[-2:]
+            # the image shows every stride-th pixel of the frame
+            stride = self.downsampler.stride(image)
+            x, y = image.get_transform("canvas", "visual").map(pos)[:2]
+            column, row = int(np.floor(x * stride)), int(np.floor(y * stride))
+            if 0 <= row < height and 0 <= column < width:
+                return grid, column, row
+        return None
 
     def on_display_timer(self) -> None:
         """Update display, usually triggered by QTimer started by slider click."""
@@ -279,29 +325,80 @@ class StackViewer(QWidgetRestore):
             self.display_index[slider.name] = slider.value()
         if old_index == self.display_index:
             return
-        if (sequence := self.sequence) is None:
+        if self.sequence is None:
             return
-        for g in range(max(sequence.sizes.get("g", 1), 1)):
-            for c in range(max(sequence.sizes.get("c", 1), 1)):
-                frame = self.datastore.get_frame(
-                    (self.display_index["t"], self.display_index["z"], c, g)
-                )
-                self.display_image(frame, c, g)
+        images = self._display_current()
+        if not self.prefetcher:
+            return
+        moves = {
+            slider.name: (slider.value(), slider.maximum())
+            for slider in self.sliders
+            if slider.name in ("t", "z")
+            and old_index[slider.name] != self.display_index[slider.name]
+        }
+        if moves:
+            self.prefetcher.follow(moves, self.display_index, images)
+
+    def _display_current(self) -> list[tuple[int, int]]:
+        """Show the frames at the display index, returns the (c, g) shown."""
+        images = [
+            (c, g)
+            for g in range(max(self.sequence.sizes.get("g", 1), 1))
+            for c in range(max(self.sequence.sizes.get("c", 1), 1))
+        ]
+        for c, g in images:
+            key = (self.display_index["t"], self.display_index["z"], c, g)
+            if (frame := self._projected(key)) is None:
+                try:
+                    frame = self.prefetcher.fetch(key) if self.prefetcher else None
+                except IndexError:
+                    # not acquired yet, not cached
+                    frame = None
+                if frame is None:
+                    frame = self.datastore.get_frame(key)
+            self.display_image(frame, c, g)
         self._canvas.update()
+        return images
+
+    def _projected(self, key: tuple[int, int, int, int]) -> np.ndarray | None:
+        """Projection through the frame at (t, z, c, g), if a slider is set to one."""
+        for slider in self.sliders:
+            if slider.name in ("t", "z") and slider.projection != "plane":
+                mode = slider.projection
+                return self.datastore.get_projection(slider.name, mode, key)
+        return None
+
+    def _on_projection_changed(self, mode: str) -> None:
+        if self.sequence is not None and self.images:
+            self._display_current()
+
+    def _load_plane(self, key: tuple[int, int, int, int]) -> np.ndarray:
+        if key[0] > self.datastore.array.last_timepoint:
+            # would read as zeros, and stay cached after the frame arrived
+            raise IndexError(f"{key} not acquired yet")
+        # a copy, the pages of the memory-mapped file are read in the worker thread
+        return self.datastore.get_frame(key)
 
     def on_frame_ready(self, event: MDAEvent) -> None:
-        """Frame received from acquisition, display the image, update sliders etc."""
-        if not self.ready:
-            timer = QTimer()
-            timer.setSingleShot(True)
-            timer.timeout.connect(lambda: self.on_frame_ready(event))
-            timer.start(100)
+        """Frame received from acquisition, schedule it to be displayed."""
+        indices = self.complement_indices(event.index)
+        if self.prefetcher:
+            # a plane of this timepoint may have been loaded before it was written
+            self.prefetcher.invalidate(
+                (indices["t"], indices["z"], indices["c"], indices.get("g", 0))
+            )
+        self.render_scheduler.submit((indices["c"], indices["g"]), event)
+
+    def _show_frame(self, event: MDAEvent) -> None:
+        """Display the image, update sliders etc."""
+        if not self.ready or len(self.deferred):
+            self.deferred.defer(event)
             return
         indices = self.complement_indices(event.index)
-        print(indices)
-        img = self.datastore.get_frame(
-            (indices["t"], indices["z"], indices["c"], indices.get("g", 0))
-        )
+        key = (indices["t"], indices["z"], indices["c"], indices.get("g", 0))
+        # a projection is updated with every frame, show it with the new frame
+        if (img := self._projected(key)) is None:
+            img = self.datastore.get_frame(key)
 
         # Update display
         display_indices = self._set_sliders(indices)
@@ -309,17 +406,13 @@ class StackViewer(QWidgetRestore):
             self.display_image(img, indices.get("c", 0), indices.get("g", 0))
             # Handle Autoscaling
             clim_slider = self.channel_row.boxes[indices["c"]].slider
+            vmin, vmax = self.autocontrast.range(indices["c"])
             clim_slider.setRange(
-                min(clim_slider.minimum(), img.min()),
-                max(clim_slider.maximum(), img.max()),
+                min(clim_slider.minimum(), vmin),
+                max(clim_slider.maximum(), vmax),
             )
             if self.channel_row.boxes[indices["c"]].autoscale_chbx.isChecked():
-                clim_slider.setValue(
-                    [
-                        min(clim_slider.minimum(), img.min()),
-                        max(clim_slider.maximum(), img.max()),
-                    ]
-                )
+                clim_slider.setValue(self.autocontrast.clim(indices["c"]))
             self.on_clim_timer(indices["c"])
 
     def _set_sliders(self, indices: dict) -> None:
@@ -334,22 +427,29 @@ class StackViewer(QWidgetRestore):
             slider.blockSignals(False)
         return display_indices
 
+    def _on_window_changed(self, first: int, last: int) -> None:
+        """The datastore only holds timepoints first...last, limit the t slider."""
+        for slider in self.sliders:
+            if slider.name == "t":
+                slider.setRange(first, max(last, first))
+
     def display_image(self, img: np.ndarray, channel: int = 0, grid: int = 0) -> None:
-        self.images[channel][grid].set_data(img)
-        self._canvas.update()
+        # the canvas is updated once for all images by the callers
+        self.downsampler.set_data(self.images[channel][grid], img)
+        self.autocontrast.update(channel, img)
 
     def on_clim_timer(self, channel: int | None = None) -> None:
         channel_list = (
             list(range(len(self.channel_row.boxes))) if channel is None else [channel]
         )
-        for grid in range(self.ng):
-            for channel in channel_list:
-                if (
-                    self.channel_row.boxes[channel].autoscale_chbx.isChecked()
-                    and self.images[channel][grid].visible
-                ):
-                    # TODO: percentile here, could be in gui
-                    clim = np.percentile(self.images[channel][grid]._data, [0, 100])
+        for channel in channel_list:
+            if not self.channel_row.boxes[channel].autoscale_chbx.isChecked():
+                continue
+            # same limits for all tiles of a channel, from its running histogram
+            if (clim := self.autocontrast.clim(channel)) is None:
+                continue
+            for grid in range(self.ng):
+                if self.images[channel][grid].visible:
                     self.images[channel][grid].clim = clim
         self._canvas.update()
 
@@ -364,6 +464,7 @@ class StackViewer(QWidgetRestore):
                     0,
                 )
             )
+            trans.translate(crop_translation(trans, self.crop_offset))
             self._expand_canvas_view(sub_event)
         else:
             translate_x = self.img_size[0] if self.transform[0] == 90 else 0
@@ -413,6 +514,9 @@ class StackViewer(QWidgetRestore):
     def _disconnect(self) -> None:
         self._mmc.mda.events.sequenceStarted.disconnect(self.on_sequence_start)
         self.datastore.frame_ready.disconnect(self.on_frame_ready)
+        self.datastore.window_changed.disconnect(self._on_window_changed)
+        if self.prefetcher:
+            self.prefetcher.close()
 
     def _reload_position(self) -> None:
         self.qt_settings = QtCore.QSettings("pymmcore_plus", self.__class__.__name__)
@@ -9,20 +9,43 @@ from pymmcore_plus import CMMCorePlus
 # from zeiss_control.output.datastore import QLocalDataStore
 from eda_plugin.utility.core_event_bus import CoreEventBus
 from datetime import timedelta
-from typing import TYPE_CHECKING, Any, cast
+from typing import TYPE_CHECKING, Any, Literal, cast
 from pathlib import Path
 import yaml
 from useq import MDAEvent
+from zeiss_control.output._util._write_queue import (
+    FlushPolicy, QueuedFrameWriter, WriteQueueReport)
 
 
 if TYPE_CHECKING:
 
     import numpy as np
     import useq
+    from zeiss_control.backend.frame_hub import FrameHub
 
 
 class CoreOMETiffWriter:
-    def __init__(self, folder: Path | str, mmcore: CMMCorePlus, event_bus:CoreEventBus) -> None:
+    """Write MDA frames into one memory-mapped OME-TIFF per grid position.
+
+    If `background` is True, frames are handed to a dedicated writer thread through a
+    bounded queue of `queue_size` frames, so that `frameReady` returns immediately.
+    The data is then flushed according to `flush_policy` (default: only at the end of
+    the sequence) and the queue is drained in `sequenceFinished`. If the queue is full,
+    `overflow` decides whether the acquisition waits ("block") or the frame is dropped
+    ("drop"). Both are reported in `write_report`.
+
+    If a `frame_source` is given, frames are received from that FrameHub instead of
+    directly from the MDA runner. Without `mmcore`, no signals are connected and the
+    methods have to be called by the owner, e.g. a `ProcessWriter`.  The writer is
+    for one sequence: `sequenceFinished` disconnects it from all signals (`close`).
+    """
+
+    def __init__(self, folder: Path | str, mmcore: CMMCorePlus | None = None,
+                 event_bus: CoreEventBus | None = None,
+                 background: bool = False, queue_size: int = 64,
+                 flush_policy: FlushPolicy | None = None,
+                 overflow: Literal["block", "drop"] = "block",
+                 frame_source: FrameHub | None = None) -> None:
         try:
             import tifffile  # noqa: F401
             import yaml
@@ -41,13 +64,66 @@ class CoreOMETiffWriter:
         self.n_grid_positions: int = 1
 
         self._mmc = mmcore
-        self._mm_config = self._mmc.getSystemState().dict()
-        self._mmc.mda.events.sequenceStarted.connect(self.sequenceStarted)
-        self._mmc.mda.events.frameReady.connect(self.frameReady)
-        self.event_bus.new_network_image.connect(self.net_frameReady)
+        self._mm_config = self._mmc.getSystemState().dict() if mmcore else {}
+        self._frame_source = frame_source
+        if frame_source is not None:
+            # queued frames are kept until they are written
+            frame_source.connect(self.frameReady, "OME-TIFF writer", retain=background)
+        if mmcore is not None:
+            self._mmc.mda.events.sequenceStarted.connect(self.sequenceStarted)
+            if frame_source is None:
+                self._mmc.mda.events.frameReady.connect(self.frameReady)
+            self._mmc.mda.events.sequenceFinished.connect(self.sequenceFinished)
+        if self.event_bus is not None:
+            self.event_bus.new_network_image.connect(self.net_frameReady)
+
+        self._closed = False
+        self._write_queue: QueuedFrameWriter | None = None
+        if background:
+            self._write_queue = QueuedFrameWriter(
+                self._write_frame, self._flush, maxsize=queue_size,
+                flush_policy=flush_policy, overflow=overflow,
+            )
+
+    @property
+    def write_report(self) -> WriteQueueReport | None:
+        """Statistics of the background writer, None if writing on the calling thread."""
+        return self._write_queue.report if self._write_queue else None
 
     def sequenceStarted(self, seq: useq.MDASequence) -> None:
         self._set_sequence(seq)
+        if self._write_queue:
+            self._write_queue.start()
+
+    def sequenceFinished(self, seq: useq.MDASequence | None = None) -> None:
+        """Write all frames still in the queue and flush everything to disk."""
+        if self._closed:
+            # called by the owner already
+            return
+        if self._write_queue:
+            report = self._write_queue.drain()
+            print("OME-TIFF writer:", report)
+            for error in report.errors:
+                print("\033[1mERROR while writing\033[0m", error)
+        else:
+            self._flush()
+        self.close()
+
+    def close(self) -> None:
+        """Disconnect from the core, the frame source and the event bus."""
+        self._closed = True
+        if self._frame_source is not None:
+            self._frame_source.disconnect(self.frameReady)
+            self._frame_source = None
+        if self._mmc is not None:
+            events = self._mmc.mda.events
+            events.sequenceStarted.disconnect(self.sequenceStarted)
+            events.frameReady.disconnect(self.frameReady)
+            events.sequenceFinished.disconnect(self.sequenceFinished)
+            self._mmc = None
+        if self.event_bus is not None:
+            self.event_bus.new_network_image.disconnect(self.net_frameReady)
+            self.event_bus = None
 
     def net_frameReady(self, img: np.ndarray, timepoint: tuple):
         event = MDAEvent(channel={"config": "Network"},
@@ -55,10 +131,24 @@ class CoreOMETiffWriter:
                                  'c': self._current_sequence.sizes.get("c", 1)-1})
         self.frameReady(img, event)
 
-    def frameReady(self, frame: np.ndarray, event: useq.MDAEvent) -> None:
+    def frameReady(self, frame: np.ndarray, event: useq.MDAEvent,
+                   meta: dict | None = None) -> None:
         # no meta input for this version yet.
+        queued = False
+        try:
+            queued = self._frame_ready(frame, event)
+        finally:
+            # a leased frame in the queue is released after it is written, on every
+            # other path (no event, dropped, an error) here
+            if self._write_queue and not queued:
+                self._release(frame)
+
+    # -------------------- private --------------------
+
+    def _frame_ready(self, frame: np.ndarray, event: useq.MDAEvent | None) -> bool:
+        """Write or queue the frame, True if it was queued."""
         if event is None:
-            return
+            return False
         if self._mmaps is None:
             if not self._current_sequence:
                 # just in case sequenceStarted wasn't called
@@ -69,20 +159,41 @@ class CoreOMETiffWriter:
                     "Writing zarr without a MDASequence not yet implemented"
                 )
 
-            mmap = self._create_seq_memmap(frame, seq)[event.index.get("g", 0)]
+            self._create_seq_memmap(frame, seq)
         else:
             print("INDEX---------------\n", event.index)
             print("n_mmpas:", len(self._mmaps))
-            mmap = self._mmaps[event.index.get("g", 0)]
 
-        # WRITE DATA TO DISK
         index = tuple(event.index.get(k) for k in self._used_axes)
+        grid = event.index.get("g", 0)
         print("\033[1mWRITING image from", event.channel.config, "\033[0m")
-        print(frame.max())
-        mmap[index] = frame
-        mmap.flush()
+        if self._write_queue:
+            if not frame.flags.writeable and self._frame_source is None:
+                # borrowed frame that is not leased, e.g. a ProcessWriter slot
+                frame = frame.copy()
+            if not self._write_queue.put(grid, index, frame):
+                print("\033[1mWRITE QUEUE FULL, dropped frame\033[0m", event.index)
+                return False
+            return True
+        self._write_frame(grid, index, frame)
+        self._mmaps[grid].flush()
+        return False
 
-    # -------------------- private --------------------
+    def _write_frame(self, grid: int, index: tuple, frame: np.ndarray) -> None:
+        # WRITE DATA TO DISK
+        try:
+            self._mmaps[grid][index] = frame
+        finally:
+            if self._write_queue:
+                self._release(frame)
+
+    def _release(self, frame: np.ndarray) -> None:
+        if self._frame_source is not None:
+            self._frame_source.release(frame, "OME-TIFF writer")
+
+    def _flush(self) -> None:
+        for mmap in self._mmaps or []:
+            mmap.flush()
 
     def _set_sequence(self, seq: useq.MDASequence | None) -> None:
         """Set the current sequence, and update the used axes."""
@@ -159,6 +270,10 @@ class CoreOMETiffWriter:
         return self._mmaps
 
     def __del__(self):
-        for mmap in self._mmaps:
+        if self._write_queue:
+            # doesn't wait if this runs on the writer thread, which wrote the last
+            # queued frame and dropped the last reference with it
+            self._write_queue.drain()
+        for mmap in self._mmaps or []:
             mmap.flush()
             del mmap
\ No newline at end of file